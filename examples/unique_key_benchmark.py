@@ -0,0 +1,31 @@
+"""time util.unique_key against the pandas MultiIndex it replaced
+
+usage: python examples/unique_key_benchmark.py [n] [nkey]
+"""
+import sys
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from worms import util
+
+
+def main(n=1000000, nkey=1000):
+    a = np.random.randint(0, nkey, n)
+    b = np.random.randint(0, nkey, n)
+    util.unique_key(a[:10], b[:10])  # compile
+    for name, scale in (('dense', 1), ('sparse', 10**9)):
+        sa, sb = a * scale, b * scale
+        t1 = perf_counter()
+        key = util.unique_key(sa, sb)
+        t1 = perf_counter() - t1
+        t2 = perf_counter()
+        mi = pd.MultiIndex.from_arrays([sa, sb])
+        ref = mi.drop_duplicates().get_indexer(mi)
+        t2 = perf_counter() - t2
+        assert np.all(key == ref)
+        print('%-6s n %i unique_key jit %.4fs pandas %.4fs speedup %.1fx' %
+              (name, n, t1, t2, t2 / t1))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
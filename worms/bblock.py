@@ -1,6 +1,6 @@
 import numpy as np
 import numba as nb
-from worms import util
+from worms import util, pdbio, dssp
 from worms.util import jit
 import numba.types as nt
 import homog
@@ -51,16 +51,32 @@ def ncac_to_stubs(ncac):
     return stubs
 
 
-def BBlock(entry, pdbfile, pose, ss):
-    chains = util.get_chain_bounds(pose)
-    ss = np.frombuffer(ss.encode(), dtype='i1')
+def BBlock(entry, pdbfile, pose=None, ss=None):
+    """build a _BBlock for a database entry
+
+    Args:
+        entry (dict): database entry
+        pdbfile (str): structure file
+        pose (Pose, optional): pose of pdbfile. if None, the backbone is
+            read from pdbfile with worms.pdbio, no pyrosetta needed
+        ss (str, optional): dssp secondary structure, computed from the
+            backbone with worms.dssp if None
 
-    ncac = util.get_bb_coords(pose)
+    Returns:
+        _BBlock: or (None, pdbfile) if the connections are bad
+    """
+    if pose is None:
+        ncac, chains = pdbio.read_backbone(pdbfile)
+    else:
+        ncac, chains = util.get_bb_coords(pose), util.get_chain_bounds(pose)
+        assert len(pose) == len(ncac)
+    if ss is None:
+        ss = dssp.dssp(ncac, chains)
+    ss = np.frombuffer(ss.encode(), dtype='i1')
     stubs = ncac_to_stubs(ncac)
 
-    assert len(pose) == len(ncac)
-    assert len(pose) == len(stubs)
-    assert len(pose) == len(ss)
+    assert len(ncac) == len(stubs)
+    assert len(ncac) == len(ss)
     conn = _make_connections_array(entry['connections'], chains)
     if len(conn) is 0:
         print('bad conn info!', pdbfile)
@@ -0,0 +1,485 @@
+"""columnar, memory-mapped storage for many _BBlock
+
+all bblocks are concatenated into a handful of flat arrays plus an offsets
+table. arrays are opened with np.memmap (copy-on-write), so every process on
+a node shares the same page cache and BBlockStore.bblock returns views.
+the same columns back SharedBBlockPool, which puts them in shared memory
+for process pools
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import numba as nb
+import numba.types as nt
+
+from worms.bblock import _BBlock
+
+_STRING_FIELDS = ('file', 'components', 'protocol', 'name', 'classes', '_type',
+                  'base')
+
+# columns of the offsets table
+_OFST_RES, _OFST_CHAIN, _OFST_CONN, _OFST_CONN_NROW, _OFST_CONN_NCOL = range(5)
+_OFST_STR = 5
+_OFST_VALID = _OFST_STR + len(_STRING_FIELDS)
+_NOFST = _OFST_VALID + 1
+
+
+def bblock_columns(bblocks):
+    """concatenate bblocks into flat column arrays
+
+    Args:
+        bblocks (list(_BBlock)): bblocks to pack, order is preserved
+
+    Returns:
+        dict: name -> np.ndarray, including the 'offsets' table
+    """
+    nblk = len(bblocks)
+    offsets = np.zeros((nblk + 1, _NOFST), dtype='i8')
+    for i, bb in enumerate(bblocks):
+        offsets[i + 1, _OFST_RES] = len(bb.ncac)
+        offsets[i + 1, _OFST_CHAIN] = len(bb.chains)
+        offsets[i + 1, _OFST_CONN] = bb.connections.size
+        for j, field in enumerate(_STRING_FIELDS):
+            offsets[i + 1, _OFST_STR + j] = len(getattr(bb, field))
+    offsets = np.cumsum(offsets, axis=0)
+    # strings are laid out field by field, shift each field past the last
+    strofst = offsets[:, _OFST_STR:_OFST_VALID]
+    strofst[:, 1:] += np.cumsum(strofst[-1, :-1])
+    for i, bb in enumerate(bblocks):
+        offsets[i, _OFST_CONN_NROW] = bb.connections.shape[0]
+        offsets[i, _OFST_CONN_NCOL] = bb.connections.shape[1]
+        offsets[i, _OFST_VALID] = bb.validated
+
+    def cat(arrays, dtype, shape):
+        if not arrays: return np.zeros((0, ) + shape, dtype=dtype)
+        return np.ascontiguousarray(np.concatenate(arrays), dtype=dtype)
+
+    cols = dict(
+        offsets=offsets,
+        ncac=cat([bb.ncac for bb in bblocks], 'f8', (3, 4)),
+        stubs=cat([bb.stubs for bb in bblocks], 'f8', (4, 4)),
+        ss=cat([bb.ss for bb in bblocks], 'i1', ()),
+        chains=cat([bb.chains for bb in bblocks], 'i4', (2, )),
+        connections=cat([bb.connections.reshape(-1) for bb in bblocks], 'i4',
+                        ()),
+        strings=cat([getattr(bb, f) for f in _STRING_FIELDS
+                     for bb in bblocks], 'i1', ()),
+    )
+    return cols
+
+
+def bblock_from_columns(cols, i):
+    """build a _BBlock for entry i whose arrays are views into cols
+
+    Args:
+        cols (dict): as returned by bblock_columns
+        i (int): index of the bblock
+
+    Returns:
+        _BBlock: arrays share memory with cols
+    """
+    ofst = cols['offsets']
+    rb, re = ofst[i, _OFST_RES], ofst[i + 1, _OFST_RES]
+    cb, ce = ofst[i, _OFST_CHAIN], ofst[i + 1, _OFST_CHAIN]
+    kb, ke = ofst[i, _OFST_CONN], ofst[i + 1, _OFST_CONN]
+    nrow, ncol = ofst[i, _OFST_CONN_NROW], ofst[i, _OFST_CONN_NCOL]
+    strings = dict()
+    for j, field in enumerate(_STRING_FIELDS):
+        sb, se = ofst[i, _OFST_STR + j], ofst[i + 1, _OFST_STR + j]
+        strings[field] = cols['strings'][sb:se]
+    return _BBlock(
+        connections=cols['connections'][kb:ke].reshape(nrow, ncol),
+        validated=bool(ofst[i, _OFST_VALID]),
+        ncac=cols['ncac'][rb:re],
+        chains=cols['chains'][cb:ce],
+        ss=cols['ss'][rb:re],
+        stubs=cols['stubs'][rb:re],
+        **strings,
+    )
+
+
+@nb.jitclass((
+    ('offsets'    , nt.int64[:, :]),
+    ('ncac'       , nt.float64[:, :, :]),
+    ('stubs'      , nt.float64[:, :, :]),
+    ('ss'         , nt.int8[:]),
+    ('chains'     , nt.int32[:, :]),
+    ('connections', nt.int32[::1]),
+    ('strings'    , nt.int8[:]),
+))  # yapf: disable
+class _BBlockSet:
+    """a whole bblock library as concatenated arrays and an offsets table
+
+    the arrays are the columns from bblock_columns, so jitted code can loop
+    over every block of a library in a single call. chains and connection
+    residue numbers are local to their block
+
+    Attributes:
+        offsets (np.ndarray): (nblk + 1, _NOFST) offsets table
+        ncac (np.ndarray): (nres_total, 3, 4)
+        stubs (np.ndarray): (nres_total, 4, 4)
+        ss (np.ndarray): (nres_total,)
+        chains (np.ndarray): (nchain_total, 2)
+        connections (np.ndarray): flattened connections of all blocks
+        strings (np.ndarray): string fields of all blocks
+    """
+
+    def __init__(self, offsets, ncac, stubs, ss, chains, connections,
+                 strings):
+        self.offsets = offsets
+        self.ncac = ncac
+        self.stubs = stubs
+        self.ss = ss
+        self.chains = chains
+        self.connections = connections
+        self.strings = strings
+
+    @property
+    def len(self):
+        return len(self.offsets) - 1
+
+    def res_range(self, i):
+        """first and one past last residue of block i in ncac, stubs, ss"""
+        return self.offsets[i, _OFST_RES], self.offsets[i + 1, _OFST_RES]
+
+    def block_ncac(self, i):
+        return self.ncac[self.offsets[i, _OFST_RES]:
+                         self.offsets[i + 1, _OFST_RES]]
+
+    def block_stubs(self, i):
+        return self.stubs[self.offsets[i, _OFST_RES]:
+                          self.offsets[i + 1, _OFST_RES]]
+
+    def block_ss(self, i):
+        return self.ss[self.offsets[i, _OFST_RES]:
+                       self.offsets[i + 1, _OFST_RES]]
+
+    def block_chains(self, i):
+        return self.chains[self.offsets[i, _OFST_CHAIN]:
+                           self.offsets[i + 1, _OFST_CHAIN]]
+
+    def block_connections(self, i):
+        conn = self.connections[self.offsets[i, _OFST_CONN]:
+                                self.offsets[i + 1, _OFST_CONN]]
+        return conn.reshape((self.offsets[i, _OFST_CONN_NROW],
+                             self.offsets[i, _OFST_CONN_NCOL]))
+
+    def _string(self, i, j):
+        return self.strings[self.offsets[i, _OFST_STR + j]:
+                            self.offsets[i + 1, _OFST_STR + j]]
+
+    def bblock(self, i):
+        """_BBlock i, arrays are views into the set"""
+        return _BBlock(
+            self.block_connections(i), self._string(i, 0),
+            self._string(i, 1), self._string(i, 2), self._string(i, 3),
+            self._string(i, 4), self.offsets[i, _OFST_VALID] != 0,
+            self._string(i, 5), self._string(i, 6), self.block_ncac(i),
+            self.block_chains(i), self.block_ss(i), self.block_stubs(i)
+        )
+
+    @property
+    def _state(self):
+        return (self.offsets, self.ncac, self.stubs, self.ss, self.chains,
+                self.connections, self.strings)
+
+
+def BBlockSet(bblocks):
+    """pack bblocks into a _BBlockSet
+
+    Args:
+        bblocks (list(_BBlock)): bblocks, block i of the set is bblocks[i]
+
+    Returns:
+        _BBlockSet: concatenated copy of the bblocks
+    """
+    return _BBlockSet(**bblock_columns(list(bblocks)))
+
+
+def write_bblock_store(path, bblocks, metas=None):
+    """write a columnar store to directory path, replacing any existing one
+
+    the store is written to a temporary directory and moved into place, so
+    readers never see a partially written store
+
+    Args:
+        path (str): store directory
+        bblocks (dict): pdbfile -> _BBlock
+        metas (dict, optional): pdbfile -> cache key data (see
+            database.pdb_meta), stored for validation
+    """
+    metas = metas or dict()
+    path = os.path.abspath(str(path))
+    files = sorted(bblocks)
+    cols = bblock_columns([bblocks[f] for f in files])
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.bblock_store_tmp')
+    for name, ary in cols.items():
+        np.save(os.path.join(tmp, name + '.npy'), ary)
+    with open(os.path.join(tmp, 'index.json'), 'w') as out:
+        json.dump(dict(files=files, meta=[metas.get(f) for f in files]), out)
+    if os.path.exists(path):
+        old = tempfile.mkdtemp(dir=parent, prefix='.bblock_store_old')
+        os.rename(path, os.path.join(old, 'store'))
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(tmp, path)
+
+
+class BBlockStore:
+    """read-only columnar bblock store opened with np.memmap
+
+    Attributes:
+        path (str): store directory
+        files (list): pdbfiles in store order
+        index (dict): pdbfile -> position in store
+        meta (dict): pdbfile -> cache key data, may be None
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, 'index.json')) as inp:
+            index = json.load(inp)
+        self.files = index['files']
+        self.index = {f: i for i, f in enumerate(self.files)}
+        self.meta = dict(zip(self.files, index['meta']))
+        self._cols = dict()
+        for name in ('offsets', 'ncac', 'stubs', 'ss', 'chains',
+                     'connections', 'strings'):
+            fname = os.path.join(self.path, name + '.npy')
+            # copy-on-write keeps arrays writeable (as numba jitclass
+            # members must be) while sharing clean pages between processes
+            self._cols[name] = np.asarray(np.load(fname, mmap_mode='c'))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(str(path), 'index.json'))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, pdbfile):
+        return pdbfile in self.index
+
+    def bblock(self, pdbfile):
+        """zero-copy _BBlock for pdbfile
+
+        Args:
+            pdbfile (str): key as stored by write_bblock_store
+
+        Returns:
+            _BBlock: arrays are views of the memory mapped columns
+        """
+        return bblock_from_columns(self._cols, self.index[pdbfile])
+
+    def bblock_set(self):
+        """zero-copy _BBlockSet of all bblocks, in store order (self.files)"""
+        return _BBlockSet(**self._cols)
+
+
+_BUNDLE_MAGIC = b'WORMSBDL'
+_BUNDLE_ALIGN = 64
+
+
+def write_bblock_bundle(fname, bblocks, entries, metas=None):
+    """write bblocks, database entries and an index into a single file
+
+    layout is magic, header length, json header, then the column arrays,
+    each aligned to 64 bytes so they can be memory mapped in place. the file
+    is written under a temporary name and renamed into place
+
+    Args:
+        fname (str): bundle file
+        bblocks (dict): pdbfile -> _BBlock
+        entries (list): database entries (dicts) for the bblocks
+        metas (dict, optional): pdbfile -> cache key data
+    """
+    metas = metas or dict()
+    files = sorted(bblocks)
+    cols = bblock_columns([bblocks[f] for f in files])
+    header = dict(
+        files=files,
+        meta=[metas.get(f) for f in files],
+        entries=entries,
+        arrays=dict(),
+    )
+    offset = 0
+    for name, ary in cols.items():
+        header['arrays'][name] = (ary.dtype.str, ary.shape, offset)
+        offset += -(-ary.nbytes // _BUNDLE_ALIGN) * _BUNDLE_ALIGN
+    hdr = json.dumps(header).encode()
+    start = len(_BUNDLE_MAGIC) + 8 + len(hdr)
+    start = -(-start // _BUNDLE_ALIGN) * _BUNDLE_ALIGN
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(_BUNDLE_MAGIC)
+            out.write(np.uint64(len(hdr)).tobytes())
+            out.write(hdr)
+            for name, ary in cols.items():
+                out.seek(start + header['arrays'][name][2])
+                out.write(np.ascontiguousarray(ary).tobytes())
+            out.truncate(start + offset)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+
+class BBlockBundle(BBlockStore):
+    """BBlockStore backed by one bundle file from write_bblock_bundle
+
+    Attributes:
+        entries (list): database entries stored in the bundle, file names
+            as written
+    """
+
+    def __init__(self, fname, expand=None):
+        """open a bundle
+
+        Args:
+            fname (str): bundle file
+            expand (callable, optional): maps stored file names to the
+                names bblocks are looked up by, e.g. expanding __DATADIR__
+        """
+        self.path = str(fname)
+        with open(self.path, 'rb') as inp:
+            if inp.read(len(_BUNDLE_MAGIC)) != _BUNDLE_MAGIC:
+                raise ValueError('not a bblock bundle: ' + self.path)
+            hdrlen = int(np.frombuffer(inp.read(8), dtype='u8')[0])
+            header = json.loads(inp.read(hdrlen).decode())
+        start = len(_BUNDLE_MAGIC) + 8 + hdrlen
+        start = -(-start // _BUNDLE_ALIGN) * _BUNDLE_ALIGN
+        self.entries = header['entries']
+        self.files = header['files']
+        if expand is not None:
+            self.files = [expand(f) for f in self.files]
+        self.index = {f: i for i, f in enumerate(self.files)}
+        self.meta = dict(zip(self.files, header['meta']))
+        self._cols = dict()
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            if np.prod(shape) == 0:
+                self._cols[name] = np.zeros(shape, dtype=dtype)
+                continue
+            self._cols[name] = np.asarray(
+                np.memmap(self.path, dtype, 'c', start + offset, tuple(shape))
+            )
+
+    @staticmethod
+    def exists(fname):
+        return os.path.isfile(str(fname))
+
+
+# shared memory segments attached in this process, by segment name
+_attached_shm = dict()
+_shm_tracking_lock = threading.Lock()
+
+
+def _attach_shm(name):
+    """map an existing segment without tracking it in this process
+
+    the creator owns the segment. a resource_tracker of its own would
+    report it leaked, and unlink it, when this process exits. children of
+    the creator share its tracker, so unregistering would drop the
+    creator's record instead, the segment must not be registered at all
+    """
+    if name not in _attached_shm:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # python < 3.13 always registers
+            with _shm_tracking_lock:
+                register = resource_tracker.register
+                resource_tracker.register = _register_unless_shm(register)
+                try:
+                    shm = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+        _attached_shm[name] = shm
+    return _attached_shm[name]
+
+
+def _register_unless_shm(register):
+    def wrapper(name, rtype):
+        if rtype != 'shared_memory': register(name, rtype)
+
+    return wrapper
+
+
+class SharedBBlockPool:
+    """bblock columns in multiprocessing.shared_memory for process pools
+
+    the creating process packs the bblocks once. a pool pickles as only the
+    segment names and array layouts, so tasks submitted to a process pool
+    refer to bblocks by index and workers map the coordinates instead of
+    receiving a copy with every task. the creator must call close (or use
+    the pool as a context manager) to free the segments
+
+    Attributes:
+        layout (dict): name -> (shm name, dtype, shape) of each column
+    """
+
+    def __init__(self, bblocks):
+        cols = bblock_columns(list(bblocks))
+        self.layout = dict()
+        self._owned = list()
+        for name, ary in cols.items():
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(1, ary.nbytes)
+            )
+            np.ndarray(ary.shape, ary.dtype, shm.buf)[...] = ary
+            self._owned.append(shm)
+            self.layout[name] = (shm.name, ary.dtype.str, ary.shape)
+        self._cols = {
+            name: np.ndarray(shape, dtype, shm.buf)
+            for shm, (name, (_, dtype, shape)) in zip(
+                self._owned, self.layout.items()
+            )
+        }
+
+    def __getstate__(self):
+        return self.layout
+
+    def __setstate__(self, layout):
+        self.layout = layout
+        self._owned = list()
+        self._cols = {
+            name: np.ndarray(shape, dtype, _attach_shm(shmname).buf)
+            for name, (shmname, dtype, shape) in layout.items()
+        }
+
+    def __len__(self):
+        return len(self._cols['offsets']) - 1
+
+    def bblock(self, i):
+        """_BBlock i, arrays are views of the shared memory"""
+        return bblock_from_columns(self._cols, i)
+
+    def bblock_set(self):
+        """_BBlockSet of all bblocks, arrays are views of the shared memory"""
+        return _BBlockSet(**self._cols)
+
+    def close(self):
+        """free the shared memory, only valid in the creating process"""
+        self._cols = dict()
+        for shm in self._owned:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # bblock views still alive, unmapped when collected
+            shm.unlink()
+        self._owned = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
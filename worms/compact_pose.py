@@ -0,0 +1,131 @@
+"""compact, numpy-only pose storage
+
+a CompactPose keeps only what is needed to rebuild a pose: residue type
+names, per-atom names and coordinates, and chain ends. it is stored with
+np.savez, which is much smaller and faster to load than a pickled
+pyrosetta Pose, and can be used without pyrosetta
+"""
+
+import io
+from collections import namedtuple
+
+import numpy as np
+
+from worms import util
+
+try:
+    from pyrosetta import rosetta as ros
+    HAVE_PYROSETTA = True
+except ImportError:
+    HAVE_PYROSETTA = False
+
+CompactPose = namedtuple(
+    'CompactPose', 'resnames atomnames coords res_atom_start chain_ends'
+)
+CompactPose.__doc__ = """numpy-only pose
+
+Attributes:
+    resnames (np.ndarray): str, full residue type name per residue
+    atomnames (np.ndarray): S4, atom names in residue type order
+    coords (np.ndarray): float32 (natom, 3)
+    res_atom_start (np.ndarray): int32 (nres + 1,) atom offsets of residues
+    chain_ends (np.ndarray): int32 (nchain,) residue index one past the end
+        of each chain
+"""
+
+
+def compact_pose(pose):
+    """extract a CompactPose from a pyrosetta Pose
+
+    Args:
+        pose (Pose): pose to compact
+
+    Returns:
+        CompactPose: numpy-only copy of pose
+    """
+    resnames, atomnames, coords, natoms = [], [], [], [0]
+    for ir in range(1, len(pose) + 1):
+        res = pose.residue(ir)
+        resnames.append(res.name())
+        for ia in range(1, res.natoms() + 1):
+            atomnames.append(res.atom_name(ia).strip())
+            xyz = res.xyz(ia)
+            coords.append((xyz.x, xyz.y, xyz.z))
+        natoms.append(res.natoms())
+    chain_ends = [end for beg, end in util.get_chain_bounds(pose)]
+    return CompactPose(
+        resnames=np.array(resnames, dtype='U'),
+        atomnames=np.array(atomnames, dtype='S4'),
+        coords=np.array(coords, dtype='f4').reshape(-1, 3),
+        res_atom_start=np.cumsum(natoms).astype('i4'),
+        chain_ends=np.array(chain_ends, dtype='i4'),
+    )
+
+
+def compact_pose_bytes(cpose):
+    """serialize CompactPose with np.savez"""
+    buf = io.BytesIO()
+    np.savez(buf, **cpose._asdict())
+    return buf.getvalue()
+
+
+def compact_pose_from_bytes(data):
+    """inverse of compact_pose_bytes, data may also be a file name"""
+    if isinstance(data, bytes): data = io.BytesIO(data)
+    with np.load(data) as npz:
+        return CompactPose(*(npz[f] for f in CompactPose._fields))
+
+
+def compact_pose_bb_coords(cpose, atoms=(b'N', b'CA', b'C')):
+    """per-residue coordinates of atoms, like util.get_bb_coords
+
+    Args:
+        cpose (CompactPose): compact pose
+        atoms (tuple, optional): atom names
+
+    Returns:
+        np.ndarray: float64 (nres, len(atoms), 4), nan if atom is missing
+    """
+    nres = len(cpose.resnames)
+    crd = np.ones((nres, len(atoms), 4))
+    crd[..., :3] = np.nan
+    resi = np.repeat(np.arange(nres), np.diff(cpose.res_atom_start))
+    for i, name in enumerate(atoms):
+        sel = cpose.atomnames == name
+        crd[resi[sel], i, :3] = cpose.coords[sel]
+    return crd
+
+
+def pose_from_compact(cpose):
+    """rebuild a pyrosetta Pose from a CompactPose
+
+    residues are created from their full type names, one chain at a time,
+    then all atom coordinates are set from the stored ones
+
+    Args:
+        cpose (CompactPose): compact pose
+
+    Returns:
+        Pose: rebuilt pose
+    """
+    pose = ros.core.pose.Pose()
+    chain_begin = 0
+    for chain_end in cpose.chain_ends:
+        names = cpose.resnames[chain_begin:chain_end]
+        seq = ''.join('X[%s]' % n for n in names)
+        chain = ros.core.pose.Pose()
+        ros.core.pose.make_pose_from_sequence(chain, seq, 'fa_standard', False)
+        if len(pose):
+            ros.core.pose.append_pose_to_pose(pose, chain, True)
+        else:
+            pose = chain
+        chain_begin = chain_end
+    ids = ros.utility.vector1_core_id_AtomID()
+    xyzs = ros.utility.vector1_numeric_xyzVector_double_t()
+    for ir in range(len(cpose.resnames)):
+        beg, end = cpose.res_atom_start[ir:ir + 2]
+        for ia, (x, y, z) in enumerate(cpose.coords[beg:end].tolist()):
+            ids.append(ros.core.id.AtomID(ia + 1, ir + 1))
+            xyzs.append(ros.numeric.xyzVector_double_t(x, y, z))
+    pose.batch_set_xyz(ids, xyzs)
+    return pose
@@ -3,9 +3,11 @@
 import os
 import json
 import random
+import hashlib
 import _pickle as pickle
 from concurrent.futures import *
 import itertools as it
+from collections import defaultdict
 import logging
 from logging import info, warning, error
 from random import shuffle
@@ -16,6 +18,10 @@ from tqdm import tqdm
 from worms import util
 from worms import BBlock
 from worms.bblock import _BBlock
+from worms.bblock_store import (BBlockStore, BBlockBundle, BBlockSet,
+                                 write_bblock_store, write_bblock_bundle)
+from worms.compact_pose import (compact_pose, compact_pose_bytes,
+                                compact_pose_from_bytes, pose_from_compact)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -40,6 +46,76 @@ def flatten_path(pdbfile):
     return pdbfile.replace(os.sep, '__') + '.pickle'
 
 
+def _expand_datadir(fname):
+    """database file name with __DATADIR__ replaced by worms/data"""
+    return fname.replace(
+        '__DATADIR__', os.path.relpath(os.path.dirname(__file__) + '/data')
+    )
+
+
+_ENTRY_KEY_FIELDS = ('file', 'name', 'class', 'type', 'base', 'components',
+                     'validated', 'protocol', 'connections')
+
+
+def entry_hash(entry):
+    """hash of the database entry fields that go into a bblock"""
+    fields = {k: entry.get(k) for k in _ENTRY_KEY_FIELDS}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+def pdb_meta(pdbfile, entry, meta=None):
+    """content addressed cache key for pdbfile and its database entry
+
+    the pdb is only read and hashed if its mtime or size differ from those
+    recorded in meta
+
+    Args:
+        pdbfile (str): pdb file name
+        entry (dict): database entry for pdbfile
+        meta (dict, optional): previously computed pdb_meta
+
+    Returns:
+        dict: key, pdb_hash, pdb_mtime, pdb_size
+    """
+    st = os.stat(pdbfile)
+    if (meta and meta['pdb_mtime'] == st.st_mtime
+            and meta['pdb_size'] == st.st_size):
+        pdb_hash = meta['pdb_hash']
+    else:
+        with open(pdbfile, 'rb') as inp:
+            pdb_hash = hashlib.sha1(inp.read()).hexdigest()
+    key = hashlib.sha1((pdb_hash + entry_hash(entry)).encode()).hexdigest()
+    return dict(
+        key=key,
+        pdb_hash=pdb_hash,
+        pdb_mtime=st.st_mtime,
+        pdb_size=st.st_size,
+    )
+
+
+def bblock_nbytes(bblock):
+    """memory held by a _BBlock's arrays"""
+    return sum(getattr(x, 'nbytes', 0) for x in bblock._state)
+
+
+# rough in-memory footprint of a pyrosetta Pose, which can't be measured
+POSE_BYTES_PER_RESIDUE = 16384
+
+
+def pose_nbytes(pose):
+    """estimated memory held by a pose"""
+    return len(pose) * POSE_BYTES_PER_RESIDUE
+
+
+def _load_bblock_cache_file(bblockfile):
+    """return meta, bblock state; meta is None for old unversioned files"""
+    with open(bblockfile, 'rb') as f:
+        data = pickle.load(f)
+    if isinstance(data, dict):
+        return data['meta'], data['state']
+    return None, tuple(data)
+
+
 class BBlockDB:
     """TODO: Summary
 
@@ -64,6 +140,11 @@ class BBlockDB:
             lazy=True,
             read_new_pdbs=False,
             progressbar=True,
+            bblock_cache_bytes=None,
+            pose_cache_bytes=None,
+            pose_format='pickle',
+            bundle=None,
+            pdb_reader=None,
     ):
         """TODO: Summary
 
@@ -74,7 +155,33 @@ class BBlockDB:
             nprocs (int, optional): Description
             lazy (bool, optional): Description
             read_new_pdbs (bool, optional): Description
+            bblock_cache_bytes (int, optional): memory budget for bblocks,
+                least recently used are evicted and reloaded from disk
+                on demand. None for unbounded
+            pose_cache_bytes (int, optional): same for poses
+            pose_format (str, optional): 'pickle' caches pickled poses,
+                'compact' caches a CompactPose (names, coordinates and
+                chain ends) which is much smaller and faster to load
+            bundle (str, optional): file written by export_bundle. its
+                entries are added to the database and its bblocks are
+                served read-only from the memory mapped bundle, without
+                reading or validating individual cache files
+            pdb_reader (str, optional): how new pdbs are read, 'pyrosetta'
+                or 'numpy'. 'numpy' reads only the backbone with
+                worms.pdbio, assigns secondary structure with worms.dssp
+                and caches no pose, so it can't be combined with
+                load_poses. default is 'pyrosetta' if it is available
         """
+        assert pose_format in ('pickle', 'compact')
+        if pdb_reader is None:
+            pdb_reader = 'pyrosetta' if HAVE_PYROSETTA else 'numpy'
+        assert pdb_reader in ('pyrosetta', 'numpy')
+        if load_poses and pdb_reader == 'numpy':
+            raise ValueError(
+                "pdb_reader='numpy' caches no poses, it can't be used with "
+                'load_poses=True'
+            )
+        self.pdb_reader = pdb_reader
         if cachedir is None:
             if 'HOME' in os.environ:
                 cachedir = os.environ['HOME'] + os.sep + '.worms/cache'
@@ -82,25 +189,41 @@ class BBlockDB:
                 cachedir = '.worms/cache'
         self.cachedir = str(cachedir)
         self.load_poses = load_poses
-        os.makedirs(self.cachedir + '/poses', exist_ok=True)
-        os.makedirs(self.cachedir + '/bblock', exist_ok=True)
-        self._bblock_cache, self._poses_cache = dict(), dict()
+        self.pose_format = pose_format
+        self._bblock_cache = util.LRUCache(bblock_cache_bytes, bblock_nbytes)
+        self._poses_cache = util.LRUCache(pose_cache_bytes, pose_nbytes)
+        self._cache_meta = dict()
+        self._store = None
+        self._alldb = []
+        if bundle is not None:
+            self._store = BBlockBundle(bundle, expand=_expand_datadir)
+            self._alldb.extend(self._store.entries)
+            # a bundle is a snapshot, trust it rather than stat every pdb
+            self._cache_meta.update(self._store.meta)
+            info('opened bundle with %i entries' % len(self._store))
+        else:
+            os.makedirs(self.cachedir + '/poses', exist_ok=True)
+            os.makedirs(self.cachedir + '/bblock', exist_ok=True)
+        if self._store is None and BBlockStore.exists(self.storedir):
+            self._store = BBlockStore(self.storedir)
+            info('opened bblock store with %i entries' % len(self._store))
         self.nprocs = nprocs
         self.lazy = lazy
         self.read_new_pdbs = read_new_pdbs
         self.progressbar = progressbar
-        self._alldb = []
-        self._holding_lock = False
+        self._query_index = None
+        self._query_cache = dict()
         for dbfile in bakerdb_files:
             with open(dbfile) as f:
                 self._alldb.extend(json.load(f))
+        # file names as in the database files, for export_bundle
+        self._unexpanded_file = dict()
         for entry in self._alldb:
             if 'name' not in entry:
                 entry['name'] = ''
-            entry['file'] = entry['file'].replace(
-                '__DATADIR__',
-                os.path.relpath(os.path.dirname(__file__) + '/data')
-            )
+            fname = entry['file']
+            entry['file'] = _expand_datadir(fname)
+            self._unexpanded_file[entry['file']] = fname
         self.dictdb = {e['file']: e for e in self._alldb}
         if len(self._alldb) != len(self.dictdb):
             warning('!' * 100)
@@ -114,39 +237,15 @@ class BBlockDB:
         self.n_missing_entries = len(self._alldb)
         if not self.lazy:
             self.n_new_entries, self.n_missing_entries = self.load_from_pdbs()
-            if self._holding_lock: self.unlock_cachedir()
-            if nprocs != 1:
-                # reload because processpool cache entries not serialized back
-                self.nprocs = 1
-                self.load_from_pdbs()
         for i, k in enumerate(sorted(self.dictdb)):
             self._alldb[i] = self.dictdb[k]
-
-    def lock_cachedir(self):
-        assert not os.path.exists(self.cachedir + '/lock'), (
-            "database is locked! if you're sure no other jobs are editing it, remove "
-            + self.cachedir + "/lock"
-        )
-        open(self.cachedir + '/lock', 'w').close()
-        assert os.path.exists(self.cachedir + '/lock')
-        self._holding_lock = True
-
-    def unlock_cachedir(self):
-        os.remove(self.cachedir + '/lock')
-        self._holding_lock = False
-
-    def islocked_cachedir(self):
-        return os.path.exists(self.cachedir + '/lock')
-
-    def check_lock_cachedir(self):
-        if not self._holding_lock:
-            self.lock_cachedir()
+        self.database_changed()
 
     def __getitem__(self, i):
         if isinstance(i, str):
-            return self._bblock_cache[i]
+            return self.bblock(i)
         else:
-            return self._bblock_cache.values()[i]
+            return list(self._bblock_cache.values())[i]
 
     def __len__(self):
         """TODO: Summary
@@ -167,10 +266,12 @@ class BBlockDB:
         """
         if isinstance(pdbfile, bytes):
             pdbfile = str(pdbfile, 'utf-8')
-        if not pdbfile in self._poses_cache:
+        pose = self._poses_cache.get(pdbfile)
+        if pose is None:
             if not self.load_cached_pose_into_memory(pdbfile):
                 self._poses_cache[pdbfile] = pose_from_file(pdbfile)
-        return self._poses_cache[pdbfile]
+            pose = self._poses_cache[pdbfile]
+        return pose
 
     def bblock(self, pdbfile):
         """TODO: Summary
@@ -182,22 +283,55 @@ class BBlockDB:
             TYPE: Description
         """
         if isinstance(pdbfile, str):
-            if not pdbfile in self._bblock_cache:
+            bblock = self._bblock_cache.get(pdbfile)
+            if bblock is None:
                 if not self.load_cached_bblock_into_memory(pdbfile):
-                    raise valueError('no bblock data for ', pdbfile)
-            return self._bblock_cache[pdbfile]
+                    raise ValueError('no bblock data for ' + pdbfile)
+                bblock = self._bblock_cache[pdbfile]
+            return bblock
         elif isinstance(pdbfile, list):
             return [self.bblock(f) for f in pdbfile]
         else:
             raise ValueError('bad pdbfile' + str(type(pdbfile)))
 
-    def query(self, query, *, useclass=True, max_bblocks=150, shuffle=True):
+    def cache_stats(self):
+        """hit/miss/eviction counters and sizes of the in-memory caches"""
+        return dict(
+            bblock=self._bblock_cache.stats(),
+            pose=self._poses_cache.stats(),
+        )
+
+    def query(
+            self,
+            query,
+            *,
+            useclass=True,
+            max_bblocks=150,
+            shuffle=True,
+            as_set=False
+    ):
+        """bblocks matching query, see query_names
+
+        Args:
+            query (str): query string
+            useclass (bool, optional): match class as well as type
+            max_bblocks (int, optional): at most this many are returned
+            shuffle (bool, optional): random subset if there are too many
+            as_set (bool, optional): return one _BBlockSet holding all the
+                bblocks (in the same order) instead of a list
+
+        Returns:
+            list(_BBlock) or _BBlockSet: matching bblocks
+        """
         names = self.query_names(query, useclass=useclass)
         if len(names) > max_bblocks:
             if shuffle:
                 random.shuffle(names)
             names = names[:max_bblocks]
-        return [self.bblock(n) for n in names]
+        bblocks = [self.bblock(n) for n in names]
+        if as_set:
+            return BBlockSet(bblocks)
+        return bblocks
 
     def query_names(self, query, *, useclass=True):
         """
@@ -206,6 +340,8 @@ class BBlockDB:
         if _type and _class match, check useclass option
         Het:NNCx/y require exact number or require extra
 
+        results are memoized until the database changes
+
         Args:
             query (TYPE): Description
             useclass (bool, optional): Description
@@ -213,13 +349,21 @@ class BBlockDB:
         Returns:
             TYPE: Description
         """
+        key = query, useclass
+        if key not in self._query_cache:
+            self._query_cache[key] = self._query_names(query, useclass)
+        return list(self._query_cache[key])
+
+    def _query_names(self, query, useclass):
         if query.lower() == "all":
             return [db['file'] for db in self._alldb]
+        index = self.query_index()
+        files = lambda ids: [self._alldb[i]['file'] for i in ids]
         query, subq = query.split(':') if query.count(':') else (query, None)
         if subq is None:
-            c_hits = [db['file'] for db in self._alldb if query in db['class']]
-            n_hits = [db['file'] for db in self._alldb if query == db['name']]
-            t_hits = [db['file'] for db in self._alldb if query == db['type']]
+            c_hits = files(index['class'].get(query, []))
+            n_hits = files(index['name'].get(query, []))
+            t_hits = files(index['type'].get(query, []))
             if not c_hits and not n_hits: return t_hits
             if not c_hits and not t_hits: return n_hits
             if not t_hits and not n_hits: return c_hits
@@ -231,18 +375,45 @@ class BBlockDB:
             if subq.endswith('Y'): excon = False
             hits = list()
             assert query == 'Het'
-            for db in self._alldb:
-                if not query in db['class']: continue
-                nc = [_ for _ in db['connections'] if _['direction'] == 'C']
-                nn = [_ for _ in db['connections'] if _['direction'] == 'N']
-                nc, tc = len(nc), subq.count('C')
-                nn, tn = len(nn), subq.count('N')
+            tc, tn = subq.count('C'), subq.count('N')
+            for (nn, nc), ids in index['Het_nconn'].items():
                 if nc >= tc and nn >= tn:
                     if nc + nn == tc + tn and excon is not True:
-                        hits.append(db['file'])
+                        hits.extend(ids)
                     elif nc + nn > tc + tn and excon is not False:
-                        hits.append(db['file'])
-        return hits
+                        hits.extend(ids)
+            return files(sorted(hits))
+
+    def query_index(self):
+        """inverted index over _alldb, built on first use
+
+        Returns:
+            dict: 'class', 'name' and 'type' map values to entry ids,
+            'Het_nconn' maps (nN, nC) to ids of 'Het' class entries
+        """
+        if self._query_index is None:
+            index = dict(
+                (k, defaultdict(list))
+                for k in ('class', 'name', 'type', 'Het_nconn')
+            )
+            for i, db in enumerate(self._alldb):
+                classes = db['class']
+                if isinstance(classes, str): classes = [classes]
+                for c in sorted(set(classes)):
+                    index['class'][c].append(i)
+                index['name'][db['name']].append(i)
+                index['type'][db['type']].append(i)
+                if 'Het' in classes:
+                    dirns = [c['direction'] for c in db['connections']]
+                    nconn = dirns.count('N'), dirns.count('C')
+                    index['Het_nconn'][nconn].append(i)
+            self._query_index = {k: dict(v) for k, v in index.items()}
+        return self._query_index
+
+    def database_changed(self):
+        """drop the query index and memoized queries after _alldb changes"""
+        self._query_index = None
+        self._query_cache = dict()
 
     def load_cached_pose_into_memory(self, pdbfile):
         """TODO: Summary
@@ -257,19 +428,120 @@ class BBlockDB:
         try:
             with open(posefile, 'rb') as f:
                 try:
-                    self._poses_cache[pdbfile] = pickle.load(f)
+                    self._poses_cache[pdbfile] = self._decode_pose(f.read())
                     return True
-                except EOFError:
-                    warning('corrupt pickled pose will be replaced', posefile)
+                except (EOFError, ValueError, OSError):
+                    warning('corrupt cached pose will be replaced', posefile)
                     os.remove(posefile)
                     return False
         except FileNotFoundError:
             return False
 
+    def compact_pose(self, pdbfile):
+        """numpy-only CompactPose for pdbfile, no pyrosetta needed
+
+        Args:
+            pdbfile (str): pdb file name
+
+        Returns:
+            CompactPose: from the cache, requires pose_format='compact'
+        """
+        assert self.pose_format == 'compact'
+        if isinstance(pdbfile, bytes):
+            pdbfile = str(pdbfile, 'utf-8')
+        return compact_pose_from_bytes(self.posefile(pdbfile))
+
+    def _decode_pose(self, posedata):
+        if self.pose_format == 'compact':
+            return pose_from_compact(compact_pose_from_bytes(posedata))
+        return pickle.loads(posedata)
+
     def bblockfile(self, pdbfile):
         """TODO: Summary"""
         return os.path.join(self.cachedir, 'bblock', flatten_path(pdbfile))
 
+    @property
+    def storedir(self):
+        """directory of the columnar bblock store"""
+        return os.path.join(self.cachedir, 'bblock_store')
+
+    def is_current(self, pdbfile, meta):
+        """check cache meta against the pdb file and its database entry
+
+        validation is lazy: the pdb is rehashed only if its mtime or size
+        changed, and each pdbfile is validated once per BBlockDB
+
+        Args:
+            pdbfile (str): pdb file name
+            meta (dict): as returned by pdb_meta, None for unversioned data
+
+        Returns:
+            bool: True if cached data can be used
+        """
+        if pdbfile in self._cache_meta:
+            return self._cache_meta[pdbfile] == meta
+        if meta is None:
+            # unversioned cache data is used only if it can't be replaced
+            if self.read_new_pdbs: return False
+            warning('unversioned cache data for ' + pdbfile)
+        elif pdbfile in self.dictdb and os.path.exists(pdbfile):
+            current = pdb_meta(pdbfile, self.dictdb[pdbfile], meta)
+            if current['key'] != meta['key']:
+                if not self.read_new_pdbs:
+                    warning('ignoring stale cache data for ' + pdbfile)
+                return False
+        self._cache_meta[pdbfile] = meta
+        return True
+
+    def build_bblock_store(self):
+        """pack all bblocks in the database into the columnar store
+
+        once written, bblocks are served as views of memory mapped arrays
+        instead of being unpickled one file at a time
+
+        Returns:
+            int: number of bblocks in the store
+        """
+        bblocks = dict()
+        for entry in self._alldb:
+            pdbfile = entry['file']
+            if self.load_cached_bblock_into_memory(pdbfile):
+                bblocks[pdbfile] = self._bblock_cache[pdbfile]
+        metas = {f: self._cache_meta.get(f) for f in bblocks}
+        write_bblock_store(self.storedir, bblocks, metas)
+        self._store = BBlockStore(self.storedir)
+        for pdbfile in list(self._bblock_cache):
+            if pdbfile in self._store:
+                self._bblock_cache[pdbfile] = self._store.bblock(pdbfile)
+        return len(bblocks)
+
+    def export_bundle(self, fname):
+        """write all bblocks and db entries into a single bundle file
+
+        the bundle can be copied to compute nodes and opened with
+        BBlockDB(bundle=fname), avoiding one cache file per bblock. file
+        names are stored as in the database files, __DATADIR__ is expanded
+        where the bundle is opened
+
+        Args:
+            fname (str): bundle file to write
+
+        Returns:
+            int: number of bblocks in the bundle
+        """
+        bblocks, entries, metas = dict(), [], dict()
+        for entry in self._alldb:
+            pdbfile = entry['file']
+            if self.load_cached_bblock_into_memory(pdbfile):
+                stored = self._unexpanded_file.get(pdbfile, pdbfile)
+                bblocks[stored] = self._bblock_cache[pdbfile]
+                metas[stored] = self._cache_meta.get(pdbfile)
+                entries.append(dict(entry, file=stored))
+            else:
+                warning('no bblock for %s, not added to bundle' % pdbfile)
+        write_bblock_bundle(fname, bblocks, entries, metas)
+        return len(bblocks)
+
     def load_cached_bblock_into_memory(self, pdbfile):
         """TODO: Summary
 
@@ -284,18 +556,27 @@ class BBlockDB:
             for f in pdbfile:
                 success &= self.load_cached_bblock_into_memory(f)
             return success
-        bblockfile = self.bblockfile(pdbfile)
-        try:
-            with open(bblockfile, 'rb') as f:
-                bbstate = list(pickle.load(f))
-                self._bblock_cache[pdbfile] = _BBlock(*bbstate)
+        if pdbfile in self._bblock_cache:
+            return True
+        if self._store is not None and pdbfile in self._store:
+            if self.is_current(pdbfile, self._store.meta[pdbfile]):
+                self._bblock_cache[pdbfile] = self._store.bblock(pdbfile)
                 return True
-        except FileNotFound:
+        try:
+            meta, bbstate = _load_bblock_cache_file(self.bblockfile(pdbfile))
+        except FileNotFoundError:
             return False
+        if not self.is_current(pdbfile, meta):
+            return False
+        self._bblock_cache[pdbfile] = _BBlock(*bbstate)
+        return True
 
     def posefile(self, pdbfile):
         """TODO: Summary"""
-        return os.path.join(self.cachedir, 'poses', flatten_path(pdbfile))
+        fname = flatten_path(pdbfile)
+        if self.pose_format == 'compact':
+            fname = fname.replace('.pickle', '.npz')
+        return os.path.join(self.cachedir, 'poses', fname)
 
     def load_from_pdbs(self):
         """Summary
@@ -303,43 +584,61 @@ class BBlockDB:
        Returns:
            TYPE: Description
        """
+        self.database_changed()
         shuffle(self._alldb)
         if self.nprocs is 1:
             with util.InProcessExecutor() as exe:
                 result = self.load_from_pdbs_inner(exe)
         else:
-            with ThreadPoolExecutor(max_workers=self.nprocs) as exe:
+            with ProcessPoolExecutor(max_workers=self.nprocs) as exe:
                 result = self.load_from_pdbs_inner(exe)
         new = [_[0] for _ in result if _[0]]
         missing = [_[1] for _ in result if _[1]]
         for miss in missing:
             self._alldb.remove(self.dictdb[miss])
             del self.dictdb[miss]
+        self.database_changed()
         return len(new), len(missing)
 
     def load_from_pdbs_inner(self, exe):
-        """Summary
+        """load cached entries in this process, read new pdbs with exe
 
-       Args:
-           exe (TYPE): Description
+        workers write the cache files and send the bblock state, and the
+        serialized pose if load_poses, back, so all in-memory caching happens
+        here in the parent
 
-       Returns:
-           TYPE: Description
-       """
-        # return exe.map(self.build_pdb_data, self._alldb)
+        Args:
+            exe (Executor): runs _read_new_pdb, may be a process pool
+
+        Returns:
+            list: (new, missing) for each entry
+        """
         shuffle(self._alldb)
-        r = []
+        r, futures = [], []
+        for entry in self._alldb:
+            if self.load_cached_bblock_into_memory(entry['file']):
+                r.append(self.build_pdb_data(entry))
+            elif not self.read_new_pdbs:
+                warning('no cached data for: ' + entry['file'])
+                r.append((None, entry['file']))  # new, missing
+            else:
+                futures.append(
+                    exe.submit(
+                        _read_new_pdb, entry, self.bblockfile(entry['file']),
+                        self.posefile(entry['file']), self.pose_format,
+                        self.pdb_reader, self.load_poses
+                    )
+                )
         kwargs = {
-            'total': len(self._alldb),
+            'total': len(futures),
             'unit': 'pdbs',
             # 'unit_scale': True,
             'leave': True
         }
-        futures = [exe.submit(self.build_pdb_data, e) for e in self._alldb]
         work = as_completed(futures)
         if self.progressbar: work = tqdm(work, **kwargs)
         for f in work:
-            r.append(f.result())
+            r.append(self.add_new_pdb_data(*f.result()))
         return r
 
     def build_pdb_data(self, entry):
@@ -352,38 +651,103 @@ class BBlockDB:
             TYPE: Description
         """
         pdbfile = entry['file']
-        cachefile = os.path.join(
-            self.cachedir, 'bblock', flatten_path(pdbfile)
-        )
-        posefile = self.posefile(pdbfile)
-        if os.path.exists(cachefile):
-            assert self.load_cached_bblock_into_memory(pdbfile)
+        if self.load_cached_bblock_into_memory(pdbfile):
             if self.load_poses:
                 assert self.load_cached_pose_into_memory(pdbfile)
             return None, None  # new, missing
         elif self.read_new_pdbs:
-            self.check_lock_cachedir()
-            read_pdb = False
-            # info('BBlockDB.build_pdb_data reading %s' % pdbfile)
-            pose = self.pose(pdbfile)
-            ss = Dssp(pose).get_dssp_secstruct()
-            bblock = BBlock(entry, pdbfile, pose, ss)
-            self._bblock_cache[pdbfile] = bblock
-
-            with open(cachefile, 'wb') as f:
-                pickle.dump(bblock._state, f)
-            if not os.path.exists(posefile):
-                with open(posefile, 'wb') as f:
-                    pickle.dump(pose, f)
-                    info('dumped _bblock_cache files for %s' % pdbfile)
-
-            if self.load_poses:
-                self._poses_cache[pdbfile] = pose
-            return pdbfile, None  # new, missing
+            return self.add_new_pdb_data(
+                *_read_new_pdb(
+                    entry, self.bblockfile(pdbfile), self.posefile(pdbfile),
+                    self.pose_format, self.pdb_reader, self.load_poses
+                )
+            )
         else:
             warning('no cached data for: ' + pdbfile)
             return None, pdbfile  # new, missing
 
+    def add_new_pdb_data(self, pdbfile, bbstate, posedata, meta=None):
+        """keep data produced by _read_new_pdb in memory, return new, missing
+
+        Args:
+            pdbfile (str): pdb file name
+            bbstate (tuple): _BBlock state, None if the entry is bad
+            posedata (bytes): serialized pose, None if another job cached it
+                or no pose was read
+            meta (dict): cache key data, as returned by pdb_meta
+
+        Returns:
+            TYPE: Description
+        """
+        if bbstate is None:
+            return None, pdbfile  # new, missing
+        self._bblock_cache[pdbfile] = _BBlock(*bbstate)
+        self._cache_meta[pdbfile] = meta
+        if self.load_poses:
+            if posedata is None:
+                self.pose(pdbfile)  # cached by another job or not at all
+            else:
+                self._poses_cache[pdbfile] = self._decode_pose(posedata)
+        return pdbfile, None  # new, missing
+
+
+def _read_new_pdb(
+        entry, bblockfile, posefile, pose_format='pickle',
+        pdb_reader='pyrosetta', return_pose=True
+):
+    """read pdb, compute and cache bblock data, safe in a worker process
+
+    many jobs may fill the same cachedir concurrently: each entry is guarded
+    by its own FileLock and files are written atomically, so readers never
+    see partial files and an entry is read only once. cache files record
+    the content addressed key from pdb_meta, stale files are replaced
+
+    Args:
+        entry (dict): database entry
+        bblockfile (str): bblock cache file
+        posefile (str): pose cache file
+        pose_format (str): 'pickle' or 'compact'
+        pdb_reader (str): 'pyrosetta', or 'numpy' to read only the backbone
+            without pyrosetta, no pose is cached
+        return_pose (bool): send the serialized pose back, else it is only
+            written to posefile
+
+    Returns:
+        (str, tuple, bytes, dict): pdbfile, _BBlock state (None if the entry
+        is bad), the serialized pose (None if another job cached the entry,
+        no pose was read or not return_pose) and the cache key data
+    """
+    pdbfile = entry['file']
+    with util.FileLock(bblockfile):
+        meta = pdb_meta(pdbfile, entry)
+        if os.path.exists(bblockfile):
+            oldmeta, bbstate = _load_bblock_cache_file(bblockfile)
+            if oldmeta is not None and oldmeta['key'] == meta['key']:
+                return pdbfile, bbstate, None, oldmeta
+        # info('BBlockDB.build_pdb_data reading %s' % pdbfile)
+        if pdb_reader == 'numpy':
+            pose = None
+            bblock = BBlock(entry, pdbfile)
+        else:
+            pose = pose_from_file(pdbfile)
+            ss = Dssp(pose).get_dssp_secstruct()
+            bblock = BBlock(entry, pdbfile, pose, ss)
+        if isinstance(bblock, tuple):
+            return pdbfile, None, None, None
+        posedata = None
+        if pose is not None and pose_format == 'compact':
+            posedata = compact_pose_bytes(compact_pose(pose))
+        elif pose is not None:
+            posedata = pickle.dumps(pose)
+        util.atomic_write(
+            bblockfile, pickle.dumps(dict(meta=meta, state=bblock._state))
+        )
+        if posedata is not None:
+            util.atomic_write(posefile, posedata)
+        info('dumped _bblock_cache files for %s' % pdbfile)
+    if not return_pose: posedata = None
+    return pdbfile, bblock._state, posedata, meta
+
 
 if __name__ == '__main__':
     import argparse
@@ -398,6 +762,14 @@ if __name__ == '__main__':
     parser.add_argument(
         '--read_new_pdbs', type=bool, dest='read_new_pdbs', default=False
     )
+    parser.add_argument(
+        '--bblock_store', type=bool, dest='bblock_store', default=False
+    )
+    parser.add_argument(
+        '--pose_format', type=str, dest='pose_format', default='pickle'
+    )
+    parser.add_argument('--export_bundle', type=str, dest='export_bundle')
+    parser.add_argument('--pdb_reader', type=str, dest='pdb_reader')
     args = parser.parse_args()
     pyrosetta.init('-mute all -ignore_unrecognized_res')
 
@@ -407,13 +779,15 @@ if __name__ == '__main__':
             nprocs=args.nprocs,
             read_new_pdbs=args.read_new_pdbs,
             lazy=False,
+            pose_format=args.pose_format,
+            pdb_reader=args.pdb_reader,
         )
         print('new entries', pp.n_new_entries)
         print('missing entries', pp.n_missing_entries)
         print('total entries', len(pp._bblock_cache))
+        if args.bblock_store:
+            print('stored entries', pp.build_bblock_store())
+        if args.export_bundle:
+            print('bundled entries', pp.export_bundle(args.export_bundle))
     except AssertionError as e:
         print(e)
-    except:
-        if args.read_new_pdbs:
-            os.remove(os.environ['HOME'] + '/.worms/cache/lock')
-        raise
@@ -0,0 +1,221 @@
+"""dssp style secondary structure from backbone N, CA, C coordinates
+
+follows Kabsch & Sander: carbonyl O and amide H are placed from the
+backbone, the electrostatic hbond energy is computed for all residue pairs
+with CA within 9A, and helices and bridges are assigned from the hbond
+pattern. the result uses the reduced alphabet of rosetta's
+Dssp.get_dssp_secstruct: H (H, G, I), E (E, B) and L (everything else)
+"""
+
+import numpy as np
+
+from worms.util import jit
+
+try:
+    from pyrosetta import pose_from_file
+    from pyrosetta.rosetta.core.scoring.dssp import Dssp
+    HAVE_PYROSETTA = True
+except ImportError:
+    HAVE_PYROSETTA = False
+
+HBOND_MAX_ENERGY = -0.5  # kcal/mol
+_Q1Q2F = 0.42 * 0.20 * 332.0
+_CA_CUTOFF = 9.0
+_CO_BOND = 1.231
+_NH_BOND = 1.01
+
+
+def _unit(v):
+    return v / np.linalg.norm(v, axis=-1)[..., None]
+
+
+def backbone_o_h(ncac, chains):
+    """place carbonyl O and amide H from N, CA and C
+
+    O of residue i lies on the bisector of CA-C and N(i+1)-C, pointing away
+    from both, H of residue i points along C(i-1)->O(i-1) from N, as in dssp.
+    the last residue of a chain gets O along CA->C, the first no H
+
+    Args:
+        ncac (np.ndarray): (nres, 3, 3+) N, CA, C coordinates
+        chains (list): [(begin, end), ...] residue bounds of chains
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): O (nres, 3), H (nres, 3) and
+        bool has_h (nres,)
+    """
+    n, ca, c = (ncac[:, k, :3].astype('f8') for k in range(3))
+    nres = len(ncac)
+    last = np.zeros(nres, dtype='?')
+    first = np.zeros(nres, dtype='?')
+    for beg, end in chains:
+        if end > beg:
+            first[beg] = True
+            last[end - 1] = True
+    nnext = np.empty_like(n)
+    nnext[:-1] = n[1:]
+    nnext[-1] = c[-1]
+    dirn = _unit(c - ca)
+    dirn[~last] += _unit(c[~last] - nnext[~last])
+    o = c + _CO_BOND * _unit(dirn)
+    h = n.copy()
+    h[1:] += _NH_BOND * _unit(c[:-1] - o[:-1])
+    return o, h, ~first
+
+
+@jit
+def _hbond_matrix(n, ca, c, o, h, has_h, cutoff, emax):
+    """hb[i, j]: C=O of residue i accepts an hbond from N-H of residue j"""
+    nres = len(n)
+    hb = np.zeros((nres, nres), dtype=np.bool_)
+    cut2 = cutoff * cutoff
+    for i in range(nres):
+        for j in range(nres):
+            if i == j or j == i + 1 or not has_h[j]:
+                continue
+            d = ca[i] - ca[j]
+            if np.sum(d * d) > cut2:
+                continue
+            don = np.sqrt(np.sum((o[i] - n[j])**2))
+            dch = np.sqrt(np.sum((c[i] - h[j])**2))
+            doh = np.sqrt(np.sum((o[i] - h[j])**2))
+            dcn = np.sqrt(np.sum((c[i] - n[j])**2))
+            e = _Q1Q2F * (1 / don + 1 / dch - 1 / doh - 1 / dcn)
+            hb[i, j] = e < emax
+    return hb
+
+
+@jit
+def _assign(hb, chain):
+    """reduced ss codes: 0 loop, 1 helix (H, G or I), 2 strand (E or B)"""
+    nres = len(hb)
+    helix4 = np.zeros(nres, dtype=np.bool_)
+    helix35 = np.zeros(nres, dtype=np.bool_)
+    for nturn in (4, 3, 5):
+        turn = np.zeros(nres, dtype=np.bool_)
+        for i in range(nres - nturn):
+            turn[i] = hb[i, i + nturn] and chain[i] == chain[i + nturn]
+        for i in range(1, nres - nturn):
+            if turn[i - 1] and turn[i]:
+                for k in range(i, i + nturn):
+                    if nturn == 4: helix4[k] = True
+                    else: helix35[k] = True
+
+    # bridges, code 1 parallel, 2 antiparallel
+    nbr = 0
+    bri = np.zeros(4 * nres + 4, dtype=np.int64)
+    brj = np.zeros(4 * nres + 4, dtype=np.int64)
+    brt = np.zeros(4 * nres + 4, dtype=np.int64)
+    for i in range(1, nres - 1):
+        if chain[i - 1] != chain[i] or chain[i + 1] != chain[i]:
+            continue
+        for j in range(i + 1, nres - 1):
+            if chain[j - 1] != chain[j] or chain[j + 1] != chain[j]:
+                continue
+            if chain[i] == chain[j] and abs(i - j) < 3:
+                continue
+            t = 0
+            if ((hb[i - 1, j] and hb[j, i + 1])
+                    or (hb[j - 1, i] and hb[i, j + 1])):
+                t = 1
+            elif ((hb[i, j] and hb[j, i])
+                  or (hb[i - 1, j + 1] and hb[j - 1, i + 1])):
+                t = 2
+            if t:
+                if nbr == len(bri):
+                    bri = np.concatenate((bri, bri))
+                    brj = np.concatenate((brj, brj))
+                    brt = np.concatenate((brt, brt))
+                bri[nbr], brj[nbr], brt[nbr] = i, j, t
+                nbr += 1
+    strand = np.zeros(nres, dtype=np.bool_)
+    for b in range(nbr):
+        strand[bri[b]] = True
+        strand[brj[b]] = True
+    # bridges of the same type close in sequence on both strands form a
+    # ladder, possibly with a bulge, the gap residues are strand too
+    for b1 in range(nbr):
+        for b2 in range(nbr):
+            if b1 == b2 or brt[b1] != brt[b2]: continue
+            i1, j1, i2, j2 = bri[b1], brj[b1], bri[b2], brj[b2]
+            if i2 <= i1 or chain[i1] != chain[i2] or chain[j1] != chain[j2]:
+                continue
+            di = i2 - i1
+            dj = j2 - j1 if brt[b1] == 1 else j1 - j2
+            if dj <= 0: continue
+            if (di < 6 and dj < 3) or (di < 3 and dj < 6):
+                for k in range(i1, i2 + 1):
+                    strand[k] = True
+                for k in range(min(j1, j2), max(j1, j2) + 1):
+                    strand[k] = True
+
+    ss = np.zeros(nres, dtype=np.int8)
+    for i in range(nres):
+        if helix4[i]: ss[i] = 1
+        elif strand[i]: ss[i] = 2
+        elif helix35[i]: ss[i] = 1
+    return ss
+
+
+def dssp(ncac, chains=None):
+    """reduced dssp secondary structure from backbone coordinates
+
+    Args:
+        ncac (np.ndarray): (nres, 3, 3+) N, CA, C coordinates
+        chains (list, optional): [(begin, end), ...] residue bounds of
+            chains, one chain if None
+
+    Returns:
+        str: one of 'H', 'E', 'L' per residue, like
+        Dssp(pose).get_dssp_secstruct()
+    """
+    nres = len(ncac)
+    if nres == 0: return ''
+    if chains is None: chains = [(0, nres)]
+    chain = np.zeros(nres, dtype='i4')
+    for ichain, (beg, end) in enumerate(chains):
+        chain[beg:end] = ichain
+    o, h, has_h = backbone_o_h(ncac, chains)
+    n, ca, c = (np.ascontiguousarray(ncac[:, k, :3], 'f8') for k in range(3))
+    hb = _hbond_matrix(n, ca, c, o, h, has_h, _CA_CUTOFF, HBOND_MAX_ENERGY)
+    codes = _assign(hb, chain)
+    return ''.join(np.array(['L', 'H', 'E'])[codes])
+
+
+def ss_agreement(ss1, ss2):
+    """fraction of residues with the same secondary structure"""
+    assert len(ss1) == len(ss2)
+    if not len(ss1): return 1.0
+    return np.mean(np.array(list(ss1)) == np.array(list(ss2)))
+
+
+def rosetta_agreement(pdbfiles):
+    """compare dssp on backbones from worms.pdbio to rosetta's Dssp
+
+    Args:
+        pdbfiles (list): structure files
+
+    Returns:
+        dict: pdbfile -> (agreement, ss, rosetta ss)
+    """
+    from worms import pdbio
+    result = dict()
+    for pdbfile in pdbfiles:
+        ncac, chains = pdbio.read_backbone(pdbfile)
+        ss = dssp(ncac, chains)
+        ref = Dssp(pose_from_file(pdbfile)).get_dssp_secstruct()
+        result[pdbfile] = ss_agreement(ss, ref), ss, ref
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import pyrosetta
+    pyrosetta.init('-mute all -ignore_unrecognized_res')
+    agree = rosetta_agreement(sys.argv[1:])
+    for pdbfile, (frac, ss, ref) in agree.items():
+        print('%6.3f %s' % (frac, pdbfile))
+        if frac < 1:
+            print('   ', ss)
+            print('   ', ref)
+    print('mean agreement %6.3f' % np.mean([a[0] for a in agree.values()]))
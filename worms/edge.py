@@ -1,9 +1,18 @@
+import hashlib
+import io
+import json
+import os
+import uuid
+from logging import info
 import numpy as np
 import numba as nb
 import numba.types as nt
-from collections import defaultdict, namedtuple
-from worms.util import contig_idx_breaks, jit, InProcessExecutor
-import concurrent.futures as cf
+from collections import Counter, defaultdict, namedtuple
+from scipy.spatial import cKDTree
+from worms.util import contig_idx_breaks, jit, atomic_write, FileLock
+from worms.util import LRUCache
+from worms.bblock_store import BBlockSet, _OFST_RES, _OFST_CHAIN
+from worms.vertex import _vertex_tail, _pjit
 from tqdm import tqdm
 
 try:
@@ -16,6 +25,19 @@ except ImportError:
 
 _SCM_Scores = namedtuple('_SCM_Scores', 'nclash ncontact rms'.split())
 
+# bump when _jit_splice_metrics changes, invalidates cached splice metrics
+_SPLICE_METRICS_CACHE_VERSION = 4
+# segments a splice metrics shard may have before they are merged
+_SPLICE_METRICS_MAX_SEGMENTS = 16
+# smallest cell of the clash and contact cell lists, angstroms
+_MIN_GRID_CELL = 2.0
+# splice_metrics cache 'hit' and 'miss' counts, one per block pair
+splice_metrics_cache_stats = Counter()
+# SpliceWindowIndex of recently used libraries, see splice_window_index
+_splice_window_indices = LRUCache(
+    2**30, lambda found: found[0].nbytes if found[0] else 0
+)
+
 
 def scm_concat(lst, axis=0):
     result = list()
@@ -36,6 +58,115 @@ def _chainbounds_of_ires(chains, ires):
     return (-1, -1)
 
 
+@jit
+def _atom_grid(xyz, first, stride, cellsize):
+    """cell lists over atoms first, first + stride, ... of xyz
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, np.ndarray): lower corner,
+        number of cells along each axis, start of each cell in atoms and
+        atom indices sorted by cell, ascending within each cell
+    """
+    n = (len(xyz) - first + stride - 1) // stride
+    lb = np.empty(3)
+    ncell = np.ones(3, dtype=np.int64)
+    for k in range(3):
+        lb[k] = np.min(xyz[first::stride, k]) if n else 0.0
+        if n:
+            ncell[k] = int((np.max(xyz[first::stride, k]) - lb[k]) /
+                           cellsize) + 1
+    cell = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        c = 0
+        for k in range(3):
+            x = xyz[first + i * stride, k]
+            c = c * ncell[k] + int((x - lb[k]) / cellsize)
+        cell[i] = c
+    cellstart = np.zeros(ncell[0] * ncell[1] * ncell[2] + 1, dtype=np.int64)
+    for i in range(n):
+        cellstart[cell[i] + 1] += 1
+    cellstart = np.cumsum(cellstart)
+    fill = cellstart[:-1].copy()
+    atoms = np.empty(n, dtype=np.int64)
+    for i in range(n):  # counting sort keeps atoms ascending in each cell
+        atoms[fill[cell[i]]] = first + i * stride
+        fill[cell[i]] += 1
+    return lb, ncell, cellstart, atoms
+
+
+@jit
+def _grid_count(xyz, grid, cellsize, b, lo, hi, mind2, maxd2):
+    """number of grid atoms in [lo, hi) with mind2 <= dist**2 to b < maxd2
+
+    maxd2 must not exceed cellsize**2, only adjacent cells are searched
+    """
+    lb, ncell, cellstart, atoms = grid
+    c = np.empty(3, dtype=np.int64)
+    for k in range(3):
+        c[k] = int(np.floor((b[k] - lb[k]) / cellsize))
+        if c[k] < -1 or c[k] > ncell[k]: return 0
+    count = 0
+    for i0 in range(max(0, c[0] - 1), min(ncell[0], c[0] + 2)):
+        for i1 in range(max(0, c[1] - 1), min(ncell[1], c[1] + 2)):
+            for i2 in range(max(0, c[2] - 1), min(ncell[2], c[2] + 2)):
+                icell = (i0 * ncell[1] + i1) * ncell[2] + i2
+                beg, end = cellstart[icell], cellstart[icell + 1]
+                beg += np.searchsorted(atoms[beg:end], lo)
+                for ia in range(beg, end):
+                    a = atoms[ia]
+                    if a >= hi: break
+                    d2 = 0.0
+                    for k in range(3):
+                        d2 += (xyz[a, k] - b[k])**2
+                    if mind2 <= d2 < maxd2:
+                        count += 1
+    return count
+
+
+@jit
+def _grid_cells(clashd2, contactd2):
+    """cell sizes of the clash and contact cell lists"""
+    # tiny cells would make huge grids, and 0 would divide by zero
+    clashcell = max(np.sqrt(clashd2), _MIN_GRID_CELL)
+    return clashcell, max(np.sqrt(contactd2), clashcell)
+
+
+def _block_grids(offsets, ncac, build, first, stride, cellsize):
+    """_atom_grid of each block of a bblock set, as offset-indexed columns
+
+    grids of blocks with build False are empty. see _block_grid
+
+    Returns:
+        tuple: (nblk, 3) lower corners, (nblk, 3) numbers of cells,
+        cellstarts and atoms of all blocks concatenated, and (nblk + 1, 2)
+        offsets of each block into cellstarts and atoms
+    """
+    nblk = len(offsets) - 1
+    lb = np.zeros((nblk, 3))
+    ncell = np.ones((nblk, 3), dtype=np.int64)
+    cellstart, atoms = list(), list()
+    gridofst = np.zeros((nblk + 1, 2), dtype=np.int64)
+    for iblk in range(nblk):
+        r0, r1 = offsets[iblk, _OFST_RES], offsets[iblk + 1, _OFST_RES]
+        xyz = ncac[r0:r1 if build[iblk] else r0].reshape(-1, 4)
+        grid = _atom_grid(xyz, first, stride, cellsize)
+        lb[iblk], ncell[iblk] = grid[0], grid[1]
+        cellstart.append(grid[2])
+        atoms.append(grid[3])
+        gridofst[iblk + 1] = gridofst[iblk] + [len(grid[2]), len(grid[3])]
+    return (lb, ncell, np.concatenate(cellstart), np.concatenate(atoms),
+            gridofst)
+
+
+@jit
+def _block_grid(grids, iblk):
+    """the _atom_grid of block iblk from _block_grids columns"""
+    lb, ncell, cellstart, atoms, gridofst = grids
+    return (lb[iblk], ncell[iblk],
+            cellstart[gridofst[iblk, 0]:gridofst[iblk + 1, 0]],
+            atoms[gridofst[iblk, 1]:gridofst[iblk + 1, 1]])
+
+
 @jit
 def _jit_splice_metrics(chains0, chains1,
                         ncac0_3d, ncac1_3d,
@@ -47,14 +178,48 @@ def _jit_splice_metrics(chains0, chains1,
                         clash_contact_range=9,
                         rms_cut=1.1,
                         skip_on_fail=True):  # yapf: disable
+    out_rms = np.empty((len(aln0s), len(aln1s)), dtype=np.float32)
+    out_nclash = np.empty((len(aln0s), len(aln1s)), dtype=np.float32)
+    out_ncontact = np.empty((len(aln0s), len(aln1s)), dtype=np.float32)
+    ncac0 = ncac0_3d.reshape(-1, 4)
+    clashcell, contactcell = _grid_cells(clashd2, contactd2)
+    clashgrid = _atom_grid(ncac0, 0, 1, clashcell)
+    contactgrid = _atom_grid(ncac0, 1, 3, contactcell)
+    _fill_splice_metrics(chains0, chains1, ncac0_3d, ncac1_3d, stubs0,
+                         stubs1, aln0s, aln1s, np.empty((0, 0)),
+                         clashgrid, contactgrid,
+                         out_rms, out_nclash, out_ncontact, clashd2,
+                         contactd2, rms_range, clash_contact_range, rms_cut,
+                         skip_on_fail)
+    return out_rms, out_nclash, out_ncontact
+
 
-    out_rms = np.zeros((len(aln0s), len(aln1s)), dtype=np.float32)
-    out_nclash = -np.ones((len(aln0s), len(aln1s)), dtype=np.float32)
-    out_ncontact = -np.ones((len(aln0s), len(aln1s)), dtype=np.float32)
+@jit
+def _fill_splice_metrics(chains0, chains1,
+                         ncac0_3d, ncac1_3d,
+                         stubs0, stubs1,
+                         aln0s, aln1s, rms_in,
+                         clashgrid, contactgrid,
+                         out_rms, out_nclash, out_ncontact,
+                         clashd2, contactd2,
+                         rms_range, clash_contact_range,
+                         rms_cut, skip_on_fail):  # yapf: disable
+    """_jit_splice_metrics writing to (len(aln0s), len(aln1s)) outputs
+
+    rms is taken from rms_in unless it is empty, see _splice_rms.
+    clashgrid and contactgrid are the _atom_grid of blk0 over all atoms
+    and over CA, with cells from _grid_cells. they may be empty if no
+    splice passes rms_cut
+    """
+    out_rms[:] = 0
+    out_nclash[:] = -1
+    out_ncontact[:] = -1
 
     ncac0 = ncac0_3d.reshape(-1, 4)
     ncac1 = ncac1_3d.reshape(-1, 4)
 
+    clashcell, contactcell = _grid_cells(clashd2, contactd2)
+
     b = np.empty((4, ), dtype=np.float64)
 
     for ialn1, aln1 in enumerate(aln1s):
@@ -67,36 +232,571 @@ def _jit_splice_metrics(chains0, chains1,
             chainb00, chainb01 = _chainbounds_of_ires(chains0, aln0)
             if np.abs(chainb00 - aln0) < rms_range: continue
             if np.abs(chainb01 - aln0) <= rms_range: continue
-            xaln = stubs0[aln0] @ stub1_inv
-
-            sum_d2, n1b = 0.0, 0
-            for i in range(-3 * rms_range, 3 * rms_range + 3):
-                a = ncac0[3 * aln0 + i]
-                b[:] = xaln @ ncac1[3 * aln1 + i]
-                sum_d2 += np.sum((a - b)**2)
-            rms = np.sqrt(sum_d2 / (rms_range * 6 + 3))
-            assert 0 <= rms < 9e9
+            if len(rms_in):
+                rms = rms_in[ialn0, ialn1]
+            else:
+                xaln = stubs0[aln0] @ stub1_inv
+                sum_d2 = 0.0
+                for i in range(-3 * rms_range, 3 * rms_range + 3):
+                    a = ncac0[3 * aln0 + i]
+                    b[:] = xaln @ ncac1[3 * aln1 + i]
+                    sum_d2 += np.sum((a - b)**2)
+                rms = np.sqrt(sum_d2 / (rms_range * 6 + 3))
+                assert 0 <= rms < 9e9
             out_rms[ialn0, ialn1] = rms
 
             if skip_on_fail and rms > rms_cut:
                 continue
-
-            nclash, ncontact = 0, 0
-            for j in range(3, 3 * clash_contact_range + 3):
-                b[:] = xaln @ ncac1[3 * aln1 + j]
-                for i in range(-1, -3 * clash_contact_range - 1, -1):
-                    a = ncac0[3 * aln0 + i]
-                    d2 = np.sum((a - b)**2)
-                    if d2 < clashd2:
-                        nclash += 1
-                    elif i % 3 == 1 and j % 3 == 1 and d2 < contactd2:
-                        ncontact += 1
-            assert 0 <= np.isnan(nclash) < 99999
-            assert 0 <= np.isnan(ncontact) < 99999
+            xaln = stubs0[aln0] @ stub1_inv
+            nclash, ncontact = _splice_counts(
+                ncac0, ncac1, xaln, aln0, aln1, clashgrid, contactgrid,
+                clashcell, contactcell, clashd2, contactd2,
+                clash_contact_range
+            )
             out_nclash[ialn0, ialn1] = nclash
             out_ncontact[ialn0, ialn1] = ncontact
 
-    return out_rms, out_nclash, out_ncontact
+
+@jit
+def _splice_counts(ncac0, ncac1, xaln, aln0, aln1, clashgrid, contactgrid,
+                   clashcell, contactcell, clashd2, contactd2,
+                   clash_contact_range):
+    """clashes and contacts of the splice of residue aln0 of blk0 to aln1
+    of blk1, placed by xaln, ncac flattened to (natom, 4)"""
+    b = np.empty((4, ), dtype=np.float64)
+    # blk0 atoms before aln0 against blk1 atoms after aln1
+    lo0 = max(0, 3 * aln0 - 3 * clash_contact_range)
+    jend = min(3 * clash_contact_range + 3, len(ncac1) - 3 * aln1)
+    nclash, ncontact = 0, 0
+    for j in range(3, jend):
+        b[:] = xaln @ ncac1[3 * aln1 + j]
+        nclash += _grid_count(
+            ncac0, clashgrid, clashcell, b, lo0, 3 * aln0, 0.0, clashd2
+        )
+        if j % 3 == 1:  # CA
+            ncontact += _grid_count(
+                ncac0, contactgrid, contactcell, b, lo0, 3 * aln0, clashd2,
+                contactd2
+            )
+    assert 0 <= np.isnan(nclash) < 99999
+    assert 0 <= np.isnan(ncontact) < 99999
+    return nclash, ncontact
+
+
+def _splice_metrics_kernel(offsets0, ncac0, stubs0, chains0,
+                           offsets1, ncac1, stubs1, chains1,
+                           tasks, aln0s, aln1s, rms_in,
+                           clashgrids, contactgrids,
+                           rms, nclash, ncontact,
+                           clashd2, contactd2, rms_range, clash_contact_range,
+                           rms_cut, skip_on_fail):  # yapf: disable
+    """splice metrics of many block pairs of two bblock sets in one call
+
+    task row (iblk0, iblk1, beg0, end0, beg1, end1) computes aln0s[beg0:end0]
+    of block iblk0 of set 0 against aln1s[beg1:end1] of block iblk1 of set
+    1 into rows beg0:end0, columns beg1:end1 of rms, nclash and ncontact.
+    rms_in is empty or holds the rms of all rows and columns. clashgrids
+    and contactgrids are _block_grids of set 0, built once per block
+    """
+    for itask in nb.prange(len(tasks)):
+        iblk0, iblk1, beg0, end0, beg1, end1 = tasks[itask]
+        r0, r0end = offsets0[iblk0, _OFST_RES], offsets0[iblk0 + 1, _OFST_RES]
+        r1, r1end = offsets1[iblk1, _OFST_RES], offsets1[iblk1 + 1, _OFST_RES]
+        c0 = chains0[offsets0[iblk0, _OFST_CHAIN]:
+                     offsets0[iblk0 + 1, _OFST_CHAIN]]
+        c1 = chains1[offsets1[iblk1, _OFST_CHAIN]:
+                     offsets1[iblk1 + 1, _OFST_CHAIN]]
+        _fill_splice_metrics(
+            c0, c1, ncac0[r0:r0end], ncac1[r1:r1end], stubs0[r0:r0end],
+            stubs1[r1:r1end], aln0s[beg0:end0], aln1s[beg1:end1],
+            rms_in[beg0:end0, beg1:end1], _block_grid(clashgrids, iblk0),
+            _block_grid(contactgrids, iblk0), rms[beg0:end0, beg1:end1],
+            nclash[beg0:end0, beg1:end1], ncontact[beg0:end0, beg1:end1],
+            clashd2, contactd2, rms_range, clash_contact_range, rms_cut,
+            skip_on_fail
+        )
+
+
+_splice_metrics_serial = jit(_splice_metrics_kernel)
+_splice_metrics_parallel = _pjit(_splice_metrics_kernel)
+
+
+def _splice_pairs_kernel(offsets0, ncac0, stubs0, offsets1, ncac1, stubs1,
+                         iblk0s, aln0s, iblk1s, aln1s, rows, cols,
+                         clashgrids, contactgrids, nclash, ncontact,
+                         clashd2, contactd2,
+                         clash_contact_range):  # yapf: disable
+    """clashes and contacts of only the splices (rows[k], cols[k])
+
+    row i is residue aln0s[i] of block iblk0s[i] of set 0, columns likewise
+    for set 1. clashgrids and contactgrids are _block_grids of set 0
+    """
+    clashcell, contactcell = _grid_cells(clashd2, contactd2)
+    for k in nb.prange(len(rows)):
+        row, col = rows[k], cols[k]
+        iblk0, iblk1 = iblk0s[row], iblk1s[col]
+        r0, r0end = offsets0[iblk0, _OFST_RES], offsets0[iblk0 + 1, _OFST_RES]
+        r1, r1end = offsets1[iblk1, _OFST_RES], offsets1[iblk1 + 1, _OFST_RES]
+        aln0, aln1 = aln0s[row], aln1s[col]
+        xaln = stubs0[r0 + aln0] @ np.linalg.inv(stubs1[r1 + aln1])
+        nc, nct = _splice_counts(
+            ncac0[r0:r0end].reshape(-1, 4), ncac1[r1:r1end].reshape(-1, 4),
+            xaln, aln0, aln1, _block_grid(clashgrids, iblk0),
+            _block_grid(contactgrids, iblk0), clashcell, contactcell,
+            clashd2, contactd2, clash_contact_range
+        )
+        nclash[row, col] = nc
+        ncontact[row, col] = nct
+
+
+_splice_pairs_serial = jit(_splice_pairs_kernel)
+_splice_pairs_parallel = _pjit(_splice_pairs_kernel)
+
+
+@jit
+def _splice_windows(offsets, ncac, stubs, chains, iblks, alns, rms_range):
+    """rms window of each splice residue in the frame of its stub
+
+    row k is for residue alns[k] of block iblks[k], N, CA and C of residues
+    alns[k] - rms_range to alns[k] + rms_range, flattened. ok[k] is False if
+    the window doesn't fit in the chain, as in _fill_splice_metrics
+    """
+    natom = 6 * rms_range + 3
+    win = np.zeros((len(alns), 3 * natom))
+    ok = np.zeros(len(alns), dtype=np.bool_)
+    for k in range(len(alns)):
+        iblk, aln = iblks[k], alns[k]
+        chains_k = chains[offsets[iblk, _OFST_CHAIN]:
+                          offsets[iblk + 1, _OFST_CHAIN]]
+        chainb0, chainb1 = _chainbounds_of_ires(chains_k, aln)
+        if np.abs(chainb0 - aln) < rms_range: continue
+        if np.abs(chainb1 - aln) <= rms_range: continue
+        ok[k] = True
+        r0 = offsets[iblk, _OFST_RES]
+        stub = stubs[r0 + aln]
+        for i in range(natom):
+            atom = 3 * (r0 + aln - rms_range) + i
+            x = ncac[atom // 3, atom % 3]
+            # stubs are rigid, inverse is rotation transposed
+            for a in range(3):
+                v = 0.0
+                for b in range(3):
+                    v += stub[b, a] * (x[b] - stub[b, 3])
+                win[k, 3 * i + a] = v
+    return win, ok
+
+
+def _splice_rms(cols0, iblk0s, aln0s, cols1, iblk1s, aln1s, rms_range):
+    """rms of all splices of aln0s against aln1s by matrix multiplication
+
+    rigid motions keep distances, so the rms of a splice is that between
+    the windows of its two residues, each in its own stub frame. sums of
+    squares of the flattened windows plus the cross term w0 @ w1.T give all
+    squared distances with one gemm
+
+    Args:
+        cols0 (tuple): offsets, ncac, stubs, chains of bblock set 0
+        iblk0s (np.ndarray): block in set 0 of each of aln0s
+        aln0s (np.ndarray): splice residues, rows
+        cols1 (tuple): as cols0 for set 1
+        iblk1s (np.ndarray): block in set 1 of each of aln1s
+        aln1s (np.ndarray): splice residues, columns
+        rms_range (int): residues each side of the splice aligned
+
+    Returns:
+        np.ndarray: (len(aln0s), len(aln1s)) rms, inf where a window
+        doesn't fit in its chain
+    """
+    w0, ok0 = _splice_windows(*cols0, iblk0s, aln0s, rms_range)
+    w1, ok1 = _splice_windows(*cols1, iblk1s, aln1s, rms_range)
+    d2 = w0 @ w1.T
+    d2 *= -2
+    d2 += np.sum(w0**2, axis=1)[:, None]
+    d2 += np.sum(w1**2, axis=1)[None]
+    rms = np.sqrt(np.maximum(d2, 0) / (6 * rms_range + 3))
+    rms[~ok0] = np.inf
+    rms[:, ~ok1] = np.inf
+    return rms
+
+
+@jit
+def _pair_rms(w0, w1, i0, i1):
+    rms = np.empty(len(i0))
+    for k in range(len(i0)):
+        d2 = 0.0
+        for m in range(w0.shape[1]):
+            d2 += (w0[i0[k], m] - w1[i1[k], m])**2
+        rms[k] = np.sqrt(d2 / (w0.shape[1] // 3))
+    return rms
+
+
+class SpliceWindowIndex:
+    """k-d tree over splice residue rms windows, see _splice_windows
+
+    windows are projected on their first ndim principal axes. projection
+    can only shrink distances, so every window within some distance of a
+    query is among those the tree finds within that distance of the
+    projected query. those candidates are then checked exactly
+
+    Attributes:
+        windows (np.ndarray): (n, 3 * natom) indexed windows
+        mean (np.ndarray): mean of windows
+        axes (np.ndarray): (ndim, 3 * natom) principal axes
+        tree (cKDTree): tree over projected windows
+    """
+
+    @property
+    def nbytes(self):
+        return (self.windows.nbytes + self.tree.data.nbytes +
+                self.tree.indices.nbytes)
+
+    def __init__(self, windows, ndim=8):
+        self.windows = np.ascontiguousarray(windows, dtype='f8')
+        self.mean = np.mean(self.windows, axis=0)
+        centered = self.windows - self.mean
+        _, evecs = np.linalg.eigh(centered.T @ centered)
+        self.axes = np.ascontiguousarray(evecs[:, ::-1][:, :ndim].T)
+        self.tree = cKDTree(centered @ self.axes.T)
+
+    def query(self, windows, rms_cut):
+        """all pairs of windows and indexed windows with rms <= rms_cut
+
+        Args:
+            windows (np.ndarray): (m, 3 * natom) query windows
+            rms_cut (float): max rms
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray): index into windows, index
+            into the indexed windows and rms of each pair
+        """
+        windows = np.ascontiguousarray(windows, dtype='f8')
+        radius = rms_cut * np.sqrt(windows.shape[1] // 3)
+        query = cKDTree((windows - self.mean) @ self.axes.T)
+        # a little slack so rounding in the projection loses no pairs
+        pairs = query.sparse_distance_matrix(
+            self.tree, radius * (1 + 1e-6) + 1e-6, output_type='ndarray'
+        )
+        i0 = pairs['i'].astype('i8')
+        i1 = pairs['j'].astype('i8')
+        rms = _pair_rms(windows, self.windows, i0, i1)
+        ok = rms <= rms_cut
+        return i0[ok], i1[ok], rms[ok]
+
+
+def splice_window_index(blks, res, rms_range):
+    """SpliceWindowIndex over the windows of residues res[i] of blks[i]
+
+    indices are cached by content, the block digests and residues as in
+    splice_metrics_cache_key, so every edge into the same library reuses one
+
+    Args:
+        blks (list): bblocks
+        res (list(np.ndarray)): splice residues of each of blks
+        rms_range (int): residues each side of the splice aligned
+
+    Returns:
+        (SpliceWindowIndex, np.ndarray): index over the windows that fit in
+        their chain, None if there are none, and the position in
+        np.concatenate(res) of each indexed window
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps([int(rms_range)] +
+                          [_bblock_digest(b) for b in blks]).encode())
+    for ires in res:
+        ires = np.ascontiguousarray(ires, dtype='i4')
+        sha.update(str(len(ires)).encode())
+        sha.update(ires.data)
+    key = sha.hexdigest()
+    found = _splice_window_indices.get(key)
+    if found is None:
+        offsets, ncac, stubs, _, chains, _, _ = BBlockSet(blks)._state
+        iblks = np.repeat(np.arange(len(blks)), [len(r) for r in res])
+        windows, ok = _splice_windows(offsets, ncac, stubs, chains, iblks,
+                                      np.concatenate(res), rms_range)
+        where = np.flatnonzero(ok)
+        index = SpliceWindowIndex(windows[where]) if len(where) else None
+        found = index, where
+        _splice_window_indices[key] = found
+    return found
+
+
+def _bblock_digest(blk):
+    """sha1 of the bblock arrays splice metrics are computed from"""
+    sha = hashlib.sha1()
+    for ary in (blk.chains, blk.ncac, blk.stubs):
+        ary = np.ascontiguousarray(ary)
+        sha.update(str((ary.dtype.str, ary.shape)).encode())
+        sha.update(ary.data)
+    return sha.hexdigest()
+
+
+def splice_metrics_cache_key(digest0, digest1, ires0, ires1, *args):
+    """content hash of the metrics of all splices of one pair of blocks
+
+    Args:
+        digest0 (str): _bblock_digest of blk0
+        digest1 (str): _bblock_digest of blk1
+        ires0 (np.ndarray): aln0s, splice residues of blk0
+        ires1 (np.ndarray): aln1s, splice residues of blk1
+        *args: clashd2, contactd2, rms_range, clash_contact_range, rms_cut,
+            skip_on_fail, rms_gemm, rms_index
+
+    Returns:
+        str: sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    params = [float(a) for a in args]
+    sha.update(
+        json.dumps([_SPLICE_METRICS_CACHE_VERSION, digest0, digest1] +
+                   params).encode()
+    )
+    for ires in (ires0, ires1):
+        ires = np.ascontiguousarray(ires, dtype='i4')
+        sha.update(str(len(ires)).encode())
+        sha.update(ires.data)
+    return sha.hexdigest()
+
+
+def _splice_metrics_shard(cachedir, key):
+    """directory holding the cached metrics of key, one per first two
+    digits of key, so at most 256"""
+    return os.path.join(cachedir, 'splice_metrics', key[:2])
+
+
+def _shard_segments(shard):
+    """segment files of shard, temp files of atomic_write start with ."""
+    try:
+        names = os.listdir(shard)
+    except FileNotFoundError:
+        return []
+    return [
+        os.path.join(shard, n) for n in sorted(names)
+        if n.endswith('.npz') and not n.startswith('.')
+    ]
+
+
+def _load_splice_metrics(cachedir, keys):
+    """cached (rms, nclash, ncontact) of those of keys that are cached
+
+    Returns:
+        dict: key -> (rms, nclash, ncontact)
+    """
+    byshard = defaultdict(set)
+    for key in keys:
+        byshard[_splice_metrics_shard(cachedir, key)].add(key)
+    found = dict()
+    for shard, shard_keys in byshard.items():
+        for path in _shard_segments(shard):
+            if not shard_keys: break
+            try:
+                npz = np.load(path)
+            except FileNotFoundError:
+                continue  # merged away meanwhile, entries recomputed
+            with npz:
+                names = set(npz.files)
+                for key in list(shard_keys):
+                    if key + '_rms' not in names: continue
+                    found[key] = tuple(
+                        npz[key + '_' + n]
+                        for n in ('rms', 'nclash', 'ncontact')
+                    )
+                    shard_keys.discard(key)
+    return found
+
+
+def _save_splice_metrics(cachedir, entries):
+    """add entries, key -> (rms, nclash, ncontact), to their shards
+
+    shards are append only, each call writes a new segment per shard with
+    just its entries, so writes cost what was computed and concurrent
+    writers never drop each other's entries. a shard with more than
+    _SPLICE_METRICS_MAX_SEGMENTS segments is merged, see
+    _merge_splice_metrics_shard
+    """
+    byshard = defaultdict(dict)
+    for key, result in entries.items():
+        byshard[_splice_metrics_shard(cachedir, key)][key] = result
+    for shard, shard_entries in byshard.items():
+        arrays = dict()
+        for key, result in shard_entries.items():
+            for n, ary in zip(('rms', 'nclash', 'ncontact'), result):
+                arrays[key + '_' + n] = ary
+        os.makedirs(shard, exist_ok=True)
+        _write_segment(shard, arrays)
+        if len(_shard_segments(shard)) > _SPLICE_METRICS_MAX_SEGMENTS:
+            _merge_splice_metrics_shard(shard)
+
+
+def _write_segment(shard, arrays):
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    atomic_write(os.path.join(shard, uuid.uuid4().hex + '.npz'),
+                 buf.getvalue())
+
+
+def _merge_splice_metrics_shard(shard):
+    """replace the segments of shard by one holding all their entries
+
+    the lock keeps two writers from merging the same segments. the merged
+    segment is written before the old ones are removed, so a reader sees
+    every entry at least once, or misses a removed segment and recomputes
+    """
+    with FileLock(shard):
+        segments = _shard_segments(shard)
+        if len(segments) <= _SPLICE_METRICS_MAX_SEGMENTS: return
+        arrays = dict()
+        for path in segments:
+            with np.load(path) as npz:
+                arrays.update((n, npz[n]) for n in npz.files)
+        _write_segment(shard, arrays)
+        for path in segments:
+            os.remove(path)
+
+
+def _unset_metrics(nrow, ncol):
+    return _SCM_Scores(
+        nclash=np.zeros((nrow, ncol), dtype=np.int32) - 1,
+        ncontact=np.zeros((nrow, ncol), dtype=np.int32) - 1,
+        rms=np.zeros((nrow, ncol), dtype=np.float32) - 1
+    )
+
+
+def _block_pair_metrics(
+        blks0, res0, blks1, res1, pairs, args, rms_gemm, rms_index,
+        parallel, progressbar
+):
+    """splice metrics of pairs (i0, i1) of blks0 and blks1
+
+    rows of the outputs are res0, the splice residues of each of blks0, in
+    order, columns res1 likewise. so each block pair is a rectangle, those
+    not in pairs are left -1
+
+    Returns:
+        _SCM_Scores: nclash, ncontact and rms
+    """
+    if rms_index:
+        return _block_pair_metrics_indexed(blks0, res0, blks1, res1, pairs,
+                                           args, parallel, progressbar)
+    start0 = np.cumsum([0] + [len(r) for r in res0])
+    start1 = np.cumsum([0] + [len(r) for r in res1])
+    metrics = _unset_metrics(start0[-1], start1[-1])
+    tasks = np.array([(
+        i0, i1, start0[i0], start0[i0 + 1], start1[i1], start1[i1 + 1]
+    ) for i0, i1 in pairs], dtype='i8').reshape(-1, 6)
+    offsets0, ncac0, stubs0, _, chains0, _, _ = BBlockSet(blks0)._state
+    offsets1, ncac1, stubs1, _, chains1, _, _ = BBlockSet(blks1)._state
+    aln0s, aln1s = np.concatenate(res0), np.concatenate(res1)
+    _, _, rms_range, _, rms_cut, _ = args
+    rms_in = np.empty((0, 0))
+    rms_args = (
+        (offsets0, ncac0, stubs0, chains0),
+        np.repeat(np.arange(len(blks0)), np.diff(start0)), aln0s,
+        (offsets1, ncac1, stubs1, chains1),
+        np.repeat(np.arange(len(blks1)), np.diff(start1)), aln1s, rms_range
+    )
+    if rms_gemm:
+        rms_in = _splice_rms(*rms_args)
+    # cell lists over each blk0, all atoms for clashes and CA only for
+    # contacts, built once per block for all its pairs. empty if rms_in
+    # says no splice of the block will be checked
+    clashd2, contactd2, _, _, _, skip_on_fail = args
+    build = np.ones(len(blks0), dtype='?')
+    if len(rms_in) and skip_on_fail:
+        for i0 in range(len(blks0)):
+            rows = rms_in[start0[i0]:start0[i0 + 1]]
+            build[i0] = rows.size > 0 and np.min(rows) <= rms_cut
+    clashcell, contactcell = _grid_cells(clashd2, contactd2)
+    clashgrids = _block_grids(offsets0, ncac0, build, 0, 1, clashcell)
+    contactgrids = _block_grids(offsets0, ncac0, build, 1, 3, contactcell)
+    kernel = _splice_metrics_serial
+    if parallel: kernel = _splice_metrics_parallel
+    # one call releases the gil for all block pairs, with a progress bar
+    # tasks are split into chunks
+    chunks = [tasks]
+    if progressbar:
+        chunks = tqdm(np.array_split(tasks, min(len(tasks), 100)))
+    for chunk in chunks:
+        kernel(
+            offsets0, ncac0, stubs0, chains0, offsets1, ncac1, stubs1,
+            chains1, chunk, aln0s, aln1s, rms_in, clashgrids, contactgrids,
+            metrics.rms, metrics.nclash, metrics.ncontact, *args
+        )
+    return metrics
+
+
+def _block_pair_metrics_indexed(
+        blks0, res0, blks1, res1, pairs, args, parallel, progressbar
+):
+    """_block_pair_metrics with rms_index
+
+    candidate splices come from the splice_window_index of blks1, only
+    those are visited. other splices get rms inf, or 0 if a window doesn't
+    fit in its chain, and nclash and ncontact -1, as from
+    _fill_splice_metrics with skip_on_fail
+
+    Returns:
+        _SCM_Scores: nclash, ncontact and rms
+    """
+    clashd2, contactd2, rms_range, clash_contact_range, rms_cut, _ = args
+    start0 = np.cumsum([0] + [len(r) for r in res0])
+    start1 = np.cumsum([0] + [len(r) for r in res1])
+    metrics = _unset_metrics(start0[-1], start1[-1])
+    if not len(pairs): return metrics
+    offsets0, ncac0, stubs0, _, chains0, _, _ = BBlockSet(blks0)._state
+    offsets1, ncac1, stubs1, _, _, _, _ = BBlockSet(blks1)._state
+    aln0s, aln1s = np.concatenate(res0), np.concatenate(res1)
+    iblk0s = np.repeat(np.arange(len(blks0)), np.diff(start0))
+    iblk1s = np.repeat(np.arange(len(blks1)), np.diff(start1))
+    w0, ok0 = _splice_windows(offsets0, ncac0, stubs0, chains0, iblk0s,
+                              aln0s, rms_range)
+    index, where1 = splice_window_index(blks1, res1, rms_range)
+    ok1 = np.zeros(len(aln1s), dtype='?')
+    ok1[where1] = True
+
+    def fill_rms(r0, r1):
+        metrics.rms[r0, r1] = np.where(ok0[r0, None] & ok1[None, r1],
+                                       np.inf, 0)
+
+    allpairs = len(pairs) == len(blks0) * len(blks1)
+    if allpairs:
+        fill_rms(slice(None), slice(None))
+    else:  # block pairs not in pairs are left -1
+        for i0, i1 in pairs:
+            fill_rms(slice(start0[i0], start0[i0 + 1]),
+                     slice(start1[i1], start1[i1 + 1]))
+
+    rows = np.flatnonzero(ok0)
+    if index is None or not len(rows): return metrics
+    q0, q1, rms = index.query(w0[rows], rms_cut)
+    rows, cols = rows[q0], where1[q1]
+    if not allpairs:
+        codes = iblk0s[rows] * len(blks1) + iblk1s[cols]
+        paircodes = [i0 * len(blks1) + i1 for i0, i1 in pairs]
+        keep = np.isin(codes, paircodes)
+        rows, cols, rms = rows[keep], cols[keep], rms[keep]
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    metrics.rms[rows, cols] = rms[order]
+
+    # cell lists only over blocks with candidate splices
+    build = np.zeros(len(blks0), dtype='?')
+    build[iblk0s[rows]] = True
+    clashcell, contactcell = _grid_cells(clashd2, contactd2)
+    clashgrids = _block_grids(offsets0, ncac0, build, 0, 1, clashcell)
+    contactgrids = _block_grids(offsets0, ncac0, build, 1, 3, contactcell)
+    kernel = _splice_pairs_serial
+    if parallel: kernel = _splice_pairs_parallel
+    chunks = [np.arange(len(rows))]
+    if progressbar:
+        chunks = tqdm(np.array_split(chunks[0], max(1, min(len(rows), 100))))
+    for chunk in chunks:
+        kernel(
+            offsets0, ncac0, stubs0, offsets1, ncac1, stubs1, iblk0s, aln0s,
+            iblk1s, aln1s, rows[chunk], cols[chunk], clashgrids,
+            contactgrids, metrics.nclash, metrics.ncontact, clashd2,
+            contactd2, clash_contact_range
+        )
+    return metrics
 
 
 def splice_metrics(
@@ -111,10 +811,51 @@ def splice_metrics(
         rms_cut=1.1,
         skip_on_fail=True,
         parallel=False,
-        progressbar=False
+        progressbar=False,
+        cachedir=None,
+        rms_gemm=False,
+        rms_index=False,
 ):
+    """rms, clash and contact metrics of all splices from exits of u to
+    entries of v
+
+    Args:
+        u (_Vertex): upstream vertex
+        ublks (list): bblocks of u
+        v (_Vertex): downstream vertex
+        vblks (list): bblocks of v
+        clashd2 (float, optional): squared clash distance, any atoms
+        contactd2 (float, optional): squared contact distance, CA only
+        rms_range (int, optional): residues each side of the splice aligned
+        clash_contact_range (int, optional): residues each side of the
+            splice checked for clashes and contacts
+        rms_cut (float, optional): splices with higher rms are not checked
+            for clashes and contacts if skip_on_fail
+        skip_on_fail (bool, optional): see rms_cut
+        parallel (bool, optional): compute block pairs in threads
+        progressbar (bool, optional): show progress of block pairs
+        cachedir (str, optional): load the metrics of each block pair
+            from, or save them to, cachedir/splice_metrics, keyed by
+            splice_metrics_cache_key, so only pairs not seen before are
+            computed. hits and misses per pair are logged and counted in
+            splice_metrics_cache_stats
+        rms_gemm (bool, optional): compute the rms of all splices with one
+            matrix multiplication, see _splice_rms, instead of per splice.
+            equal up to rounding, which can flip splices at rms_cut
+        rms_index (bool, optional): find splices with rms <= rms_cut with
+            a SpliceWindowIndex over the entries of v instead of computing
+            all rms, for big libraries. the index is cached per library,
+            see splice_window_index, and only the splices it finds are
+            checked for clashes and contacts. needs skip_on_fail, higher rms
+            are reported as inf
+
+    Returns:
+        _SCM_Scores: (nexit of u, nentry of v) nclash, ncontact and rms
+    """
 
     assert (u.dirn[1] + v.dirn[0]) == 1
+    if rms_index and not skip_on_fail:
+        raise ValueError('rms_index needs skip_on_fail')
     outidx = [
         np.where(u.inout[:, 1] == i)[0][0]
         for i in range(np.max(u.inout[:, 1]) + 1)
@@ -140,54 +881,91 @@ def splice_metrics(
     for iblk in outblk_res.keys():
         outblk_res[iblk] = np.array(outblk_res[iblk], 'i4')
 
-    if u.dirn[1] == 0:  # swap!
+    swapped = u.dirn[1] == 0
+    if swapped:  # swap!
         u, ublks, v, vblks = v, vblks, u, ublks
         outblk_res, inblk_res = inblk_res, outblk_res
         outblk, inblk = inblk, outblk
 
-    metrics = _SCM_Scores(
-        nclash=np.zeros((len(outblk), len(inblk)), dtype=np.int32) - 1,
-        ncontact=np.zeros((len(outblk), len(inblk)), dtype=np.int32) - 1,
-        rms=np.zeros((len(outblk), len(inblk)), dtype=np.float32) - 1
+    args = (
+        clashd2, contactd2, rms_range, clash_contact_range, rms_cut,
+        skip_on_fail
+    )
+    kw = dict(
+        args=args, rms_gemm=rms_gemm, rms_index=rms_index,
+        parallel=parallel, progressbar=progressbar
     )
 
-    exe = cf.ProcessPoolExecutor if parallel else InProcessExecutor
-    with exe() as pool:
-        futures = list()
-        offset0 = 0
-        for iblk0, ires0 in outblk_res.items():
-            blk0 = ublks[iblk0]
-            offset1 = 0
-            for iblk1, ires1 in inblk_res.items():
-                blk1 = vblks[iblk1]
-                future = pool.submit(
-                    _jit_splice_metrics, blk0.chains, blk1.chains, blk0.ncac,
-                    blk1.ncac, blk0.stubs, blk1.stubs, ires0, ires1, clashd2,
-                    contactd2, rms_range, clash_contact_range, rms_cut,
-                    skip_on_fail
-                )
-                future.stash = (
-                    iblk0, iblk1, offset0, offset1, len(ires0), len(ires1)
-                )
-                futures.append(future)
-                offset1 += len(ires1)
-            offset0 += len(ires0)
-
-        iter = cf.as_completed(futures)
-        if progressbar:
-            iter = tqdm(cf.as_completed(futures), total=len(futures))
-        for i, future in enumerate(iter):
-            iblk0, iblk1, offset0, offset1, nres0, nres1 = future.stash
-            rms, nclash, ncontact = future.result()
-            myslice = (
-                slice(offset0, offset0 + nres0),
-                slice(offset1, offset1 + nres1)
+    # rows of the outputs are the exits of u grouped by block, columns the
+    # entries of v, so each block pair is a rectangle
+    blk0s, blk1s = list(outblk_res), list(inblk_res)
+    res0 = [outblk_res[i] for i in blk0s]
+    res1 = [inblk_res[i] for i in blk1s]
+    pairs = [(i0, i1) for i0 in range(len(blk0s)) for i1 in range(len(blk1s))]
+
+    if not cachedir:
+        metrics = _block_pair_metrics([ublks[i] for i in blk0s], res0,
+                                      [vblks[i] for i in blk1s], res1,
+                                      pairs, **kw)
+    else:
+        start0 = np.cumsum([0] + [len(r) for r in res0])
+        start1 = np.cumsum([0] + [len(r) for r in res1])
+        metrics = _unset_metrics(start0[-1], start1[-1])
+
+        def rect(i0, i1):
+            return (slice(start0[i0], start0[i0 + 1]),
+                    slice(start1[i1], start1[i1 + 1]))
+
+        digests0 = [_bblock_digest(ublks[i]) for i in blk0s]
+        digests1 = [_bblock_digest(vblks[i]) for i in blk1s]
+        keys = [
+            splice_metrics_cache_key(
+                digests0[i0], digests1[i1], res0[i0], res1[i1], *args,
+                rms_gemm, rms_index
+            ) for i0, i1 in pairs
+        ]
+        cached = _load_splice_metrics(cachedir, keys)
+        missing = list()
+        for (i0, i1), key in zip(pairs, keys):
+            if key not in cached:
+                missing.append((i0, i1, key))
+                continue
+            rms, nclash, ncontact = cached[key]
+            metrics.rms[rect(i0, i1)] = rms
+            metrics.nclash[rect(i0, i1)] = nclash
+            metrics.ncontact[rect(i0, i1)] = ncontact
+        nmiss = len(missing)
+        splice_metrics_cache_stats['hit'] += len(pairs) - nmiss
+        splice_metrics_cache_stats['miss'] += nmiss
+        info('splice_metrics cache: %i of %i block pairs hit' %
+             (len(pairs) - nmiss, len(pairs)))
+
+        if missing:  # compute only the blocks of missing pairs
+            sub0 = sorted({i0 for i0, _, _ in missing})
+            sub1 = sorted({i1 for _, i1, _ in missing})
+            where0 = {i0: k for k, i0 in enumerate(sub0)}
+            where1 = {i1: k for k, i1 in enumerate(sub1)}
+            new = _block_pair_metrics(
+                [ublks[blk0s[i]] for i in sub0], [res0[i] for i in sub0],
+                [vblks[blk1s[i]] for i in sub1], [res1[i] for i in sub1],
+                [(where0[i0], where1[i1]) for i0, i1, _ in missing], **kw
             )
-            metrics.rms[myslice] = rms
-            metrics.nclash[myslice] = nclash
-            metrics.ncontact[myslice] = ncontact
+            substart0 = np.cumsum([0] + [len(res0[i]) for i in sub0])
+            substart1 = np.cumsum([0] + [len(res1[i]) for i in sub1])
+            entries = dict()
+            for i0, i1, key in missing:
+                k0, k1 = where0[i0], where1[i1]
+                subrect = (slice(substart0[k0], substart0[k0 + 1]),
+                           slice(substart1[k1], substart1[k1 + 1]))
+                result = (new.rms[subrect], new.nclash[subrect],
+                          new.ncontact[subrect])
+                metrics.rms[rect(i0, i1)] = result[0]
+                metrics.nclash[rect(i0, i1)] = result[1]
+                metrics.ncontact[rect(i0, i1)] = result[2]
+                entries[key] = result
+            _save_splice_metrics(cachedir, entries)
 
-    if u.dirn[1] == 0:  # swap!
+    if swapped:  # swap back, rows are exits of u
         metrics = _SCM_Scores(
             metrics.nclash.T, metrics.ncontact.T, metrics.rms.T
         )
@@ -195,11 +973,15 @@ def splice_metrics(
     return metrics
 
 
+def _good_edges(m, rms_cut, ncontact_cut):
+    # * is logical 'and'
+    return ((m.nclash == 0) * (m.rms <= rms_cut) *
+            (m.ncontact >= ncontact_cut))
+
+
 def Edge(u, ublks, v, vblks, rms_cut=1.1, ncontact_cut=10, verbosity=0, **kw):
     m = splice_metrics(u, ublks, v, vblks, rms_cut=rms_cut, **kw)
-    # * is logical 'and'
-    good_edges = ((m.nclash == 0) * (m.rms <= rms_cut) *
-                  (m.ncontact >= ncontact_cut))
+    good_edges = _good_edges(m, rms_cut, ncontact_cut)
     if verbosity > 0:
         print(
             'fraction good edges:', good_edges.sum(), good_edges.size,
@@ -208,6 +990,73 @@ def Edge(u, ublks, v, vblks, rms_cut=1.1, ncontact_cut=10, verbosity=0, **kw):
     return _Edge(scmatrix_to_splices(good_edges))
 
 
+def edge_append(
+        edge,
+        u_old,
+        u,
+        ublks,
+        v_old,
+        v,
+        vblks,
+        rms_cut=1.1,
+        ncontact_cut=10,
+        **kw
+):
+    """update edge after rows were added to its vertices with vertex_append
+
+    splice metrics are only computed for exits of the new rows of u against
+    all entries of v, and for the old exits against entries of the new rows
+    of v. the result is identical to Edge(u, ublks, v, vblks, ...)
+
+    Args:
+        edge (_Edge): edge between u_old and v_old
+        u_old (_Vertex): vertex before vertex_append
+        u (_Vertex): vertex after vertex_append
+        ublks (list): all bblocks of u, old and new
+        v_old (_Vertex): vertex before vertex_append
+        v (_Vertex): vertex after vertex_append
+        vblks (list): all bblocks of v, old and new
+        rms_cut (float, optional): see Edge
+        ncontact_cut (int, optional): see Edge
+        **kw: passed to splice_metrics
+
+    Returns:
+        _Edge: edge between u and v
+    """
+    nexit_old, nentry_old = edge.len, len(v_old.inbreaks) - 1
+    assert nexit_old == np.max(u_old.exit_index) + 1
+    good_edges = np.zeros((np.max(u.exit_index) + 1, len(v.inbreaks) - 1),
+                          dtype='?')
+    good_edges[:nexit_old, :nentry_old] = splices_to_scmatrix(
+        edge.splices, nentry_old
+    )
+    if u.len > u_old.len:
+        m = splice_metrics(
+            _vertex_tail(u, u_old.len), ublks, v, vblks, rms_cut=rms_cut,
+            **kw
+        )
+        good_edges[nexit_old:] = _good_edges(m, rms_cut, ncontact_cut)
+    if v.len > v_old.len:
+        m = splice_metrics(
+            u_old, ublks, _vertex_tail(v, v_old.len), vblks, rms_cut=rms_cut,
+            **kw
+        )
+        good_edges[:nexit_old, nentry_old:] = _good_edges(
+            m, rms_cut, ncontact_cut
+        )
+    return _Edge(scmatrix_to_splices(good_edges))
+
+
+@jit
+def splices_to_scmatrix(splices, nentry):
+    """inverse of scmatrix_to_splices"""
+    scmatrix = np.zeros((len(splices), nentry), dtype=np.bool_)
+    for i in range(len(splices)):
+        for j in range(1, splices[i, 0]):
+            scmatrix[i, splices[i, j]] = True
+    return scmatrix
+
+
 @jit
 def scmatrix_to_splices(scmatrix):
     assert scmatrix.ndim is 2
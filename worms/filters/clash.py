@@ -1,9 +1,10 @@
-import concurrent.futures as cf
 import numpy as np
-from multiprocessing import cpu_count
+import numba as nb
 
-from worms.util import jit, InProcessExecutor
+from worms.util import jit
 from worms.search.result import SearchResult
+from worms.bblock_store import BBlockSet, _BBlockSet
+from worms.vertex import _pjit
 
 
 @jit
@@ -49,94 +50,121 @@ def _get_trimmed_chain_bounds(dirn, ires, idx, chains, trim=8):
 
 
 @jit
-def _check_all_chain_clashes(
-        dirns, iress, indices, position, chains, ncacs, thresh
-):
-    for i in range(len(dirns) - 1):
+def _check_worm_clashes(bbset, iblks, dirns, ires, position, thresh):
+    """True if no CA of consecutive or any two blocks of a worm clash
+
+    Args:
+        bbset (_BBlockSet): bblocks of all vertices
+        iblks (np.ndarray): (nvert,) block of each vertex in bbset
+        dirns (np.ndarray): (nvert, 2) dirn of each vertex
+        ires (np.ndarray): (nvert, 2) ires row of each vertex
+        position (np.ndarray): (nvert, 4, 4) worm positions
+        thresh (float): squared clash distance
+    """
+    nvert = len(dirns)
+    for i in range(nvert - 1):
         ichntrm = _get_trimmed_chain_bounds(
-            dirns[i], iress[i], indices[i], chains[i], 8
+            dirns[i], ires, i, bbset.block_chains(iblks[i]), 8
         )
+        ncaci = bbset.block_ncac(iblks[i])
         for j in range(i + 1, i + 2):
             jchntrm = _get_trimmed_chain_bounds(
-                dirns[j], iress[j], indices[j], chains[j], 8
+                dirns[j], ires, j, bbset.block_chains(iblks[j]), 8
             )
+            ncacj = bbset.block_ncac(iblks[j])
             for ichain in range(len(ichntrm)):
                 ilb, iub = ichntrm[ichain]
                 for jchain in range(len(jchntrm)):
                     jlb, jub = jchntrm[jchain]
-                    for ir in range(ilb, iub):
-                        ica = position[i] @ ncacs[i][ir, 1]
-                        for jr in range(jlb, jub):
-                            jca = position[j] @ ncacs[j][jr, 1]
-                            d2 = np.sum((ica - jca)**2)
-                            if d2 < thresh:
-                                return False
-    for i in range(len(dirns) - 1):
-        ichains = _get_all_chain_bounds(
-            dirns[i], iress[i], indices[i], chains[i], 8
-        )
-        for j in range(i + 1, i + 2):
-            jchains = _get_all_chain_bounds(
-                dirns[j], iress[j], indices[j], chains[j], 8
-            )
-            for ichain in range(len(ichains)):
-                ilb, iub = ichains[ichain]
-                for jchain in range(len(jchains)):
-                    jlb, jub = jchains[jchain]
-                    for ir in range(ilb, iub):
-                        ica = position[i] @ ncacs[i][ir, 1]
-                        for jr in range(jlb, jub):
-                            jca = position[j] @ ncacs[j][jr, 1]
-                            d2 = np.sum((ica - jca)**2)
-                            if d2 < thresh:
-                                return False
-    for i in range(len(dirns) - 1):
-        ichains = _get_all_chain_bounds(
-            dirns[i], iress[i], indices[i], chains[i], 8
-        )
-        for j in range(i + 1, len(dirns)):
-            jchains = _get_all_chain_bounds(
-                dirns[j], iress[j], indices[j], chains[j], 8
+                    if _chains_clash(position[i], ncaci, ilb, iub,
+                                     position[j], ncacj, jlb, jub, thresh):
+                        return False
+    for jend in (2, nvert):  # consecutive blocks first, they clash most
+        for i in range(nvert - 1):
+            ichains = _get_all_chain_bounds(
+                dirns[i], ires, i, bbset.block_chains(iblks[i]), 8
             )
-            for ichain in range(len(ichains)):
-                ilb, iub = ichains[ichain]
-                for jchain in range(len(jchains)):
-                    jlb, jub = jchains[jchain]
-                    for ir in range(ilb, iub):
-                        ica = position[i] @ ncacs[i][ir, 1]
-                        for jr in range(jlb, jub):
-                            jca = position[j] @ ncacs[j][jr, 1]
-                            d2 = np.sum((ica - jca)**2)
-                            if d2 < thresh:
-                                return False
+            ncaci = bbset.block_ncac(iblks[i])
+            for j in range(i + 1, min(i + jend, nvert)):
+                jchains = _get_all_chain_bounds(
+                    dirns[j], ires, j, bbset.block_chains(iblks[j]), 8
+                )
+                ncacj = bbset.block_ncac(iblks[j])
+                for ichain in range(len(ichains)):
+                    ilb, iub = ichains[ichain]
+                    for jchain in range(len(jchains)):
+                        jlb, jub = jchains[jchain]
+                        if _chains_clash(position[i], ncaci, ilb, iub,
+                                         position[j], ncacj, jlb, jub,
+                                         thresh):
+                            return False
     return True
 
 
+@jit
+def _chains_clash(posi, ncaci, ilb, iub, posj, ncacj, jlb, jub, thresh):
+    for ir in range(ilb, iub):
+        ica = posi @ ncaci[ir, 1]
+        for jr in range(jlb, jub):
+            jca = posj @ ncacj[jr, 1]
+            d2 = np.sum((ica - jca)**2)
+            if d2 < thresh:
+                return True
+    return False
+
+
+def _prune_clashes_kernel(bbset, iblks, dirns, ires, positions, thresh, ok):
+    """_check_worm_clashes of every worm into ok"""
+    for iworm in nb.prange(len(iblks)):
+        ok[iworm] = _check_worm_clashes(
+            bbset, iblks[iworm], dirns, ires[iworm], positions[iworm], thresh
+        )
+
+
+_prune_clashes_serial = jit(_prune_clashes_kernel)
+_prune_clashes_parallel = _pjit(_prune_clashes_kernel)
+
+
 def prune_clashing_results(graph, worms, thresh=4.0, parallel=False):
-    verts = tuple(graph.verts)
+    """worms whose blocks don't clash
 
-    exe = cf.ProcessPoolExecutor if parallel else InProcessExecutor
-    with exe() as pool:
-        futures = list()
-        for i in range(len(worms.indices)):
-            dirns = tuple([v.dirn for v in verts])
-            iress = tuple([v.ires for v in verts])
-            chains = tuple([
-                graph.bbs[k][verts[k].ibblock[worms.indices[i, k]]].chains
-                for k in range(len(graph.verts))
-            ])
-            ncacs = tuple([
-                graph.bbs[k][verts[k].ibblock[worms.indices[i, k]]].ncac
-                for k in range(len(graph.verts))
-            ])
-            futures.append(
-                pool.submit(
-                    _check_all_chain_clashes, dirns, iress, worms.indices[i],
-                    worms.positions[i], chains, ncacs, thresh * thresh
-                )
-            )
-        ok = np.array([f.result() for f in futures], dtype='?')
+    all checks run in one jitted call over a _BBlockSet of the blocks of
+    every vertex, with parallel over worms in threads
+
+    Args:
+        graph (Graph): bbs and verts the worms refer to
+        worms (SearchResult): worms to check
+        thresh (float): min CA distance
+        parallel (bool): check worms in threads
+
+    Returns:
+        SearchResult: worms without clashes
+    """
+    verts = tuple(graph.verts)
+    # one set of all libraries, each library once however many vertices
+    # use it, vertex k refers to it from base[k]
+    libs, base, start = list(), list(), dict()
+    for bbs in graph.bbs:
+        if id(bbs) not in start:
+            start[id(bbs)] = sum(len(lib) for lib in libs)
+            if isinstance(bbs, _BBlockSet):
+                libs.append([bbs.bblock(i) for i in range(bbs.len)])
+            else:
+                libs.append(list(bbs))
+        base.append(start[id(bbs)])
+    bbset = BBlockSet([bb for lib in libs for bb in lib])
+    nworm, nvert = len(worms.indices), len(verts)
+    iblks = np.empty((nworm, nvert), dtype=np.int64)
+    ires = np.empty((nworm, nvert, 2), dtype=np.int32)
+    for k in range(nvert):
+        iblks[:, k] = base[k] + verts[k].ibblock[worms.indices[:, k]]
+        ires[:, k] = verts[k].ires[worms.indices[:, k]]
+    dirns = np.stack([v.dirn for v in verts]).astype(np.int32)
+    positions = np.ascontiguousarray(worms.positions, dtype=np.float64)
+    ok = np.empty(nworm, dtype=np.bool_)
+    kernel = _prune_clashes_parallel if parallel else _prune_clashes_serial
+    kernel(bbset, iblks, dirns, ires, positions, thresh * thresh, ok)
 
     return SearchResult(
         worms.positions[ok], worms.indices[ok], worms.losses[ok]
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,142 @@
+"""pyrosetta-free backbone reading from pdb and mmcif files
+
+only what a BBlock needs is extracted: N, CA and C coordinates of every
+protein residue and the chain bounds. atom records are parsed with
+vectorized numpy operations on fixed width columns, so reading is limited
+by io rather than by per-residue python code
+"""
+
+import gzip
+
+import numpy as np
+
+_BB_ATOMS = (b'N', b'CA', b'C')
+
+
+def _read_bytes(fname):
+    opener = gzip.open if str(fname).endswith('.gz') else open
+    with opener(fname, 'rb') as inp:
+        return inp.read()
+
+
+def read_backbone(fname):
+    """read N, CA, C coordinates and chain bounds from pdb or mmcif file
+
+    files ending in .cif or .mmcif (optionally .gz) are read as mmcif,
+    anything else as pdb
+
+    Args:
+        fname (str): structure file
+
+    Returns:
+        (np.ndarray, list): float64 (nres, 3, 4) homogeneous N, CA, C
+        coordinates and [(begin, end), ...] residue bounds of each chain,
+        as util.get_bb_coords and util.get_chain_bounds return for a pose
+    """
+    name = str(fname)
+    if name.endswith('.gz'): name = name[:-3]
+    if name.endswith('.cif') or name.endswith('.mmcif'):
+        return read_cif_backbone(fname)
+    return read_pdb_backbone(fname)
+
+
+def read_pdb_backbone(fname):
+    """read_backbone for pdb format, only the first model is used"""
+    lines = _read_bytes(fname).splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith(b'ENDMDL'):
+            lines = lines[:i]
+            break
+    lines = [l for l in lines if l.startswith((b'ATOM  ', b'HETATM'))]
+    if not lines:
+        raise ValueError('no atoms in ' + str(fname))
+    recs = np.array(lines, dtype='S80')
+    cols = recs.view('u1').reshape(len(recs), 80)
+
+    def field(beg, end):
+        return np.ascontiguousarray(cols[:, beg:end]).view('S%i' % (end - beg)
+                                                            ).ravel()
+
+    xyz = np.ascontiguousarray(cols[:, 30:54]).view('S8').astype('f8')
+    return _backbone_from_atoms(
+        atom=np.char.strip(field(12, 16)),
+        altloc=field(16, 17),
+        chain=field(21, 22),
+        resid=field(22, 27),  # resseq and insertion code
+        xyz=xyz.reshape(-1, 3),
+    )
+
+
+def read_cif_backbone(fname):
+    """read_backbone for mmcif format, only the first model is used"""
+    lines = _read_bytes(fname).splitlines()
+    names, rows = [], []
+    for line in lines:
+        if line.startswith(b'_atom_site.'):
+            names.append(line.split()[0][11:].decode())
+        elif names and line.startswith((b'ATOM', b'HETATM')):
+            rows.append(line)
+        elif rows:
+            break
+    if not rows:
+        raise ValueError('no atom_site records in ' + str(fname))
+    tokens = np.array(b' '.join(rows).split()).reshape(len(rows), len(names))
+    col = {n: tokens[:, i] for i, n in enumerate(names)}
+
+    def get(*keys, default=b'?'):
+        for k in keys:
+            if k in col: return col[k]
+        return np.full(len(tokens), default)
+
+    keep = np.ones(len(tokens), dtype='?')
+    if 'pdbx_PDB_model_num' in col:
+        model = col['pdbx_PDB_model_num']
+        keep = model == model[0]
+    atom = np.char.strip(get('auth_atom_id', 'label_atom_id'), b'"\'')
+    altloc = get('label_alt_id')
+    altloc = np.where(np.isin(altloc, (b'.', b'?')), b' ', altloc)
+    resid = np.char.add(
+        get('auth_seq_id', 'label_seq_id'), get('pdbx_PDB_ins_code')
+    )
+    xyz = np.stack([
+        col['Cartn_x'].astype('f8'),
+        col['Cartn_y'].astype('f8'),
+        col['Cartn_z'].astype('f8'),
+    ], axis=-1)
+    return _backbone_from_atoms(
+        atom=atom[keep],
+        altloc=altloc[keep],
+        chain=get('auth_asym_id', 'label_asym_id')[keep],
+        resid=resid[keep],
+        xyz=xyz[keep],
+    )
+
+
+def _backbone_from_atoms(atom, altloc, chain, resid, xyz):
+    """group atom records into residues, keep those with N, CA and C
+
+    residues are consecutive runs of records with the same chain and residue
+    id. the first alternate location is used. residues without a complete
+    backbone (waters, ligands) are dropped, a new chain starts wherever the
+    chain id changes
+    """
+    ok = np.isin(altloc, (b' ', b'A', b'1'))
+    atom, chain, resid, xyz = atom[ok], chain[ok], resid[ok], xyz[ok]
+    newres = np.ones(len(atom), dtype='?')
+    newres[1:] = (chain[1:] != chain[:-1]) | (resid[1:] != resid[:-1])
+    ires = np.cumsum(newres) - 1
+    nres = ires[-1] + 1 if len(ires) else 0
+    ncac = np.ones((nres, 3, 4))
+    ncac[..., :3] = np.nan
+    for i, name in enumerate(_BB_ATOMS):
+        sel = atom == name
+        ncac[ires[sel], i, :3] = xyz[sel]
+    isprot = ~np.any(np.isnan(ncac[..., :3]), axis=(1, 2))
+    ncac = np.ascontiguousarray(ncac[isprot])
+    reschain = chain[newres][isprot]
+    if not len(ncac):
+        return ncac, []
+    breaks = np.flatnonzero(reschain[1:] != reschain[:-1]) + 1
+    bounds = np.concatenate([[0], breaks, [len(ncac)]])
+    chains = [(int(b), int(e)) for b, e in zip(bounds[:-1], bounds[1:])]
+    return ncac, chains
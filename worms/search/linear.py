@@ -3,7 +3,7 @@ import numpy as np
 import numba as nb
 import types
 from worms.util import jit, InProcessExecutor
-from worms.vertex import _Vertex
+from worms.vertex import vertex_from_state, vertex_astype, orbit_indices
 from worms.edge import _Edge
 from random import random
 import concurrent.futures as cf
@@ -24,9 +24,42 @@ def lossfunc_rand_1_in(n):
 
 
 def grow_linear(
-        verts, edges, loss_function=null_lossfunc, loss_threshold=1.0,
-        parallel=0
+        verts,
+        edges,
+        loss_function=null_lossfunc,
+        loss_threshold=1.0,
+        parallel=0,
+        single_precision=False,
+        loss_margin=0.01,
 ):
+    """find all linear worms through verts and edges with small loss
+
+    Args:
+        verts (tuple(_Vertex)): vertices of the linear graph
+        edges (tuple(_Edge)): edges between consecutive verts
+        loss_function (jit function): loss of worm positions
+        loss_threshold (float): keep worms with loss <= loss_threshold
+        parallel (int): search batches of start vertices in threads
+        single_precision (bool): search with float32 vertex transforms and
+            positions, which halves memory traffic, then recompute positions
+            and losses of the hits in float64 and filter those by
+            loss_threshold
+        loss_margin (float): with single_precision, the float32 search keeps
+            worms with loss <= loss_threshold + loss_margin, so worms near
+            the threshold are not lost to rounding before rescoring
+
+    symmetric verts are searched like any other, over their representative
+    rows only, with edges built over them: members of an orbit splice the
+    same way up to the block's symmetry, so one splice check and one loss
+    per class are done. expand_symmetric gives the equivalent worms. the
+    loss of a class is that of its representative, members of symmetric
+    blocks sit rotated by the block symmetry, so losses that see this
+    rotation may keep a class whose members fail, which expand_symmetric
+    drops, or drop one whose members pass
+
+    Returns:
+        SearchResult: positions, indices and losses of the worms
+    """
     assert len(verts) > 1
     assert len(verts) == len(edges) + 1
     assert verts[0].dirn[0] == 2
@@ -38,12 +71,18 @@ def grow_linear(
     #     if not 'NUMBA_DISABLE_JIT' in os.environ:
     #         loss_function = nb.njit(nogil=1, fastmath=1)
 
+    search_verts, search_threshold = verts, loss_threshold
+    if single_precision:
+        search_verts = [vertex_astype(v, np.float32) for v in verts]
+        search_threshold = loss_threshold + loss_margin
+
     exe = cf.ThreadPoolExecutor if parallel else InProcessExecutor
     # exe = cf.ProcessPoolExecutor if parallel else InProcessExecutor
     with exe() as pool:
         futures = list()
         batch_size, vert0_size = 10, verts[0].len
-        verts_pickleable = [v._state for v in verts]
+        verts_pickleable = [v._state for v in search_verts]
+        vert_dtype = verts_pickleable[0][0].dtype
         edges_pickleable = [e._state for e in edges]
         for ivert in range(0, verts[0].len, batch_size):
             futures.append(
@@ -52,11 +91,11 @@ def grow_linear(
                     verts_pickleable=verts_pickleable,
                     edges_pickleable=edges_pickleable,
                     loss_function=loss_function,
-                    loss_threshold=loss_threshold,
+                    loss_threshold=search_threshold,
                     nresults=0,
                     isplice=0,
                     ivertex_range=(ivert, min(vert0_size, ivert + batch_size)),
-                    splice_position=np.eye(4),
+                    splice_position=np.eye(4, dtype=vert_dtype),
                     showprogress=0
                 )
             )
@@ -67,14 +106,128 @@ def grow_linear(
         indices=np.concatenate([r.indices for r in results]),
         losses=np.concatenate([r.losses for r in results]),
     )
+    if single_precision:
+        result = rescore_linear(result, verts, loss_function, loss_threshold)
 
     return result
 
 
+def rescore_linear(result, verts, loss_function, loss_threshold):
+    """recompute positions and losses of result in float64
+
+    Args:
+        result (SearchResult): worms from grow_linear
+        verts (tuple(_Vertex)): the vertices result refers to
+        loss_function (jit function): loss of worm positions
+        loss_threshold (float): keep worms with loss <= loss_threshold
+
+    Returns:
+        SearchResult: worms with loss <= loss_threshold, float64 positions
+    """
+    verts = tuple(verts)
+    positions = _linear_positions(verts, result.indices)
+    losses = _linear_losses(positions, loss_function)
+    ok = losses <= loss_threshold
+    return SearchResult(
+        positions[ok], result.indices[ok], losses[ok].astype(np.float32)
+    )
+
+
+def expand_symmetric(
+        result,
+        verts,
+        full_verts,
+        loss_function,
+        loss_threshold,
+        full_edges=None,
+):
+    """worms over full_verts equivalent to those of a symmetric search
+
+    every equivalent worm is rescored and kept if its loss is <=
+    loss_threshold. splices of members are taken to be those of their
+    representative, which they equal up to the symmetry of the blocks, see
+    _symmetry_compress
+
+    Args:
+        result (SearchResult): worms from grow_linear over verts
+        verts (tuple(_Vertex)): vertices result refers to, some symmetric
+        full_verts (tuple(_Vertex)): verts built with symmetric=False
+        loss_function (jit function): loss of worm positions
+        loss_threshold (float): keep worms with loss <= loss_threshold
+        full_edges (tuple(_Edge), optional): edges between consecutive
+            full_verts. if given, worms with a splice they reject are
+            dropped, for blocks only symmetric within _SYMMETRY_RMS_TOL
+
+    Returns:
+        (np.ndarray, SearchResult): (nexpand,) index into result of each
+        worm, and the worms, float64 positions
+    """
+    iresult, indices = orbit_indices(result.indices, verts)
+    full_verts = tuple(full_verts)
+    if full_edges is not None:
+        allowed = _splices_allowed_all(full_verts, tuple(full_edges),
+                                       indices)
+        iresult, indices = iresult[allowed], indices[allowed]
+    positions = _linear_positions(full_verts, indices)
+    losses = _linear_losses(positions, loss_function)
+    ok = losses <= loss_threshold
+    return iresult[ok], SearchResult(
+        positions[ok], indices[ok], losses[ok].astype(np.float32)
+    )
+
+
+@jit
+def _linear_positions(verts, indices):
+    positions = np.empty((len(indices), len(verts), 4, 4), dtype=np.float64)
+    for i in range(len(indices)):
+        splice_position = np.eye(4)
+        for isplice in range(len(verts)):
+            ivertex = indices[i, isplice]
+            x2orig = verts[isplice].vertex_x2orig(ivertex).astype(np.float64)
+            positions[i, isplice] = splice_position @ x2orig
+            x2exit = verts[isplice].vertex_x2exit(ivertex).astype(np.float64)
+            splice_position = splice_position @ x2exit
+    return positions
+
+
+@jit
+def _linear_losses(positions, loss_function):
+    losses = np.empty(len(positions), dtype=np.float64)
+    for i in range(len(positions)):
+        losses[i] = loss_function(positions[i])
+    return losses
+
+
+@jit
+def _splice_allowed(full_verts, full_edges, isplice, irow, inext):
+    """full_edges[isplice] allows splicing row irow to row inext"""
+    iexit = full_verts[isplice].exit_index[irow]
+    ienter = full_verts[isplice + 1].entry_index[inext]
+    for allowed in full_edges[isplice].allowed_entries(iexit):
+        if allowed == ienter:
+            return True
+    return False
+
+
+@jit
+def _splices_allowed_all(full_verts, full_edges, indices):
+    """which worms over full_verts have only splices full_edges allows"""
+    ok = np.ones(len(indices), dtype=np.bool_)
+    for i in range(len(indices)):
+        for isplice in range(len(full_verts) - 1):
+            if not _splice_allowed(full_verts, full_edges, isplice,
+                                   indices[i, isplice],
+                                   indices[i, isplice + 1]):
+                ok[i] = False
+                break
+    return ok
+
+
 def _grow_linear_start(verts_pickleable, edges_pickleable, **kwargs):
-    verts = tuple([_Vertex(*vp) for vp in verts_pickleable])
+    verts = tuple([vertex_from_state(vp) for vp in verts_pickleable])
     edges = tuple([_Edge(*ep) for ep in edges_pickleable])
-    positions = np.empty(shape=(1024, len(verts), 4, 4), dtype=np.float64)
+    dtype = verts[0].x2orig.dtype
+    positions = np.empty(shape=(1024, len(verts), 4, 4), dtype=dtype)
     indices = np.empty(shape=(1024, len(verts)), dtype=np.int32)
     losses = np.empty(shape=(1024, ), dtype=np.float32)
     result = SearchResult(positions=positions, indices=indices, losses=losses)
@@ -111,7 +264,9 @@ def _grow_linear_recurse(
             if (ivertex + 1) % (ivertex_range[1] / showprogress) == 0:
                 print(int(ivertex * showprogress / ivertex_range[1]))
         result.indices[nresults, isplice] = ivertex
-        vertex_position = splice_position @ current_vertex.x2orig[ivertex]
+        vertex_position = (
+            splice_position @ current_vertex.vertex_x2orig(ivertex)
+        )
         result.positions[nresults, isplice] = vertex_position
         if isplice == len(edges):
             loss = loss_function(result.positions[nresults])
@@ -121,7 +276,9 @@ def _grow_linear_recurse(
                 result = expand_results(result, nresults)
         else:
             next_vertex = verts[isplice + 1]
-            next_splicepos = splice_position @ current_vertex.x2exit[ivertex]
+            next_splicepos = (
+                splice_position @ current_vertex.vertex_x2exit(ivertex)
+            )
             iexit = current_vertex.exit_index[ivertex]
             allowed_entries = edges[isplice].allowed_entries(iexit)
             for ienter in allowed_entries:
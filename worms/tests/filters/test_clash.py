@@ -0,0 +1,24 @@
+import numpy as np
+from worms import Vertex, Edge
+from worms.graph import Graph
+from worms.search.linear import grow_linear
+from worms.filters.clash import prune_clashing_results
+from worms.tests import only_if_jit
+
+
+@only_if_jit
+def test_prune_clashing_results_parallel(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    verts = (Vertex(bbs, '_C'), Vertex(bbs, 'NC'), Vertex(bbs, 'N_'))
+    edges = (
+        Edge(verts[0], bbs, verts[1], bbs),
+        Edge(verts[1], bbs, verts[2], bbs),
+    )
+    result = grow_linear(verts, edges)
+    graph = Graph((bbs, ) * 3, verts, edges)
+    serial = prune_clashing_results(graph, result)
+    parallel = prune_clashing_results(graph, result, parallel=True)
+    assert 0 < len(serial.indices) < len(result.indices)
+    assert np.all(parallel.indices == serial.indices)
+    assert np.all(parallel.positions == serial.positions)
+    assert np.all(parallel.losses == serial.losses)
@@ -1,9 +1,12 @@
-from worms.search.linear import grow_linear
+from worms.search.linear import grow_linear, expand_symmetric
 from worms import Vertex, Edge, BBlockDB
 import pytest
 import numpy as np
 import os
 from worms.tests import only_if_jit
+from worms.util import jit
+from worms.vertex import vertex_astype, orbit_indices
+from worms.edge import _Edge, scmatrix_to_splices
 
 
 def _print_splices(e):
@@ -107,6 +110,153 @@ def test_linear_search_three(bbdb_fullsize_prots):
     ])  # yapf: disable
 
 
+@jit
+def _lossfunc_end_dist(pos):
+    return np.sqrt(np.sum(pos[-1, :3, 3]**2)) / 10.0
+
+
+@only_if_jit
+def test_linear_search_single_precision(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    verts = (Vertex(bbs, '_C'), Vertex(bbs, 'NC'), Vertex(bbs, 'N_'))
+    edges = (Edge(verts[0], bbs, verts[1], bbs),
+             Edge(verts[1], bbs, verts[2], bbs))
+    kw = dict(loss_function=_lossfunc_end_dist, loss_threshold=10.0)
+    ref = grow_linear(verts, edges, **kw)
+    assert 0 < len(ref.losses) < _num_splices(edges[0]) * _num_splices(
+        edges[1])
+
+    # float32 search alone, drift from float64 is small
+    verts_f4 = [vertex_astype(v, np.float32) for v in verts]
+    assert verts_f4[1].x2exit.dtype == np.float32
+    res = grow_linear(verts_f4, edges, **kw)
+    assert res.positions.dtype == np.float32
+    assert np.all(res.indices == ref.indices)
+    assert np.allclose(res.losses, ref.losses, atol=1e-4)
+    assert np.allclose(res.positions, ref.positions, atol=1e-3)
+
+    # with float64 rescoring, the results are exactly the float64 ones
+    res = grow_linear(verts, edges, single_precision=True, **kw)
+    assert res.positions.dtype == np.float64
+    assert np.all(res.indices == ref.indices)
+    assert np.all(res.losses == ref.losses)
+    assert np.all(res.positions == ref.positions)
+
+
+@only_if_jit
+def test_linear_search_lazy(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    verts = (Vertex(bbs, '_C'), Vertex(bbs, 'NC'), Vertex(bbs, 'N_'))
+    edges = (Edge(verts[0], bbs, verts[1], bbs),
+             Edge(verts[1], bbs, verts[2], bbs))
+    kw = dict(loss_function=_lossfunc_end_dist, loss_threshold=10.0)
+    ref = grow_linear(verts, edges, **kw)
+
+    # lazy and materialized vertices mixed per segment
+    lazy = (verts[0], Vertex(bbs, 'NC', lazy=True), verts[2])
+    assert lazy[1].lazy and not verts[1].lazy
+    res = grow_linear(lazy, edges, **kw)
+    assert np.all(res.indices == ref.indices)
+    assert np.allclose(res.losses, ref.losses)
+    assert np.allclose(res.positions, ref.positions)
+
+
+def _all_splices_edge(u, v):
+    nexit, nentry = np.max(u.exit_index) + 1, np.max(v.entry_index) + 1
+    return _Edge(scmatrix_to_splices(np.ones((nexit, nentry), dtype='?')))
+
+
+def _sorted_result(result):
+    order = np.lexsort(result.indices.T[::-1])
+    return [a[order] for a in result]
+
+
+def _worm_set(result):
+    return set(map(tuple, result.indices))
+
+
+def _symmetric_verts(bbs):
+    u = Vertex(bbs, '_C')
+    full = (u, Vertex(bbs, 'NC'), Vertex(bbs, 'N_'))
+    verts = (u, Vertex(bbs, 'NC', symmetric=True),
+             Vertex(bbs, 'N_', symmetric=True))
+    return full, verts
+
+
+@only_if_jit
+def test_linear_search_symmetric(bbdb):
+    full, verts = _symmetric_verts(bbdb.query('all'))
+    full_edges = (_all_splices_edge(*full[:2]), _all_splices_edge(*full[1:]))
+    edges = (_all_splices_edge(*verts[:2]), _all_splices_edge(*verts[1:]))
+
+    kw = dict(loss_function=_lossfunc_end_dist, loss_threshold=9e9)
+    everything = grow_linear(full, full_edges, **kw)
+    compressed = grow_linear(verts, edges, **kw)
+    assert len(compressed.indices) < len(everything.indices)
+    iresult, result = expand_symmetric(compressed, verts, full, **kw)
+    assert np.all(np.diff(iresult) >= 0)
+    for a, b in zip(_sorted_result(result), _sorted_result(everything)):
+        assert np.all(a == b)
+
+    # members of an orbit end up in different places, so the threshold
+    # splits orbits. expanded worms are rescored, only classes whose
+    # representative passes are expanded
+    kw['loss_threshold'] = float(np.median(everything.losses))
+    ref = grow_linear(full, full_edges, **kw)
+    compressed = grow_linear(verts, edges, **kw)
+    iresult, result = expand_symmetric(compressed, verts, full, **kw)
+    assert len(result.indices)
+    assert _worm_set(result) <= _worm_set(ref)
+    assert np.all(result.losses <= kw['loss_threshold'])
+
+    res = grow_linear(verts, edges, single_precision=True, **kw)
+    assert np.all(res.indices == compressed.indices)
+    assert np.allclose(res.losses, compressed.losses)
+
+
+@only_if_jit
+def test_linear_search_symmetric_edges(bbdb):
+    # real splice checks over the representative rows of the Cn blocks,
+    # members splice the same way, so nothing the full search finds is lost
+    bbs = bbdb.query('all')
+    full, verts = _symmetric_verts(bbs)
+    full_edges = (Edge(full[0], bbs, full[1], bbs),
+                  Edge(full[1], bbs, full[2], bbs))
+    edges = (Edge(verts[0], bbs, verts[1], bbs),
+             Edge(verts[1], bbs, verts[2], bbs))
+    assert _num_splices(edges[1]) < _num_splices(full_edges[1])
+    kw = dict(loss_function=_lossfunc_end_dist, loss_threshold=9e9)
+    ref = grow_linear(full, full_edges, **kw)
+    assert len(ref.indices)
+    compressed = grow_linear(verts, edges, **kw)
+    assert len(compressed.indices) < len(ref.indices)
+    _, result = expand_symmetric(compressed, verts, full, **kw)
+    assert _worm_set(result) == _worm_set(ref)
+
+
+@only_if_jit
+def test_linear_search_symmetric_full_edges(bbdb):
+    bbs = bbdb.query('all')
+    full, verts = _symmetric_verts(bbs)
+    full_edges = (Edge(full[0], bbs, full[1], bbs),
+                  Edge(full[1], bbs, full[2], bbs))
+    # representatives may splice anywhere, only full_edges decides which
+    # of their members are worms
+    edges = (_all_splices_edge(*verts[:2]), _all_splices_edge(*verts[1:]))
+    kw = dict(loss_function=_lossfunc_end_dist, loss_threshold=9e9)
+    ref = grow_linear(full, full_edges, **kw)
+    assert len(ref.indices)
+
+    compressed = grow_linear(verts, edges, **kw)
+    _, members = orbit_indices(compressed.indices, verts)
+    assert len(members) > len(ref.indices)
+    iresult, result = expand_symmetric(
+        compressed, verts, full, full_edges=full_edges, **kw
+    )
+    for a, b in zip(_sorted_result(result), _sorted_result(ref)):
+        assert np.all(a == b)
+
+
 if __name__ == '__main__':
     bbdb_fullsize_prots = BBlockDB(
         cachedir=str('.worms_pytest_cache'),
@@ -0,0 +1,34 @@
+import numpy as np
+from worms.compact_pose import *
+from worms.tests import only_if_pyrosetta
+from worms import util
+
+
+def test_compact_pose_bytes():
+    cpose = CompactPose(
+        resnames=np.array(['ALA:NtermProteinFull', 'SER:CtermProteinFull']),
+        atomnames=np.array([b'N', b'CA', b'C', b'O', b'N', b'CA', b'C'], 'S4'),
+        coords=np.random.rand(7, 3).astype('f4'),
+        res_atom_start=np.array([0, 4, 7], 'i4'),
+        chain_ends=np.array([2], 'i4'),
+    )
+    cpose2 = compact_pose_from_bytes(compact_pose_bytes(cpose))
+    for a, b in zip(cpose, cpose2):
+        assert np.all(a == b)
+    bb = compact_pose_bb_coords(cpose2)
+    assert bb.shape == (2, 3, 4)
+    assert np.allclose(bb[1, :, :3], cpose.coords[4:7])
+
+
+@only_if_pyrosetta
+def test_compact_pose_roundtrip(c3pose):
+    cpose = compact_pose(c3pose)
+    assert len(cpose.resnames) == len(c3pose)
+    assert np.allclose(
+        compact_pose_bb_coords(cpose), util.get_bb_coords(c3pose), atol=1e-3)
+    pose = pose_from_compact(compact_pose_from_bytes(compact_pose_bytes(cpose)))
+    assert len(pose) == len(c3pose)
+    assert pose.num_chains() == c3pose.num_chains()
+    assert pose.sequence() == c3pose.sequence()
+    assert np.allclose(
+        util.get_bb_coords(pose), util.get_bb_coords(c3pose), atol=1e-3)
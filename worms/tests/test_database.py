@@ -1,7 +1,12 @@
 import pytest
 from worms.database import *
+from worms.database import _read_new_pdb
+from worms.bblock_store import (BBlockStore, BBlockBundle, SharedBBlockPool,
+                                 write_bblock_store)
 import logging
 import json
+import subprocess
+import sys
 from worms.util import InProcessExecutor
 from pprint import pprint
 from os.path import dirname
@@ -53,6 +58,34 @@ def test_database_simple(tmpdir, caplog):
     # assert len(pp.cache) == 213
 
 
+def test_query_index(tmpdir):
+    dbfiles = [f for f in test_db_files if os.path.exists(f)]
+    pp = BBlockDB(cachedir=str(tmpdir), bakerdb_files=dbfiles)
+    for query in ('Het:NN', 'Het:NNX', 'Het:NNY', 'Het:NC', 'Het:CCX'):
+        subq = query.split(':')[1]
+        tn, tc = subq.count('N'), subq.count('C')
+        brute = list()
+        for db in pp._alldb:
+            if 'Het' not in db['class']: continue
+            dirns = [c['direction'] for c in db['connections']]
+            nn, nc = dirns.count('N'), dirns.count('C')
+            if nn < tn or nc < tc: continue
+            if nn + nc == tn + tc and not subq.endswith('X'):
+                brute.append(db['file'])
+            elif nn + nc > tn + tc and not subq.endswith('Y'):
+                brute.append(db['file'])
+        assert pp.query_names(query) == brute
+    c3n = [db['file'] for db in pp._alldb if 'C3_N' in db['class']]
+    assert pp.query_names('C3_N') == c3n
+    names = pp.query_names('C3_N')
+    names.clear()
+    assert pp.query_names('C3_N') == c3n
+    assert ('C3_N', True) in pp._query_cache
+    pp.database_changed()
+    assert not pp._query_cache
+    assert pp.query_names('C3_N') == c3n
+
+
 @only_if_pyrosetta_distributed
 def test_construct_database_from_pdbs(tmpdir, datadir):
     pp = BBlockDB(
@@ -101,5 +134,257 @@ def test_construct_database_from_pdbs(tmpdir, datadir):
     assert np.all(pp.bblock(keys[11]).conn_resids(1) == [8])
 
 
+@only_if_pyrosetta_distributed
+def test_construct_database_from_pdbs_process_pool(tmpdir, datadir, bbdb):
+    pp = BBlockDB(
+        cachedir=str(tmpdir),
+        bakerdb_files=[os.path.join(datadir, 'test_db_file.json')],
+        lazy=False,
+        read_new_pdbs=True,
+        load_poses=True,
+        nprocs=2,
+        progressbar=False)
+    assert pp.n_new_entries == 12
+    assert pp.n_missing_entries == 0
+    assert len(pp._bblock_cache) == 12
+    assert len(pp._poses_cache) == 12
+    for f in pp.query_names('all'):
+        for x, y in zip(pp.bblock(f)._state, bbdb.bblock(f)._state):
+            assert np.all(x == y)
+        assert os.path.exists(pp.bblockfile(f))
+        assert os.path.exists(pp.posefile(f))
+
+
 def test_conftest_pdbfile(bbdb):
     assert len(bbdb.query('all')) == 12
+
+
+def test_bblock_store(bbdb, tmpdir):
+    files = bbdb.query_names('all')
+    bblocks = {f: bbdb.bblock(f) for f in files}
+    write_bblock_store(str(tmpdir.join('store')), bblocks)
+    store = BBlockStore(str(tmpdir.join('store')))
+    assert len(store) == len(files)
+    for f in files:
+        a, b = bblocks[f], store.bblock(f)
+        for x, y in zip(a._state, b._state):
+            assert np.all(x == y)
+        assert isinstance(store._cols['ncac'].base, np.memmap)
+        assert np.shares_memory(b.ncac, store._cols['ncac'])
+        assert np.shares_memory(b.stubs, store._cols['stubs'])
+
+
+def test_database_bblock_store(bbdb, tmpdir):
+    dbfile = os.path.join(dirname(__file__), '../data/test_db_file.json')
+    pp = BBlockDB(cachedir=str(tmpdir), bakerdb_files=[dbfile])
+    for f in bbdb.query_names('all'):
+        pp._bblock_cache[f] = bbdb.bblock(f)
+    assert pp.build_bblock_store() == 12
+    pp2 = BBlockDB(cachedir=str(tmpdir), bakerdb_files=[dbfile], lazy=False)
+    assert pp2.n_missing_entries == 0
+    assert len(pp2.query('all')) == 12
+
+
+def test_database_bundle(bbdb, tmpdir, monkeypatch):
+    dbfile = os.path.join(dirname(__file__), '../data/test_db_file.json')
+    pp = BBlockDB(cachedir=str(tmpdir.join('a')), bakerdb_files=[dbfile])
+    for f in bbdb.query_names('all'):
+        pp._bblock_cache[f] = bbdb.bblock(f)
+    bundle = str(tmpdir.join('test.bundle'))
+    assert pp.export_bundle(bundle) == 12
+    assert len(BBlockBundle(bundle)) == 12
+    cachedir = tmpdir.join('b')
+    pp2 = BBlockDB(cachedir=str(cachedir), bundle=bundle, lazy=False)
+    assert not cachedir.exists()
+    assert pp2.n_missing_entries == 0
+    assert len(pp2.query('all')) == 12
+    for f in bbdb.query_names('all'):
+        assert np.all(pp2.bblock(f).stubs == bbdb.bblock(f).stubs)
+        assert np.all(pp2.bblock(f).connections == bbdb.bblock(f).connections)
+
+    # file names are stored unexpanded and resolved where the bundle is opened
+    assert all(e['file'].startswith('__DATADIR__/')
+               for e in BBlockBundle(bundle).entries)
+    monkeypatch.chdir(str(tmpdir))
+    pp3 = BBlockDB(cachedir=str(tmpdir.join('c')), bundle=bundle, lazy=False)
+    assert pp3.n_missing_entries == 0
+    ref = {os.path.basename(f): f for f in bbdb.query_names('all')}
+    for f in pp3.query_names('all'):
+        assert os.path.exists(f)
+        assert np.all(pp3.bblock(f).stubs == bbdb.bblock(
+            ref[os.path.basename(f)]).stubs)
+
+
+@nb.njit
+def _bblock_set_nres(bbset):
+    nres = 0
+    for i in range(bbset.len):
+        bb = bbset.bblock(i)
+        nres += len(bb.ncac)
+        assert len(bb.ncac) == len(bbset.block_stubs(i))
+    return nres
+
+
+def test_bblock_set(bbdb, tmpdir):
+    bbs = bbdb.query('all')
+    bbset = bbdb.query('all', as_set=True)
+    assert bbset.len == len(bbs)
+    assert _bblock_set_nres(bbset) == sum(len(bb.ncac) for bb in bbs)
+    for i, bb in enumerate(bbs):
+        bb2 = bbset.bblock(i)
+        for a, b in zip(bb._state, bb2._state):
+            assert np.all(a == b)
+        assert np.all(bbset.block_connections(i) == bb.connections)
+        assert np.all(bbset.block_chains(i) == bb.chains)
+    write_bblock_store(tmpdir, {bytes(bb.file).decode(): bb for bb in bbs})
+    store = BBlockStore(tmpdir)
+    storeset = store.bblock_set()
+    assert _bblock_set_nres(storeset) == _bblock_set_nres(bbset)
+    ifile = store.index[bytes(bbs[0].file).decode()]
+    assert np.all(storeset.block_ncac(ifile) == bbs[0].ncac)
+
+
+def test_shared_bblock_pool(bbdb):
+    bbs = bbdb.query('all')
+    with SharedBBlockPool(bbs) as pool:
+        assert len(pool) == len(bbs)
+        pool2 = pickle.loads(pickle.dumps(pool))
+        assert len(pickle.dumps(pool)) < 1000
+        for i, bb in enumerate(bbs):
+            bb2 = pool2.bblock(i)
+            assert np.all(bb2.ncac == bb.ncac)
+            assert np.all(bb2.stubs == bb.stubs)
+            assert np.all(bb2.connections == bb.connections)
+            assert bytes(bb2.file) == bytes(bb.file)
+        del bb2, pool2
+
+
+def test_shared_bblock_pool_other_process(bbdb):
+    # a process that is not a child of the creator has its own
+    # resource_tracker, which must not unlink the segments when it exits
+    bbs = bbdb.query('all')
+    code = ('import pickle, sys; pool = pickle.load(sys.stdin.buffer); '
+            'print(len(pool.bblock(0).ncac))')
+    with SharedBBlockPool(bbs) as pool:
+        proc = subprocess.run([sys.executable, '-c', code],
+                              input=pickle.dumps(pool), capture_output=True,
+                              env=dict(os.environ,
+                                       PYTHONPATH=os.pathsep.join(sys.path)))
+        assert proc.returncode == 0, proc.stderr
+        assert int(proc.stdout.split()[-1]) == len(bbs[0].ncac)
+        assert b'leaked' not in proc.stderr
+        pool2 = pickle.loads(pickle.dumps(pool))
+        assert np.all(pool2.bblock(0).ncac == bbs[0].ncac)
+        del pool2
+
+
+def test_pdb_meta(tmpdir):
+    pdbfile = str(tmpdir.join('test.pdb'))
+    with open(pdbfile, 'w') as out:
+        out.write('ATOM      1  N   ALA A   1\n')
+    entry = dict(file=pdbfile, connections=[])
+    meta = pdb_meta(pdbfile, entry)
+    assert pdb_meta(pdbfile, entry, meta) == meta
+    # pdb is only rehashed if mtime or size change
+    lazy = pdb_meta(pdbfile, entry, dict(meta, pdb_hash='notahash'))
+    assert lazy['pdb_hash'] == 'notahash'
+    entry2 = dict(entry, connections=[{'direction': 'N'}])
+    assert pdb_meta(pdbfile, entry2, meta)['key'] != meta['key']
+    with open(pdbfile, 'w') as out:
+        out.write('ATOM      1  N   GLY A   1\n')
+    os.utime(pdbfile, (0, meta['pdb_mtime'] + 10))
+    assert pdb_meta(pdbfile, entry, meta)['key'] != meta['key']
+
+
+def test_database_stale_cache(bbdb, tmpdir, datadir):
+    dbfile = os.path.join(datadir, 'test_db_file.json')
+    pp = BBlockDB(cachedir=str(tmpdir), bakerdb_files=[dbfile])
+    pdbfile = pp.query_names('all')[0]
+    meta = pdb_meta(pdbfile, pp.dictdb[pdbfile])
+    state = bbdb.bblock(pdbfile)._state
+    with open(pp.bblockfile(pdbfile), 'wb') as out:
+        pickle.dump(dict(meta=meta, state=state), out)
+    assert pp.load_cached_bblock_into_memory(pdbfile)
+
+    pp = BBlockDB(cachedir=str(tmpdir), bakerdb_files=[dbfile])
+    pp.dictdb[pdbfile]['connections'] = pp.dictdb[pdbfile]['connections'][:1]
+    assert not pp.load_cached_bblock_into_memory(pdbfile)
+    with pytest.raises(ValueError):
+        pp.bblock(pdbfile)
+
+
+def test_database_bblock_cache_budget(bbdb, datadir):
+    files = bbdb.query_names('all')
+    budget = 3 * max(bblock_nbytes(bbdb.bblock(f)) for f in files)
+    pp = BBlockDB(
+        cachedir=bbdb.cachedir,
+        bakerdb_files=[os.path.join(datadir, 'test_db_file.json')],
+        bblock_cache_bytes=budget)
+    for i in range(2):
+        for f in files:
+            for x, y in zip(pp.bblock(f)._state, bbdb.bblock(f)._state):
+                assert np.all(x == y)
+    stats = pp.cache_stats()['bblock']
+    assert stats['nbytes'] <= budget
+    assert stats['nitems'] < len(files)
+    assert stats['evictions'] > 0
+    assert stats['misses'] == stats['evictions'] + stats['nitems']
+
+
+@only_if_pyrosetta
+def test_construct_database_compact_poses(tmpdir, datadir):
+    pp = BBlockDB(
+        cachedir=str(tmpdir),
+        bakerdb_files=[os.path.join(datadir, 'test_db_file.json')],
+        lazy=False,
+        read_new_pdbs=True,
+        pose_format='compact',
+        progressbar=False)
+    for f in pp.query_names('all'):
+        assert pp.posefile(f).endswith('.npz')
+        assert len(pp.compact_pose(f).resnames) == len(pp.pose(f))
+        pp.load_cached_pose_into_memory(f)
+        assert np.allclose(
+            util.get_bb_coords(pp.pose(f)), pp.bblock(f).ncac, atol=1e-3)
+
+
+@only_if_pyrosetta
+def test_read_new_pdb_return_pose(tmpdir, datadir):
+    with open(os.path.join(datadir, 'test_db_file.json')) as inp:
+        entry = json.load(inp)[0]
+    entry['file'] = entry['file'].replace('__DATADIR__', datadir)
+    bbfile, posefile = str(tmpdir.join('bblock')), str(tmpdir.join('pose'))
+    pdbfile, bbstate, posedata, meta = _read_new_pdb(
+        entry, bbfile, posefile, return_pose=False
+    )
+    assert bbstate is not None and posedata is None
+    assert os.path.exists(posefile)
+
+
+def test_construct_database_numpy_reader(bbdb, tmpdir, datadir):
+    pp = BBlockDB(
+        cachedir=str(tmpdir),
+        bakerdb_files=[os.path.join(datadir, 'test_db_file.json')],
+        lazy=False,
+        read_new_pdbs=True,
+        pdb_reader='numpy',
+        progressbar=False)
+    assert pp.n_new_entries == 12
+    assert not os.listdir(str(tmpdir.join('poses')))
+    for f in pp.query_names('all'):
+        bb, ref = pp.bblock(f), bbdb.bblock(f)
+        assert np.all(bb.chains == ref.chains)
+        assert np.all(bb.connections == ref.connections)
+        assert np.allclose(bb.stubs, ref.stubs, atol=1e-3)
+
+
+def test_numpy_reader_rejects_load_poses(tmpdir, datadir):
+    with pytest.raises(ValueError):
+        BBlockDB(
+            cachedir=str(tmpdir),
+            bakerdb_files=[os.path.join(datadir, 'test_db_file.json')],
+            load_poses=True,
+            read_new_pdbs=True,
+            pdb_reader='numpy',
+            progressbar=False)
+    assert not os.path.exists(str(tmpdir.join('poses')))
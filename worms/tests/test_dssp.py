@@ -0,0 +1,56 @@
+import os
+import json
+import numpy as np
+from worms.dssp import *
+from worms.dssp import _assign
+from worms.pdbio import read_backbone
+from worms.tests import only_if_pyrosetta
+
+
+def test_backbone_o_h(datadir):
+    pdbfile = os.path.join(datadir, 'c2.pdb')
+    ncac, chains = read_backbone(pdbfile)
+    o, h, has_h = backbone_o_h(ncac, chains)
+    with open(pdbfile) as inp:
+        ref = np.array([[float(l[30 + 8 * k:38 + 8 * k]) for k in range(3)]
+                        for l in inp
+                        if l.startswith('ATOM') and l[12:16] == ' O  '])
+    notlast = np.ones(len(ncac), dtype='?')
+    notlast[[e - 1 for b, e in chains]] = False
+    assert np.all(np.linalg.norm(o - ref, axis=-1)[notlast] < 0.2)
+    assert list(np.flatnonzero(~has_h)) == [b for b, e in chains]
+
+
+def test_dssp_helix_loop(datadir):
+    ss = dssp(*read_backbone(os.path.join(datadir, 'curved_helix.pdb')))
+    assert ss == 'LHHHHHHHHHHHL'
+    ss = dssp(*read_backbone(os.path.join(datadir, 'c3.pdb')))
+    assert ss == 'LHHHHHHHLLHHHHHHHLLHHHHHHHL'
+    assert dssp(*read_backbone(os.path.join(datadir, 'loop.pdb'))) == 'L' * 8
+
+
+def test_dssp_bridges():
+    n = 20
+    chain = np.zeros(n, dtype='i4')
+    hb = np.zeros((n, n), dtype='?')
+    for i in range(2, 8, 2):  # antiparallel hairpin
+        hb[i, 19 - i] = hb[19 - i, i] = True
+    ss = ''.join('LHE'[x] for x in _assign(hb, chain))
+    assert ss == 'LLEEEEELLLLLLEEEEELL'
+    hb = np.zeros((n, n), dtype='?')
+    for i in range(2, 8, 2):  # parallel
+        hb[i - 1, i + 10] = hb[i + 10, i + 1] = True
+    ss = ''.join('LHE'[x] for x in _assign(hb, chain))
+    assert ss == 'LLEEEEELLLLLEEEEELLL'
+
+
+@only_if_pyrosetta
+def test_dssp_rosetta_agreement(datadir):
+    with open(os.path.join(datadir, 'test_db_file.json')) as inp:
+        pdbfiles = sorted({
+            e['file'].replace('__DATADIR__', datadir)
+            for e in json.load(inp)
+        })
+    agree = rosetta_agreement(pdbfiles)
+    assert np.mean([a[0] for a in agree.values()]) > 0.9
+    assert min(a[0] for a in agree.values()) > 0.75
@@ -1,6 +1,12 @@
 from worms import Vertex
+from worms.vertex import vertex_append
 from worms.tests import only_if_jit
 from worms.edge import *
+from worms.edge import _jit_splice_metrics, _atom_grid, _block_grids
+from worms.edge import _block_grid
+from worms.edge import _load_splice_metrics, _save_splice_metrics
+from worms.edge import _shard_segments, _splice_window_indices
+import concurrent.futures as cf
 import numba as nb
 import numba.types as nt
 import numpy as np
@@ -20,6 +26,218 @@ def test_splice_metrics_run(bbdb):
                 m = splice_metrics(u, bbs, v, bbs)
 
 
+def test_splice_metrics_parallel(bbdb):
+    bbs = bbdb.query('all')
+    u = Vertex(bbs, '_C')
+    v = Vertex(bbs, 'N_')
+    m = splice_metrics(u, bbs, v, bbs, skip_on_fail=False)
+    mp = splice_metrics(u, bbs, v, bbs, skip_on_fail=False, parallel=True)
+    for a, b in zip(m, mp):
+        assert np.all(a == b)
+
+
+def _splice_metrics_by_block_pair(u, ublks, v, vblks, **kw):
+    """reference splice_metrics, one _jit_splice_metrics call per pair"""
+    outidx = [
+        np.where(u.inout[:, 1] == i)[0][0]
+        for i in range(np.max(u.inout[:, 1]) + 1)
+    ]
+    outblk, outres = u.ibblock[outidx], u.ires[outidx, 1]
+    inblk = v.ibblock[v.inbreaks[:-1]]
+    inres = v.ires[v.inbreaks[:-1], 0]
+    shape = len(outblk), len(inblk)
+    rms, nclash, ncontact = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for iblk0 in np.unique(outblk):
+        for iblk1 in np.unique(inblk):
+            rows = np.flatnonzero(outblk == iblk0)
+            cols = np.flatnonzero(inblk == iblk1)
+            blk0, blk1 = ublks[iblk0], vblks[iblk1]
+            if u.dirn[1] == 1:
+                m = _jit_splice_metrics(
+                    blk0.chains, blk1.chains, blk0.ncac, blk1.ncac,
+                    blk0.stubs, blk1.stubs, outres[rows], inres[cols], **kw
+                )
+            else:  # exits of u are N-terminal
+                m = _jit_splice_metrics(
+                    blk1.chains, blk0.chains, blk1.ncac, blk0.ncac,
+                    blk1.stubs, blk0.stubs, inres[cols], outres[rows], **kw
+                )
+                m = [x.T for x in m]
+            rms[np.ix_(rows, cols)] = m[0]
+            nclash[np.ix_(rows, cols)] = m[1]
+            ncontact[np.ix_(rows, cols)] = m[2]
+    return rms, nclash, ncontact
+
+
+@only_if_jit
+def test_splice_metrics_kernel_vs_block_pairs(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    for udirn, vdirn in (('_C', 'N_'), ('_N', 'C_')):
+        u = Vertex(bbs, udirn)
+        v = Vertex(bbs, vdirn)
+        for skip in (True, False):
+            rms, nclash, ncontact = _splice_metrics_by_block_pair(
+                u, bbs, v, bbs, skip_on_fail=skip
+            )
+            assert np.sum(nclash >= 0) > 10
+            for parallel in (False, True):
+                m = splice_metrics(
+                    u, bbs, v, bbs, skip_on_fail=skip, parallel=parallel
+                )
+                assert np.all(m.rms == rms.astype('f4'))
+                assert np.all(m.nclash == nclash)
+                assert np.all(m.ncontact == ncontact)
+
+
+@only_if_jit
+def test_splice_metrics_rms_gemm(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    for udirn, vdirn in (('_C', 'N_'), ('_N', 'C_')):
+        u = Vertex(bbs, udirn)
+        v = Vertex(bbs, vdirn)
+        for skip in (True, False):
+            m = splice_metrics(
+                u, bbs, v, bbs, skip_on_fail=skip, rms_gemm=True
+            )
+            ref = splice_metrics(u, bbs, v, bbs, skip_on_fail=skip)
+            assert np.sum(ref.rms > 0) > 100
+            assert np.allclose(m.rms, ref.rms, atol=1e-4)
+            assert np.all(m.nclash == ref.nclash)
+            assert np.all(m.ncontact == ref.ncontact)
+
+
+def test_splice_window_index():
+    rng = np.random.default_rng(0)
+    w0 = rng.normal(size=(300, 30))
+    w1 = np.concatenate([w0[:100] + rng.normal(scale=0.2, size=(100, 30)),
+                         rng.normal(size=(200, 30))])
+    i0, i1, rms = SpliceWindowIndex(w1, ndim=4).query(w0, 1.0)
+    ref = np.sqrt(np.sum((w0[:, None] - w1[None])**2, axis=2) / 10)
+    assert np.sum(ref <= 1.0) >= 100
+    assert len(rms) == np.sum(ref <= 1.0)
+    assert np.all(ref[i0, i1] <= 1.0)
+    assert np.allclose(rms, ref[i0, i1])
+
+
+@only_if_jit
+def test_splice_metrics_rms_index(bbdb_fullsize_prots):
+    bbs = bbdb_fullsize_prots.query('all')
+    for udirn, vdirn in (('_C', 'N_'), ('_N', 'C_')):
+        u = Vertex(bbs, udirn)
+        v = Vertex(bbs, vdirn)
+        for rms_cut in (1.1, 3.0):
+            m = splice_metrics(u, bbs, v, bbs, rms_cut=rms_cut, rms_index=True)
+            ref = splice_metrics(u, bbs, v, bbs, rms_cut=rms_cut)
+            ok = ref.rms <= rms_cut
+            assert np.sum(ok) > 10
+            assert np.all((m.rms <= rms_cut) == ok)
+            assert np.allclose(m.rms[ok], ref.rms[ok], atol=1e-4)
+            assert np.all(m.nclash[ok] == ref.nclash[ok])
+            assert np.all(m.ncontact[ok] == ref.ncontact[ok])
+    with pytest.raises(ValueError):
+        splice_metrics(u, bbs, v, bbs, skip_on_fail=False, rms_index=True)
+
+
+@only_if_jit
+def test_splice_metrics_rms_index_reuse(bbdb_fullsize_prots, tmpdir):
+    bbs = bbdb_fullsize_prots.query('all')
+    u, v = Vertex(bbs, '_C'), Vertex(bbs, 'N_')
+    ref = splice_metrics(u, bbs, v, bbs, rms_index=True)
+    # the index of v's library is built once
+    hits = _splice_window_indices.hits
+    m = splice_metrics(u, bbs, v, bbs, rms_index=True)
+    assert _splice_window_indices.hits == hits + 1
+    for a, b in zip(ref, m):
+        assert np.all(a == b)
+    # cached pairs leave missing ones that are not all pairs of their blocks
+    kw = dict(rms_index=True, cachedir=str(tmpdir))
+    sub = bbs[:2]
+    splice_metrics(Vertex(sub, '_C'), sub, Vertex(sub, 'N_'), sub, **kw)
+    m = splice_metrics(u, bbs, v, bbs, **kw)
+    for a, b in zip(ref, m):
+        assert np.all(a == b)
+
+
+def test_splice_metrics_cache(bbdb, tmpdir):
+    bbs = bbdb.query('all')
+    before = splice_metrics_cache_stats.copy()
+    kw = dict(skip_on_fail=False, cachedir=str(tmpdir))
+
+    def ncount(what):
+        return splice_metrics_cache_stats[what] - before[what]
+
+    def npairs(u, v):
+        return len(set(u.ibblock)) * len(set(v.ibblock))
+
+    u, v = Vertex(bbs, '_C'), Vertex(bbs, 'N_')
+    ref = splice_metrics(u, bbs, v, bbs, skip_on_fail=False)
+
+    # a smaller library, its block pairs are reused by the full one
+    usub = Vertex(bbs[:2], '_C')
+    m0 = splice_metrics(usub, bbs[:2], v, bbs, **kw)
+    assert ncount('miss') == npairs(usub, v) and ncount('hit') == 0
+    assert len(m0.rms) < len(ref.rms)
+    for a, b in zip(ref, m0):
+        assert np.all(a[:len(b)] == b)
+    m1 = splice_metrics(u, bbs, v, bbs, **kw)
+    assert ncount('hit') == npairs(usub, v)
+    assert ncount('miss') == npairs(u, v)
+    shards = tmpdir.join('splice_metrics').listdir(lambda f: f.isdir())
+    assert 0 < len(shards) <= min(npairs(u, v), 256)
+    assert all(len(f.basename) == 2 for f in shards)
+    # the second call appended a segment for the pairs it computed
+    assert all(len(_shard_segments(str(f))) <= 2 for f in shards)
+    m2 = splice_metrics(u, bbs, v, bbs, **kw)
+    assert ncount('hit') == npairs(usub, v) + npairs(u, v)
+    assert ncount('miss') == npairs(u, v)
+    for a, b, c in zip(ref, m1, m2):
+        assert np.all(a == b)
+        assert np.all(a == c)
+
+    # same block pairs and residues the other way round
+    nhit = ncount('hit')
+    u, v = Vertex(bbs, '_N'), Vertex(bbs, 'C_')
+    ref = splice_metrics(u, bbs, v, bbs, skip_on_fail=False)
+    m = splice_metrics(u, bbs, v, bbs, **kw)
+    assert ncount('hit') == nhit + npairs(u, v)
+    for a, b in zip(ref, m):
+        assert np.all(a == b)
+
+    nmiss = ncount('miss')
+    splice_metrics(u, bbs, v, bbs, rms_range=7, **kw)
+    assert ncount('miss') == nmiss + npairs(u, v)
+
+
+def _save_entries(cachedir, keys, max_segments):
+    import worms.edge
+    worms.edge._SPLICE_METRICS_MAX_SEGMENTS = max_segments
+    _save_splice_metrics(cachedir, {
+        k: (np.full((2, 3), i, 'f4'), np.zeros((2, 3), 'i4'),
+            np.ones((2, 3), 'i4'))
+        for i, k in enumerate(keys)
+    })
+
+
+def test_splice_metrics_cache_concurrent(tmpdir):
+    cachedir = str(tmpdir)
+    # all in shard 00, written by concurrent processes in small batches
+    keys = ['00%038x' % i for i in range(64)]
+    with cf.ProcessPoolExecutor(4) as pool:
+        futures = [
+            pool.submit(_save_entries, cachedir, keys[i:i + 4], 3)
+            for i in range(0, len(keys), 4)
+        ]
+        for f in futures:
+            f.result()
+    segments = _shard_segments(str(tmpdir.join('splice_metrics', '00')))
+    assert 0 < len(segments) <= 3 + 4
+    found = _load_splice_metrics(cachedir, keys + ['00' + 'f' * 38])
+    assert sorted(found) == keys
+    for i, k in enumerate(keys):
+        assert np.all(found[k][0] == i % 4)
+        assert np.all(found[k][2] == 1)
+
+
 @only_if_jit
 def test_splice_metrics_fullsize_prots(bbdb_fullsize_prots):
     bbs = bbdb_fullsize_prots.query('all')
@@ -51,6 +269,50 @@ def test_splice_metrics_fullsize_prots(bbdb_fullsize_prots):
     assert nrms == 36
 
 
+def test_block_grids(bbdb):
+    bbs = bbdb.query('all')
+    offsets, ncac, _, _, _, _, _ = BBlockSet(bbs)._state
+    build = np.arange(len(bbs)) % 2 == 0
+    grids = _block_grids(offsets, ncac, build, 1, 3, 10.0)
+    for iblk, bb in enumerate(bbs):
+        grid = _block_grid(grids, iblk)
+        xyz = bb.ncac.reshape(-1, 4)[:len(bb.ncac) * 3 * build[iblk]]
+        for a, b in zip(grid, _atom_grid(xyz, 1, 3, 10.0)):
+            assert np.all(a == b)
+
+
+@only_if_jit
+@pytest.mark.parametrize('clashd2', [9.0, 0.0])
+def test_jit_splice_metrics_clash_contact(bbdb_fullsize_prots, clashd2):
+    blk0, blk1 = bbdb_fullsize_prots.query('all')[:2]
+    aln0s = np.arange(10, len(blk0.ncac) - 10, 7)
+    aln1s = np.arange(10, len(blk1.ncac) - 10, 5)
+    R = 25  # windows run off the ends of the blocks for some alns
+    rms, nclash, ncontact = _jit_splice_metrics(
+        blk0.chains, blk1.chains, blk0.ncac, blk1.ncac, blk0.stubs,
+        blk1.stubs, aln0s, aln1s, clashd2=clashd2, clash_contact_range=R,
+        skip_on_fail=False
+    )
+    ncac0 = blk0.ncac.reshape(-1, 4)
+    ncac1 = blk1.ncac.reshape(-1, 4)
+    ntested = 0
+    for i0, aln0 in enumerate(aln0s):
+        for i1, aln1 in enumerate(aln1s):
+            if nclash[i0, i1] < 0: continue
+            xaln = blk0.stubs[aln0] @ np.linalg.inv(blk1.stubs[aln1])
+            ia = np.arange(max(0, 3 * aln0 - 3 * R), 3 * aln0)
+            ib = np.arange(3 * aln1 + 3, min(3 * aln1 + 3 * R + 3, len(ncac1)))
+            b = ncac1[ib] @ xaln.T
+            d2 = np.sum((ncac0[ia, None] - b[None])**2, axis=-1)
+            ca = (ia[:, None] % 3 == 1) & (ib[None] % 3 == 1)
+            assert nclash[i0, i1] == np.sum(d2 < clashd2)
+            assert ncontact[i0, i1] == np.sum(
+                ca & (d2 >= clashd2) & (d2 < 100)
+            )
+            ntested += 1
+    assert ntested > 100
+
+
 @only_if_jit
 def test_edge_fullsize_prots(bbdb_fullsize_prots):
     bbs = bbdb_fullsize_prots.query('all')
@@ -87,3 +349,21 @@ def test_edge_fullsize_prots(bbdb_fullsize_prots):
     assert np.all(e.allowed_entries(21) == [0, 58])
     assert np.all(e.allowed_entries(22) == [1, 57, 59, 60])
     assert np.all(e.allowed_entries(23) == [20, 58, 59, 60])
+
+
+@only_if_jit
+def test_edge_append(bbdb_fullsize_prots):
+    # fullsize2 first, only it has a C terminal site
+    bbs = bbdb_fullsize_prots.query('all')[::-1]
+    for udirn, vdirn in (('_C', 'N_'), ('_N', 'C_')):
+        u_old = Vertex(bbs[:1], udirn)
+        v_old = Vertex(bbs[:1], vdirn)
+        u = vertex_append(u_old, bbs[1:], [1])
+        v = vertex_append(v_old, bbs[1:], [1])
+        assert u.len > u_old.len or v.len > v_old.len
+        e_old = Edge(u_old, bbs, v_old, bbs)
+        e = edge_append(e_old, u_old, u, bbs, v_old, v, bbs)
+        full = Edge(Vertex(bbs, udirn), bbs, Vertex(bbs, vdirn), bbs)
+        assert e.len == np.max(u.exit_index) + 1
+        assert full.total_allowed_splices() > 0
+        assert np.all(e.splices == full.splices)
@@ -0,0 +1,55 @@
+import os
+import numpy as np
+from worms.pdbio import *
+from worms.tests import only_if_pyrosetta
+from worms import util
+
+
+def _pdb_to_cif(pdbfile, ciffile):
+    names = ('group_PDB id label_atom_id label_alt_id label_comp_id '
+             'Cartn_x Cartn_y Cartn_z auth_seq_id auth_asym_id '
+             'pdbx_PDB_model_num').split()
+    out = ['data_test', 'loop_'] + ['_atom_site.' + n for n in names]
+    with open(pdbfile) as inp:
+        for l in inp:
+            if not l.startswith('ATOM'): continue
+            out.append(' '.join([
+                'ATOM', l[6:11].strip(), l[12:16].strip(), '.', l[17:20],
+                l[30:38].strip(), l[38:46].strip(), l[46:54].strip(),
+                l[22:26].strip(), l[21], '1'
+            ]))
+    with open(ciffile, 'w') as out_:
+        out_.write('\n'.join(out + ['#', '']))
+
+
+def test_read_pdb_backbone(datadir):
+    ncac, chains = read_backbone(os.path.join(datadir, 'c3.pdb'))
+    assert ncac.shape == (27, 3, 4)
+    assert chains == [(0, 9), (9, 18), (18, 27)]
+    assert np.all(ncac[..., 3] == 1)
+    assert np.allclose(ncac[0, :, :3], [[0.758, -6.502, -8.267],
+                                        [0.373, -7.732, -7.571],
+                                        [1.128, -7.828, -6.217]])
+    ncac, chains = read_backbone(os.path.join(datadir, '3uc7A_clean.pdb'))
+    assert len(ncac) == 132 and len(chains) == 6
+
+
+def test_read_cif_backbone(datadir, tmpdir):
+    pdbfile = os.path.join(datadir, 'c4.pdb')
+    ciffile = str(tmpdir.join('c4.cif'))
+    _pdb_to_cif(pdbfile, ciffile)
+    ncac, chains = read_backbone(pdbfile)
+    ncac2, chains2 = read_backbone(ciffile)
+    assert chains == chains2
+    assert np.allclose(ncac, ncac2)
+
+
+@only_if_pyrosetta
+def test_read_backbone_matches_pose(datadir):
+    import pyrosetta
+    for name in ('c3.pdb', 'c6.pdb', 'fullsize1.pdb', '3uc7A_clean.pdb'):
+        pdbfile = os.path.join(datadir, name)
+        pose = pyrosetta.pose_from_file(pdbfile)
+        ncac, chains = read_backbone(pdbfile)
+        assert chains == util.get_chain_bounds(pose)
+        assert np.allclose(ncac, util.get_bb_coords(pose), atol=1e-3)
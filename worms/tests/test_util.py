@@ -41,6 +41,42 @@ def test_contig_idx_breaks():
     assert np.all(util.contig_idx_breaks(tst) == [0, 4, 8])
 
 
+def test_unique_key():
+    a = np.array([3, 3, 1, 3, 1, 0, 3], dtype='i4')
+    b = np.array([5, 5, 5, 2, 5, 5, 5], dtype='i4')
+    assert np.all(util.unique_key(a, b) == [0, 0, 1, 2, 1, 3, 0])
+    assert np.all(util.unique_key(a) == [0, 0, 1, 0, 1, 2, 0])
+    assert len(util.unique_key(a[:0], b[:0])) == 0
+    a = np.random.randint(0, 30, 1000)
+    b = np.random.randint(-5, 30, 1000)
+    first = dict()
+    for x in zip(a, b):
+        first.setdefault(x, len(first))
+    assert np.all(util.unique_key(a, b) == [first[x] for x in zip(a, b)])
+    # sparse keys go through the hash map
+    ref = [first[x] for x in zip(a, b)]
+    assert np.all(util.unique_key(a * 10**9, b * 10**9) == ref)
+    # key ranges whose product wraps around in int64
+    a = np.array([0, 2**32, 0, 2**32, 0], dtype='i8')
+    b = np.array([0, 0, 2**32, 2**32, 0], dtype='i8')
+    assert np.all(util.unique_key(a, b) == [0, 1, 2, 3, 0])
+    # (2**62 + 1) * 4 wraps to 4
+    a = np.array([0, 2**62, 0, 2**62], dtype='i8')
+    b = np.array([0, 3, 3, 3], dtype='i8')
+    assert np.all(util.unique_key(a, b) == [0, 1, 2, 1])
+
+
+def test_unique_key_pandas():
+    # timings are in examples/unique_key_benchmark.py
+    pd = pytest.importorskip('pandas')
+    a = np.random.randint(0, 100, 10000)
+    b = np.random.randint(0, 100, 10000)
+    key = util.unique_key(a, b)
+    mi = pd.MultiIndex.from_arrays([a, b])
+    ref = mi.drop_duplicates().get_indexer(mi)
+    assert np.all(key == ref)
+
+
 def test_numba_expand_array_if_needed_1d():
     ary0 = ary = np.arange(7)
     for i in range(7):
@@ -107,3 +143,77 @@ def test_numba_expand_array_if_needed_int32():
     assert ary.shape[0] >= 100
     assert np.all(ary[:len(ary0)] == ary0)
     assert np.all(ary[len(ary0):] == -1)
+
+
+def _locked_increment(fname, n):
+    for i in range(n):
+        with util.FileLock(fname):
+            with open(fname) as inp:
+                val = int(inp.read())
+            util.atomic_write(fname, str(val + 1).encode())
+
+
+def test_FileLock_atomic_write(tmpdir):
+    import multiprocessing
+    fname = str(tmpdir.join('counter'))
+    util.atomic_write(fname, b'0')
+    procs = [
+        multiprocessing.Process(target=_locked_increment, args=(fname, 50))
+        for i in range(4)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    with open(fname) as inp:
+        assert int(inp.read()) == 200
+    assert tmpdir.listdir() == [tmpdir.join('counter')]
+
+
+def test_FileLock_threads(tmpdir):
+    import threading
+    fname = str(tmpdir.join('counter'))
+    util.atomic_write(fname, b'0')
+    threads = [
+        threading.Thread(target=_locked_increment, args=(fname, 50))
+        for i in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(fname) as inp:
+        assert int(inp.read()) == 200
+
+
+def test_FileLock_stale_fallback(tmpdir):
+    import socket
+    fname = str(tmpdir.join('entry'))
+    lock = util.FileLock(fname)
+    with open(lock.lockfile + 'x', 'w') as out:
+        out.write('%s 999999999 0' % socket.gethostname())
+    assert lock.is_stale(lock.lockfile + 'x')
+    with open(lock.lockfile + 'x', 'w') as out:
+        out.write('otherhost 1 0')
+    assert not lock.is_stale(lock.lockfile + 'x')
+    lock.stale_after = -1
+    assert lock.is_stale(lock.lockfile + 'x')
+
+
+def test_LRUCache():
+    cache = util.LRUCache(max_bytes=10, sizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'yyyy'
+    assert cache.get('a') == 'xxxx'
+    cache['c'] = 'zzzz'
+    assert list(cache) == ['a', 'c']
+    assert cache.get('b') is None
+    assert cache.stats() == dict(
+        hits=1, misses=1, evictions=1, nitems=2, nbytes=8)
+    cache['big'] = 'q' * 50
+    assert list(cache) == ['big']
+    assert cache.evictions == 3
+    unbounded = util.LRUCache()
+    for i in range(100):
+        unbounded[i] = i
+    assert len(unbounded) == 100 and unbounded.evictions == 0
@@ -11,7 +11,7 @@ def test_Vertex_NC(bbdb):
     v = Vertex(bbs, 'NC')
     assert v.len == 55
     assert v.x2exit.shape == (55, 4, 4)
-    assert v.x2orig.shape == (55, 4, 4)
+    assert v.x2orig.shape == (18, 4, 4)
     assert v.inout.shape == (55, 2)
     assert v.ires.shape == (55, 2)
     assert v.isite.shape == (55, 2)
@@ -27,12 +27,122 @@ def test_Vertex_NC(bbdb):
         assert np.all(vals == i)
 
 
+def test_Vertex_parallel(bbdb):
+    bbs = bbdb.query('all')
+    v = Vertex(bbs, 'NC')
+    vp = Vertex(bbs, 'NC', parallel=1)
+    for a, b in zip(v._state, vp._state):
+        assert np.all(a == b)
+
+
+def test_Vertex_bblock_set(bbdb):
+    bbs = bbdb.query('all')
+    v = Vertex(bbs, 'NC', min_seg_len=15)
+    vs = Vertex(bbdb.query('all', as_set=True), 'NC', min_seg_len=15)
+    for a, b in zip(v._state, vs._state):
+        assert np.all(a == b)
+    assert v.len == 28
+    for i in range(v.len):
+        bb = bbs[v.ibblock[i]]
+        stub0, stub1 = bb.stubs[v.ires[i, 0]], bb.stubs[v.ires[i, 1]]
+        x2orig = v.x2orig[v.inout[i, 0]]
+        assert np.allclose(x2orig @ stub0, np.eye(4))
+        assert np.allclose(v.x2exit[i], x2orig @ stub1)
+        assert v.isite[i, 0] != v.isite[i, 1]
+        if v.ichain[i, 0] == v.ichain[i, 1]:
+            assert abs(v.ires[i, 0] - v.ires[i, 1]) >= 15
+
+
+def test_Vertex_cache(bbdb, tmpdir):
+    bbs = bbdb.query('all')
+    v = Vertex(bbs, 'NC')
+    vc = Vertex(bbs, 'NC', cachedir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    vl = Vertex(bbs, 'NC', cachedir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    for a, b, c in zip(v._state, vc._state, vl._state):
+        assert np.all(a == b)
+        assert np.all(a == c)
+    Vertex(bbs, 'NC', min_seg_len=15, cachedir=str(tmpdir))
+    Vertex(bbs, 'CN', cachedir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 3
+    v4 = Vertex(bbs, 'NC', cachedir=str(tmpdir), dtype=np.float32)
+    assert v4.x2exit.dtype == np.float32
+    assert len(tmpdir.listdir()) == 3
+    # coordinates alone change symmetric vertices, they are in the key
+    bbset = BBlockSet(bbs)
+    key = vertex_cache_key(bbset, 'NC', np.arange(bbset.len), 1)
+    bbset.ncac[0, 0, 0] += 1.0
+    assert vertex_cache_key(bbset, 'NC', np.arange(bbset.len), 1) != key
+
+
+def test_Vertex_lazy(bbdb):
+    bbs = bbdb.query('all')
+    for dirn in ('NC', '_C', 'N_'):
+        v = Vertex(bbs, dirn)
+        vl = Vertex(bbs, dirn, lazy=True)
+        assert not v.lazy and vl.lazy
+        assert vl.x2exit.shape == (0, 4, 4)
+        assert v.exit_stub.shape == (0, 4, 4)
+        assert vl.exit_stub.shape == (np.max(v.inout[:, 1]) + 1, 4, 4)
+        assert np.all(v.x2orig == vl.x2orig)
+        assert np.all(v.inout == vl.inout)
+        for i in range(v.len):
+            assert np.allclose(vl.vertex_x2exit(i), v.x2exit[i])
+
+
+def test_Vertex_symmetric(bbdb):
+    bbs = bbdb.query('all')
+    files = [bytes(bb.file).decode() for bb in bbs]
+    ic3het = [i for i, f in enumerate(files) if f.endswith('c3het.pdb')][0]
+    assert cyclic_symmetry(bbs[ic3het].ncac, bbs[ic3het].chains) == 3
+    for dirn in ('NC', 'N_', '_C'):
+        v = Vertex(bbs, dirn)
+        vs = Vertex(bbs, dirn, symmetric=True)
+        assert vs.symmetric and not v.symmetric
+        # every row is in exactly one orbit
+        orbits = vs.orbit[vs.orbit >= 0]
+        assert np.all(np.sort(orbits) == np.arange(v.len))
+        for i in range(vs.len):
+            orbit = vs.orbit[i][vs.orbit[i] >= 0]
+            assert np.all(v.ibblock[orbit] == vs.ibblock[i])
+            assert v.orbit_size(i) == 1 and v.orbit_row(i, 0) == i
+            assert vs.orbit_size(i) == len(orbit)
+            assert vs.orbit_row(i, len(orbit) - 1) == orbit[-1]
+            # representatives keep their own geometry, members are rotated
+            x2orig = v.x2orig[v.entry_index[orbit]]
+            assert np.all(x2orig[0] == vs.vertex_x2orig(i))
+            if len(orbit) > 1:
+                assert not np.allclose(x2orig[1:], x2orig[0], atol=0.1)
+            if dirn[1] != '_':
+                assert np.allclose(v.x2exit[orbit], vs.x2exit[i], atol=1e-2)
+        nc3het = np.sum(v.ibblock == ic3het)
+        if dirn[0] == '_':
+            assert vs.len == v.len
+        else:
+            assert np.sum(vs.ibblock == ic3het) * 3 == nc3het
+
+
+def test_vertex_append(bbdb):
+    bbs = bbdb.query('all')
+    for dirn in ('NC', '_C', 'N_'):
+        for kw in (dict(), dict(lazy=True), dict(symmetric=True),
+                   dict(dtype=np.float32)):
+            full = Vertex(bbs, dirn, min_seg_len=3, **kw)
+            v = Vertex(bbs[:5], dirn, min_seg_len=3, **kw)
+            v = vertex_append(v, bbs[5:], np.arange(5, len(bbs)), 3)
+            for a, b in zip(full._state, v._state):
+                assert a.dtype == b.dtype
+                assert a.shape == b.shape
+                assert np.all(a == b)
+
+
 def test_Vertex_CN(bbdb):
     bbs = bbdb.query('all')
     v = Vertex(bbs, 'CN')
     assert v.len == 55
     assert v.x2exit.shape == (55, 4, 4)
-    assert v.x2orig.shape == (55, 4, 4)
+    assert v.x2orig.shape == (25, 4, 4)
     assert v.inout.shape == (55, 2)
     assert v.ires.shape == (55, 2)
     assert v.isite.shape == (55, 2)
@@ -52,7 +162,7 @@ def test_Vertex__C(bbdb):
     v = Vertex(bbs, '_C')
     assert v.len == 25
     assert v.x2exit.shape == (25, 4, 4)
-    assert v.x2orig.shape == (25, 4, 4)
+    assert v.x2orig.shape == (12, 4, 4)
     assert np.all(v.x2orig == np.eye(4))
     assert v.inout.shape == (25, 2)
     assert v.ires.shape == (25, 2)
@@ -103,7 +213,7 @@ def test_Vertex__N(bbdb):
     v = Vertex(bbs, '_N')
     assert v.len == 18
     assert v.x2exit.shape == (18, 4, 4)
-    assert v.x2orig.shape == (18, 4, 4)
+    assert v.x2orig.shape == (12, 4, 4)
     assert v.inout.shape == (18, 2)
     assert v.ires.shape == (18, 2)
     assert v.isite.shape == (18, 2)
@@ -2,9 +2,15 @@
 """
 import os
 import re
+import time
+import errno
+import fcntl
+import socket
+import tempfile
 import functools as ft
 import itertools as it
 import operator
+from collections import OrderedDict
 import numpy as np
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
@@ -12,7 +18,6 @@ from concurrent.futures import as_completed as cf_as_completed
 import multiprocessing
 import threading
 from homog import hrot
-import pandas as pd
 import numba as nb
 try:
     # god, I'm so tired of this crap....
@@ -112,6 +117,244 @@ class NonFuture:
         return self._result
 
 
+def atomic_write(fname, data):
+    """write bytes to fname so readers never see a partial file
+
+    data goes to a temp file in the same directory which is then renamed
+    over fname
+
+    Args:
+        fname (str): destination
+        data (bytes): contents
+    """
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+
+# per lock file threading.Lock of FileLock, fcntl locks are per process
+_file_thread_locks = dict()
+_file_thread_locks_lock = threading.Lock()
+
+
+def _file_thread_lock(lockfile):
+    with _file_thread_locks_lock:
+        return _file_thread_locks.setdefault(
+            os.path.abspath(lockfile), threading.Lock()
+        )
+
+
+class FileLock:
+    """advisory lock guarding a single file, usable as a context manager
+
+    locks fname + '.lock' with fcntl.lockf, which the os drops if the holder
+    dies, so crashed jobs never leave a stale fcntl lock behind. fcntl locks
+    belong to the process, so threads of one process are excluded by a
+    threading.Lock per lock file held along with it. on
+    filesystems without fcntl locking, falls back to an O_EXCL lock file
+    holding host, pid and time, which is broken once the holding process is
+    gone or the file is older than stale_after seconds
+
+    Attributes:
+        fname (str): file being guarded
+        stale_after (float): age in seconds after which a fallback lock file
+            is considered stale
+        poll (float): seconds between attempts
+    """
+
+    def __init__(self, fname, stale_after=3600.0, poll=0.1):
+        self.fname = fname
+        self.lockfile = fname + '.lock'
+        self.stale_after = stale_after
+        self.poll = poll
+        self._fd = None
+        self._fallback = False
+        self._thread_lock = _file_thread_lock(self.lockfile)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _stamp(self):
+        return ('%s %i %f' % (socket.gethostname(), os.getpid(),
+                              time.time())).encode()
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            self._acquire_file()
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def _acquire_file(self):
+        while True:
+            fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            except OSError as e:
+                os.close(fd)
+                if e.errno not in (errno.ENOLCK, errno.EOPNOTSUPP,
+                                   errno.ENOSYS, errno.EINVAL):
+                    raise
+                self._fallback = True
+                return self._acquire_fallback()
+            try:  # file may have been removed by previous holder
+                same = os.fstat(fd).st_ino == os.stat(self.lockfile).st_ino
+            except FileNotFoundError:
+                same = False
+            if same:
+                os.ftruncate(fd, 0)
+                os.write(fd, self._stamp())
+                self._fd = fd
+                return
+            os.close(fd)
+
+    def _acquire_fallback(self):
+        lockfile = self.lockfile + 'x'
+        while True:
+            try:
+                fd = os.open(lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o666)
+                os.write(fd, self._stamp())
+                os.close(fd)
+                return
+            except FileExistsError:
+                if self.is_stale(lockfile):
+                    try:
+                        os.remove(lockfile)
+                    except FileNotFoundError:
+                        pass
+                    continue
+            time.sleep(self.poll)
+
+    def is_stale(self, lockfile):
+        """check if fallback lockfile was left by a dead or ancient job"""
+        try:
+            with open(lockfile) as inp:
+                host, pid, stamp = inp.read().split()
+            age = time.time() - os.path.getmtime(lockfile)
+        except (FileNotFoundError, ValueError):
+            return False  # gone or still being written
+        if age > self.stale_after:
+            return True
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return False
+
+    def release(self):
+        try:
+            if self._fallback:
+                os.remove(self.lockfile + 'x')
+                self._fallback = False
+            elif self._fd is not None:
+                # remove while still holding the lock, waiters notice via
+                # inode
+                os.remove(self.lockfile)
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            self._thread_lock.release()
+
+
+class LRUCache:
+    """dict-like cache with a byte budget and least-recently-used eviction
+
+    the most recently inserted item is never evicted, so a lookup right
+    after an insert always succeeds even if the item alone exceeds max_bytes
+
+    Attributes:
+        max_bytes (int): byte budget, None for unbounded
+        sizeof (callable): computes the size of a value in bytes
+        nbytes (int): current total size
+        hits (int): get calls that found their key
+        misses (int): get calls that did not
+        evictions (int): items dropped to stay within max_bytes
+    """
+
+    def __init__(self, max_bytes=None, sizeof=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda x: 0)
+        self._data = OrderedDict()
+        self._sizes = dict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self[key]
+        self._data[key] = value
+        self._sizes[key] = self.sizeof(value)
+        self.nbytes += self._sizes[key]
+        if self.max_bytes is not None:
+            while self.nbytes > self.max_bytes and len(self._data) > 1:
+                oldest = next(iter(self._data))
+                del self[oldest]
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            nitems=len(self),
+            nbytes=self.nbytes,
+        )
+
+
 def cpu_count():
     """TODO: Summary
 
@@ -703,20 +946,58 @@ def residue_sym_err(p, ang, ir, jr, n=1, axis=[0, 0, 1], verbose=0):
     return np.sqrt(mxdist)
 
 
+_PAIR_TYPE = nb.types.UniTuple(nb.types.int64, 2)
+
+
+@jit
+def _unique_key(a, b):
+    key = np.empty(len(a), dtype=np.int64)
+    if len(a) == 0: return key
+    amin, bmin = np.min(a), np.min(b)
+    na = np.int64(np.max(a)) - amin + 1
+    nb_ = np.int64(np.max(b)) - bmin + 1
+    n = 0
+    # na * nb_ can overflow int64, ranges that wrap around are negative
+    limit = max(4 * len(a), 1 << 20)
+    if 0 < na and 0 < nb_ and na <= limit // nb_:
+        # dense table, vertex keys (block, residue) are small ints
+        table = np.full(na * nb_, -1, dtype=np.int64)
+        for i in range(len(a)):
+            k = (a[i] - amin) * nb_ + b[i] - bmin
+            if table[k] < 0:
+                table[k] = n
+                n += 1
+            key[i] = table[k]
+    else:
+        seen = nb.typed.Dict.empty(key_type=_PAIR_TYPE,
+                                   value_type=nb.types.int64)
+        for i in range(len(a)):
+            pair = (np.int64(a[i]), np.int64(b[i]))
+            if pair not in seen:
+                seen[pair] = n
+                n += 1
+            key[i] = seen[pair]
+    return key
+
+
 def unique_key(a, b=None):
-    """Summary
+    """number distinct (a, b) pairs in order of first occurrence
+
+    like pandas MultiIndex.drop_duplicates().get_indexer, in jitted code.
+    a dense table is used if the key ranges are small, else a hash map
 
     Args:
-        a (TYPE): Description
-        b (TYPE): Description
+        a (np.ndarray): integer keys
+        b (np.ndarray, optional): second integer keys, same length as a
 
     Returns:
-        TYPE: Description
+        np.ndarray: int64 id of the (a[i], b[i]) pair, ids are 0, 1, ... in
+        order of first occurrence
     """
-    if b is None:
-        raise NotImplementedError
-    mi = pd.MultiIndex.from_arrays([a, b]).drop_duplicates()
-    return mi.get_indexer([a, b])
+    a = np.ascontiguousarray(a)
+    b = np.zeros_like(a) if b is None else np.ascontiguousarray(b)
+    assert a.shape == b.shape and a.ndim == 1
+    return _unique_key(a, b)
 
 
 @nb.njit('int32[:](int32[:])', nogil=1)
@@ -1,181 +1,738 @@
 """TODO: Summary
 """
 
+import os
+import json
+import itertools
+import contextlib
+import shutil
+import hashlib
+import tempfile
+
 import numpy as np
 import numba as nb
 import numba.types as nt
-from homog import is_homog_xform
 from worms import util
-from worms.bblock import chain_of_ires, _BBlock
+from worms.util import jit
+from worms.bblock_store import (BBlockSet, _BBlockSet, _OFST_RES,
+                                _OFST_CHAIN, _OFST_CONN, _OFST_CONN_NROW,
+                                _OFST_CONN_NCOL)
 from logging import warning
-import concurrent.futures as cf
-from worms.util import InProcessExecutor
-
-@nb.jitclass((
-    ('x2exit' , nt.float64[:, :, :]),
-    ('x2orig' , nt.float64[:, :, :]),
-    ('inout'  , nt.int32[:, :]),
-    ('inbreaks' , nt.int32[:]),
-    ('ires'   , nt.int32[:, :]),
-    ('isite'  , nt.int32[:, :]),
-    ('ichain' , nt.int32[:, :]),
-    ('ibblock'    , nt.int32[:]),
-    ('dirn'   , nt.int32[:]),
-))  # yapf: disable
-class _Vertex:
-    """contains data for one topological vertex in the topological graph
-
-    Attributes:
-        dirn (TYPE): Description
-        ibblock (TYPE): Description
-        ichain (TYPE): Description
-        inout (TYPE): Description
-        ires (TYPE): Description
-        isite (TYPE): Description
-        x2exit (TYPE): Description
-        x2orig (TYPE): Description
-    """
 
-    def __init__(self, x2exit, x2orig, ires, isite, ichain, ibblock, inout,
-                 inbreaks, dirn):
-        """TODO: Summary
 
-        Args:
-            x2exit (TYPE): Description
-            x2orig (TYPE): Description
-            ires (TYPE): Description
-            isite (TYPE): Description
-            ichain (TYPE): Description
+def _vertex_class(float_type):
+    """make the _Vertex jitclass with transforms of float_type"""
+
+    @nb.jitclass((
+        ('x2exit' , float_type[:, :, :]),
+        ('x2orig' , float_type[:, :, :]),
+        ('inout'  , nt.int32[:, :]),
+        ('inbreaks' , nt.int32[:]),
+        ('ires'   , nt.int32[:, :]),
+        ('isite'  , nt.int32[:, :]),
+        ('ichain' , nt.int32[:, :]),
+        ('ibblock'    , nt.int32[:]),
+        ('dirn'   , nt.int32[:]),
+        ('exit_stub', float_type[:, :, :]),
+        ('orbit'  , nt.int32[:, :]),
+    ))  # yapf: disable
+    class _Vertex:
+        """contains data for one topological vertex in the topological graph
+
+        Attributes:
+            dirn (TYPE): Description
             ibblock (TYPE): Description
+            ichain (TYPE): Description
             inout (TYPE): Description
-            dirn (TYPE): Description
-
-        Deleted Parameters:
-            bblock (TYPE): Description
-        """
-        self.x2exit = x2exit
-        self.x2orig = x2orig
-        self.ires = ires
-        self.isite = isite
-        self.ichain = ichain
-        self.ibblock = ibblock
-        self.inout = inout
-        self.inbreaks = inbreaks
-        self.dirn = dirn
-
-    @property
-    def entry_index(self):
-        return self.inout[:, 0]
-
-    @property
-    def exit_index(self):
-        return self.inout[:, 1]
-
-    def entry_range(self, ienter):
-        return self.inbreaks[ienter], self.inbreaks[ienter + 1]
-
-    @property
-    def len(self):
-        """Summary
-
-        Returns:
-            TYPE: Description
+            ires (TYPE): Description
+            isite (TYPE): Description
+            x2exit (TYPE): Description, empty if lazy
+            x2orig (TYPE): (nentry, 4, 4), one per entry, indexed by
+                entry_index. see vertex_x2orig
+            exit_stub (np.ndarray): (nexit, 4, 4) stub of each exit, indexed
+                by exit_index, only stored if lazy
+            orbit (np.ndarray): (len, nfold) rows of the uncompressed vertex
+                equivalent to each row, -1 padded, only stored if symmetric
         """
-        return len(self.ires)
 
-    @property
-    def _state(self):
-        return (self.x2exit, self.x2orig, self.ires, self.isite, self.ichain,
-                self.ibblock, self.inout, self.inbreaks, self.dirn)
+        def __init__(self, x2exit, x2orig, ires, isite, ichain, ibblock,
+                     inout, inbreaks, dirn, exit_stub, orbit):
+            """TODO: Summary
+
+            Args:
+                x2exit (TYPE): Description
+                x2orig (TYPE): Description
+                ires (TYPE): Description
+                isite (TYPE): Description
+                ichain (TYPE): Description
+                ibblock (TYPE): Description
+                inout (TYPE): Description
+                dirn (TYPE): Description
+                exit_stub (np.ndarray): exit stubs, empty unless x2exit is
+                orbit (np.ndarray): symmetry equivalent rows, may be empty
+
+            Deleted Parameters:
+                bblock (TYPE): Description
+            """
+            self.x2exit = x2exit
+            self.x2orig = x2orig
+            self.ires = ires
+            self.isite = isite
+            self.ichain = ichain
+            self.ibblock = ibblock
+            self.inout = inout
+            self.inbreaks = inbreaks
+            self.dirn = dirn
+            self.exit_stub = exit_stub
+            self.orbit = orbit
+
+        @property
+        def entry_index(self):
+            return self.inout[:, 0]
+
+        @property
+        def exit_index(self):
+            return self.inout[:, 1]
+
+        @property
+        def lazy(self):
+            return len(self.x2exit) == 0
+
+        @property
+        def symmetric(self):
+            return len(self.orbit) > 0
+
+        def vertex_x2orig(self, ivertex):
+            return self.x2orig[self.inout[ivertex, 0]]
+
+        def vertex_x2exit(self, ivertex):
+            """x2exit of ivertex, computed from the stubs if lazy"""
+            if len(self.x2exit):
+                return self.x2exit[ivertex]
+            return (self.x2orig[self.inout[ivertex, 0]]
+                    @ self.exit_stub[self.inout[ivertex, 1]])
+
+        def entry_range(self, ienter):
+            return self.inbreaks[ienter], self.inbreaks[ienter + 1]
+
+        def orbit_size(self, ivertex):
+            """number of uncompressed rows equivalent to ivertex"""
+            if len(self.orbit) == 0:
+                return 1
+            n = 0
+            while n < self.orbit.shape[1] and self.orbit[ivertex, n] >= 0:
+                n += 1
+            return n
+
+        def orbit_row(self, ivertex, imember):
+            """uncompressed row of member imember of the orbit of ivertex"""
+            if len(self.orbit) == 0:
+                return ivertex
+            return self.orbit[ivertex, imember]
+
+        @property
+        def len(self):
+            """Summary
+
+            Returns:
+                TYPE: Description
+            """
+            return len(self.ires)
+
+        @property
+        def _state(self):
+            return (self.x2exit, self.x2orig, self.ires, self.isite,
+                    self.ichain, self.ibblock, self.inout, self.inbreaks,
+                    self.dirn, self.exit_stub, self.orbit)
+
+    return _Vertex
+
+
+_VERTEX_FIELDS = ('x2exit', 'x2orig', 'ires', 'isite', 'ichain', 'ibblock',
+                  'inout', 'inbreaks', 'dirn', 'exit_stub', 'orbit')
+# bump when vertex construction changes, invalidates cached vertices
+_VERTEX_CACHE_VERSION = 4
+# max CA rms between chains of a block considered symmetric
+_SYMMETRY_RMS_TOL = 0.5
+
+_Vertex = _vertex_class(nt.float64)
+# single precision transforms, see vertex_astype
+_Vertex_f4 = _vertex_class(nt.float32)
+
+
+def vertex_from_state(state):
+    """_Vertex or _Vertex_f4 from _state, depending on transform dtype"""
+    if state[0].dtype == np.float32:
+        return _Vertex_f4(*state)
+    return _Vertex(*state)
+
+
+def vertex_astype(vertex, dtype):
+    """copy of vertex with x2exit, x2orig and exit_stub converted to dtype
 
+    Args:
+        vertex (_Vertex): vertex to convert
+        dtype (np.dtype): np.float64 or np.float32
 
-def vertex_single(bbstate, bbid, din, dout, min_seg_len):
-    """Summary
+    Returns:
+        _Vertex: a _Vertex_f4 if dtype is np.float32
+    """
+    state = list(vertex._state)
+    for i in (0, 1, _VERTEX_FIELDS.index('exit_stub')):
+        state[i] = np.ascontiguousarray(state[i], dtype)
+    return vertex_from_state(state)
+
+
+@jit
+def _conn_side(conn, dirn):
+    """residues and site numbers of all connections in direction dirn
+
+    dirn 2 (no connection) gives the single dummy residue -1 in site -1
+    """
+    if dirn == 2:
+        return np.full(1, -1, np.int32), np.full(1, -1, np.int32)
+    n = 0
+    for i in range(len(conn)):
+        if conn[i, 0] == dirn:
+            n += conn[i, 1] - 2
+    ires = np.empty(n, np.int32)
+    isite = np.empty(n, np.int32)
+    n = 0
+    for i in range(len(conn)):
+        if conn[i, 0] == dirn:
+            for j in range(2, conn[i, 1]):
+                ires[n] = conn[i, j]
+                isite[n] = i
+                n += 1
+    return ires, isite
+
+
+@jit
+def _chain_of(chains, ir):
+    if ir < 0: return -1
+    for c in range(len(chains)):
+        if chains[c, 0] <= ir < chains[c, 1]:
+            return c
+    return -1
+
+
+@jit
+def _block_pairs(offsets, chains, connections, iblk, din, dout, min_seg_len):
+    """valid (entry, exit) residue pairs of block iblk, entry major
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, bool): int32 (n, 2) ires, isite
+        and ichain, and False if the block has no connection in din or dout
+    """
+    conn = connections[offsets[iblk, _OFST_CONN]:offsets[iblk + 1,
+                                                           _OFST_CONN]]
+    conn = conn.reshape((offsets[iblk, _OFST_CONN_NROW],
+                         offsets[iblk, _OFST_CONN_NCOL]))
+    chains = chains[offsets[iblk, _OFST_CHAIN]:offsets[iblk + 1, _OFST_CHAIN]]
+    ires0, isite0 = _conn_side(conn, din)
+    ires1, isite1 = _conn_side(conn, dout)
+    if len(ires0) == 0 or len(ires1) == 0:
+        empty = np.empty((0, 2), np.int32)
+        return empty, empty, empty, False
+    n0, n1 = len(ires0), len(ires1)
+    ires = np.empty((n0 * n1, 2), np.int32)
+    isite = np.empty((n0 * n1, 2), np.int32)
+    ichain = np.empty((n0 * n1, 2), np.int32)
+    n = 0
+    for i in range(n0):
+        c0 = _chain_of(chains, ires0[i])
+        for j in range(n1):
+            # not same site, and different chains or long enough segment
+            if isite0[i] == isite1[j]: continue
+            c1 = _chain_of(chains, ires1[j])
+            if c0 == c1 and abs(ires0[i] - ires1[j]) < min_seg_len: continue
+            ires[n, 0], ires[n, 1] = ires0[i], ires1[j]
+            isite[n, 0], isite[n, 1] = isite0[i], isite1[j]
+            ichain[n, 0], ichain[n, 1] = c0, c1
+            n += 1
+    return ires[:n], isite[:n], ichain[:n], True
+
+
+@jit
+def _first_occurrence(vals):
+    """ids numbering the distinct vals in order of first occurrence
+
+    vals are residue numbers >= -1
+    """
+    ids = np.empty(len(vals), np.int32)
+    if len(vals) == 0: return ids, 0
+    seen = np.full(np.max(vals) + 2, -1, np.int32)
+    n = 0
+    for i in range(len(vals)):
+        if seen[vals[i] + 1] < 0:
+            seen[vals[i] + 1] = n
+            n += 1
+        ids[i] = seen[vals[i] + 1]
+    return ids, n
+
+
+def _vertex_counts(offsets, chains, connections, din, dout, min_seg_len):
+    """per block number of pairs, distinct entries and distinct exits
+
+    number of pairs is -1 for blocks lacking a connection in din or dout
+    """
+    nblk = len(offsets) - 1
+    counts = np.zeros((nblk, 3), np.int64)
+    for iblk in nb.prange(nblk):
+        ires, _, _, ok = _block_pairs(offsets, chains, connections, iblk,
+                                      din, dout, min_seg_len)
+        if not ok:
+            counts[iblk, 0] = -1
+            continue
+        counts[iblk, 0] = len(ires)
+        counts[iblk, 1] = _first_occurrence(ires[:, 0])[1]
+        counts[iblk, 2] = _first_occurrence(ires[:, 1])[1]
+    return counts
+
+
+def _vertex_fill(offsets, stubs, chains, connections, din, dout, min_seg_len,
+                 bbids, start, x2exit, x2orig, ires, isite, ichain, ibblock,
+                 inout, exit_stub):
+    """fill vertex arrays, block iblk goes to rows start[iblk, 0] on, its
+    entry and exit ids start at start[iblk, 1] and start[iblk, 2]. x2orig
+    has one row per entry, exit_stub one per exit. x2exit and exit_stub are
+    only filled if not empty"""
+    ident = np.eye(4)
+    for iblk in nb.prange(len(offsets) - 1):
+        bires, bisite, bichain, ok = _block_pairs(
+            offsets, chains, connections, iblk, din, dout, min_seg_len)
+        if len(bires) == 0: continue
+        ientry = _first_occurrence(bires[:, 0])[0]
+        iexit = _first_occurrence(bires[:, 1])[0]
+        res0 = offsets[iblk, _OFST_RES]
+        nentry, nexit = 0, 0
+        for k in range(len(bires)):
+            i = start[iblk, 0] + k
+            e = start[iblk, 1] + ientry[k]
+            ir0, ir1 = bires[k, 0], bires[k, 1]
+            if ientry[k] == nentry:
+                nentry += 1
+                x2orig[e] = ident
+                if ir0 >= 0:
+                    # stubs are rigid, inverse is rotation transposed
+                    stub = stubs[res0 + ir0]
+                    for a in range(3):
+                        for b in range(3):
+                            x2orig[e, a, b] = stub[b, a]
+                            x2orig[e, a, 3] -= stub[b, a] * stub[b, 3]
+            if iexit[k] == nexit and len(exit_stub):
+                nexit += 1
+                x = start[iblk, 2] + iexit[k]
+                exit_stub[x] = ident if ir1 < 0 else stubs[res0 + ir1]
+            if not len(x2exit):
+                pass
+            elif ir1 < 0:
+                x2exit[i] = x2orig[e]
+            else:
+                stub = stubs[res0 + ir1]
+                for a in range(4):
+                    for b in range(4):
+                        x2exit[i, a, b] = 0
+                        for c in range(4):
+                            x2exit[i, a, b] += x2orig[e, a, c] * stub[c, b]
+            ires[i] = bires[k]
+            isite[i] = bisite[k]
+            ichain[i] = bichain[k]
+            ibblock[i] = bbids[iblk]
+            inout[i, 0] = e
+            inout[i, 1] = start[iblk, 2] + iexit[k]
+
+
+_vertex_counts_serial = jit(_vertex_counts)
+_vertex_fill_serial = jit(_vertex_fill)
+_pjit = nb.njit(nogil=True, fastmath=True, parallel=True)
+_vertex_counts_parallel = _pjit(_vertex_counts)
+_vertex_fill_parallel = _pjit(_vertex_fill)
+
+
+@contextlib.contextmanager
+def _numba_threads(parallel):
+    """run prange kernels with parallel threads if it is an int > 1
+
+    parallel used to be the number of worker processes of Vertex, it is
+    now the number of numba threads, at most NUMBA_NUM_THREADS. True or 1
+    keep numba's current number
+    """
+    nthread = nb.get_num_threads()
+    if parallel is not True and int(parallel) > 1:
+        nb.set_num_threads(min(int(parallel), nb.config.NUMBA_NUM_THREADS))
+    try:
+        yield
+    finally:
+        nb.set_num_threads(nthread)
+
+
+def vertex_arrays(
+        bbset, din, dout, bbids=None, min_seg_len=1, parallel=0, lazy=False
+):
+    """build the arrays of a _Vertex for a whole library in one pass
+
+    for each block, every residue of a connection in direction din is paired
+    with every residue of a connection in direction dout (2 meaning no
+    connection, residue -1). pairs from the same site, or from the same chain
+    closer than min_seg_len in sequence, are removed
 
     Args:
-        bb (TYPE): Description
-        bbid (TYPE): Description
-        din (TYPE): Description
-        dout (TYPE): Description
-        min_seg_len (TYPE): Description
+        bbset (_BBlockSet): bblock library
+        din (int): entry direction, 0 N, 1 C, 2 none
+        dout (int): exit direction
+        bbids (np.ndarray, optional): ibblock values of blocks, default
+            position in bbset
+        min_seg_len (int, optional): min residues between entry and exit
+            on the same chain
+        parallel (int, optional): loop over blocks in threads, an int > 1
+            is the number of threads, see _numba_threads
+        lazy (bool, optional): store exit stubs instead of x2exit
 
     Returns:
-        TYPE: Description
+        (tuple, np.ndarray, np.ndarray): arrays x2exit (empty if lazy),
+        x2orig (one per entry), ires, isite, ichain, ibblock, inout and
+        exit_stub (one per exit, empty unless lazy), indices of blocks
+        without connections in din or dout, and (nblk + 1,) first row of
+        each block
+    """
+    offsets, _, stubs, _, chains, connections, _ = bbset._state
+    if bbids is None: bbids = np.arange(len(offsets) - 1)
+    bbids = np.asarray(bbids, dtype='i4')
+    counts_fn = _vertex_counts_parallel if parallel else _vertex_counts_serial
+    fill_fn = _vertex_fill_parallel if parallel else _vertex_fill_serial
+    with _numba_threads(parallel):
+        counts = counts_fn(offsets, chains, connections, din, dout,
+                           min_seg_len)
+    invalid = np.flatnonzero(counts[:, 0] < 0)
+    counts[invalid] = 0
+    start = np.zeros((len(counts) + 1, 3), dtype='i8')
+    np.cumsum(counts, axis=0, out=start[1:])
+    n = start[-1, 0]
+    x2exit = np.empty((0 if lazy else n, 4, 4))
+    x2orig = np.empty((start[-1, 1], 4, 4))
+    ires, isite, ichain, inout = (np.empty((n, 2), 'i4') for i in range(4))
+    ibblock = np.empty(n, 'i4')
+    exit_stub = np.empty((start[-1, 2] if lazy else 0, 4, 4))
+    with _numba_threads(parallel):
+        fill_fn(offsets, stubs, chains, connections, din, dout, min_seg_len,
+                bbids, start, x2exit, x2orig, ires, isite, ichain, ibblock,
+                inout, exit_stub)
+    return ((x2exit, x2orig, ires, isite, ichain, ibblock, inout, exit_stub),
+            invalid, start[:, 0])
+
+
+def cyclic_symmetry(ncac, chains, rms_tol=_SYMMETRY_RMS_TOL):
+    """order of the cyclic symmetry taking chain i to chain i + 1
+
+    the transform superimposing chain 0 on chain 1 must superimpose every
+    chain i on chain i + 1, and the last on the first, within rms_tol
+
+    Args:
+        ncac (np.ndarray): (nres, 3, 4) backbone coordinates
+        chains (np.ndarray): (nchain, 2) residue bounds of chains
+        rms_tol (float, optional): max CA rms
+
+    Returns:
+        int: nchain if the block is a Cn homo-oligomer, else 1
+    """
+    nchain = len(chains)
+    lens = chains[:, 1] - chains[:, 0]
+    if nchain < 2 or np.any(lens != lens[0]) or lens[0] < 3:
+        return 1
+    ca = [ncac[b:e, 1, :3] for b, e in chains]
+    cen0, cen1 = ca[0].mean(axis=0), ca[1].mean(axis=0)
+    u, s, vt = np.linalg.svd((ca[0] - cen0).T @ (ca[1] - cen1))
+    if np.linalg.det(u @ vt) < 0:
+        u[:, -1] = -u[:, -1]
+    rot = (u @ vt).T
+    for i in range(nchain):
+        moved = (ca[i] - cen0) @ rot.T + cen1
+        dist2 = np.sum((moved - ca[(i + 1) % nchain])**2, axis=-1)
+        if np.sqrt(np.mean(dist2)) > rms_tol:
+            return 1
+    return nchain
+
+
+@jit
+def _shift_res(chains, ir, ichain, shift):
+    if ir < 0: return -1
+    jchain = (ichain + shift) % len(chains)
+    return ir - chains[ichain, 0] + chains[jchain, 0]
+
+
+@jit
+def _symmetry_orbits(ires, ichain, rowstart, offsets, chains, nfold):
+    """rows equivalent under the cyclic symmetry of their block
+
+    the representative of an orbit is the row entering on chain 0. orbits
+    are only formed if every shifted row is in the vertex, rows of
+    incomplete orbits are kept as they are
+
+    Returns:
+        (np.ndarray, np.ndarray): bool keep of each row, and (nrow, maxfold)
+        orbit of each representative row, -1 padded
+    """
+    nrow = len(ires)
+    keep = np.ones(nrow, np.bool_)
+    orbit = np.full((nrow, max(1, np.max(nfold))), -1, np.int32)
+    for i in range(nrow):
+        orbit[i, 0] = i
+    for iblk in range(len(nfold)):
+        nf = nfold[iblk]
+        if nf < 2 or rowstart[iblk] == rowstart[iblk + 1]: continue
+        bchains = chains[offsets[iblk, _OFST_CHAIN]:offsets[iblk + 1,
+                                                            _OFST_CHAIN]]
+        nres = offsets[iblk + 1, _OFST_RES] - offsets[iblk, _OFST_RES] + 1
+        lookup = dict()
+        for i in range(rowstart[iblk], rowstart[iblk + 1]):
+            lookup[(ires[i, 0] + 1) * nres + ires[i, 1] + 1] = i
+        members = np.empty(nf, np.int64)
+        for i in range(rowstart[iblk], rowstart[iblk + 1]):
+            if ichain[i, 0] != 0: continue
+            complete = True
+            for shift in range(1, nf):
+                ir0 = _shift_res(bchains, ires[i, 0], ichain[i, 0], shift)
+                ir1 = _shift_res(bchains, ires[i, 1], ichain[i, 1], shift)
+                key = (ir0 + 1) * nres + ir1 + 1
+                if key not in lookup:
+                    complete = False
+                    break
+                members[shift] = lookup[key]
+            if not complete: continue
+            for shift in range(1, nf):
+                keep[members[shift]] = False
+                orbit[i, shift] = members[shift]
+    return keep, orbit
+
+
+def _symmetry_compress(tup, rowstart, bbset, din):
+    """keep one row per orbit of symmetry equivalent rows
+
+    rows of a Cn block related by its symmetry enter and exit the block the
+    same way, so their splices and x2exit agree up to how symmetric the
+    block really is, but x2orig of the members differs by the symmetry
+    rotation of the block. searches use the representative of each orbit,
+    expand_symmetric rescores the members, see grow_linear. vertices
+    without entry (din 2) are not compressed: the same exit on different
+    chains gives worms related by a global rotation
+
+    Returns:
+        tuple: vertex arrays as from vertex_arrays, and orbit
+    """
+    x2exit, x2orig, ires, isite, ichain, ibblock, inout, exit_stub = tup
+    offsets, ncac, _, _, chains, _, _ = bbset._state
+    nfold = np.ones(len(offsets) - 1, dtype='i4')
+    if din != 2:
+        for iblk in range(len(nfold)):
+            b, e = offsets[iblk:iblk + 2, _OFST_CHAIN]
+            r = offsets[iblk, _OFST_RES]
+            nfold[iblk] = cyclic_symmetry(ncac[r:], chains[b:e])
+    keep, orbit = _symmetry_orbits(ires, ichain, rowstart, offsets, chains,
+                                   nfold)
+    rows = np.flatnonzero(keep)
+    # entry and exit ids increase along rows, renumber the kept ones
+    ientry, inout0 = np.unique(inout[rows, 0], return_inverse=True)
+    iexit, inout1 = np.unique(inout[rows, 1], return_inverse=True)
+    inout = np.stack([inout0, inout1], axis=-1).astype('i4')
+    if len(x2exit): x2exit = x2exit[rows]
+    if len(exit_stub): exit_stub = exit_stub[iexit]
+    tup = (x2exit, x2orig[ientry], ires[rows], isite[rows], ichain[rows],
+           ibblock[rows], inout, exit_stub)
+    orbit = orbit[rows]
+    width = max(1, np.max(np.sum(orbit >= 0, axis=1), initial=0))
+    return tup, np.ascontiguousarray(orbit[:, :width])
+
+
+def orbit_indices(indices, verts):
+    """indices of all worms equivalent to indices over symmetric vertices
+
+    the worms are not scored, see expand_symmetric
+
+    Args:
+        indices (np.ndarray): (nresult, nvert) indices into verts, like
+            SearchResult.indices
+        verts (tuple(_Vertex)): vertices indices refer to, some of them
+            symmetric
+
+    Returns:
+        (np.ndarray, np.ndarray): (nexpand,) index into indices and
+        (nexpand, nvert) indices into the uncompressed vertices, which are
+        the same as verts for verts that are not symmetric
+    """
+    iresult, expanded = [], []
+    for i, idx in enumerate(indices):
+        choices = []
+        for ivert, vert in zip(idx, verts):
+            if vert.symmetric:
+                orbit = vert.orbit[ivert]
+                choices.append(orbit[orbit >= 0])
+            else:
+                choices.append([ivert])
+        for combo in itertools.product(*choices):
+            iresult.append(i)
+            expanded.append(combo)
+    return (np.array(iresult, dtype='i4'),
+            np.array(expanded, dtype='i4').reshape(-1, len(verts)))
+
+
+def vertex_append(vertex, bbs, bbids, min_seg_len=1, parallel=0):
+    """vertex with rows of new bblocks appended
+
+    the result is identical to building the vertex from the old and new
+    bblocks together: blocks are independent and rows, entries and exits are
+    numbered in block order. lazy, symmetric and dtype follow vertex
+
+    Args:
+        vertex (_Vertex): vertex built from the old bblocks
+        bbs (list or _BBlockSet): new bblocks
+        bbids (np.ndarray): ibblock values of new bblocks, their index in
+            the list of all bblocks
+        min_seg_len (int, optional): must be the one vertex was built with
+        parallel (int, optional): see Vertex
+
+    Returns:
+        _Vertex: new vertex, old rows come first
     """
-    bb = _BBlock(*bbstate)
-    ires0, ires1 = [], []
-    isite0, isite1 = [], []
-    for i in range(bb.n_connections):
-        ires = bb.conn_resids(i)
-        if bb.conn_dirn(i) == din:
-            ires0.append(ires)
-            isite0.append(np.repeat(i, len(ires)))
-        if bb.conn_dirn(i) == dout:
-            ires1.append(ires)
-            isite1.append(np.repeat(i, len(ires)))
-    if (din < 2 and not ires0 or dout < 2 and not ires1):
-        dirn = 'NC_' [din] + 'NC_' [dout]
-        warning('invalid vertex ' + dirn + ' ' + bytes(bb.file).decode())
-        return None
-
-    dummy = [np.array([-1], dtype='i4')]
-    ires0 = np.concatenate(ires0 or dummy)
-    ires1 = np.concatenate(ires1 or dummy)
-    isite0 = np.concatenate(isite0 or dummy)
-    isite1 = np.concatenate(isite1 or dummy)
-    chain0 = chain_of_ires(bb, ires0)
-    chain1 = chain_of_ires(bb, ires1)
-
-    if ires0[0] == -1: assert len(ires0) is 1
-    else: assert np.all(ires0 >= 0)
-    if ires1[0] == -1: assert len(ires1) is 1
-    else: assert np.all(ires1 >= 0)
-
-    if ires0[0] == -1: stub0inv = np.eye(4).reshape(1, 4, 4)
-    else: stub0inv = np.linalg.inv(bb.stubs[ires0])
-    if ires1[0] == -1: stub1 = np.eye(4).reshape(1, 4, 4)
-    else: stub1 = bb.stubs[ires1]
-
-    stub0inv, stub1 = np.broadcast_arrays(stub0inv[:, None], stub1)
-    ires = np.stack(np.broadcast_arrays(ires0[:, None], ires1), axis=-1)
-    isite = np.stack(np.broadcast_arrays(isite0[:, None], isite1), axis=-1)
-    chain = np.stack(np.broadcast_arrays(chain0[:, None], chain1), axis=-1)
-
-    x2exit = stub0inv @ stub1
-    x2orig = stub0inv
-    assert is_homog_xform(x2exit)  # this could be slowish
-    assert is_homog_xform(x2orig)
-
-    # min chain len, not same site
-    not_same_chain = chain[..., 0] != chain[..., 1]
-    not_same_site = isite[..., 0] != isite[..., 1]
-    seqsep = np.abs(ires[..., 0] - ires[..., 1])
-
-    # remove invalid in/out pairs (+ is or, * is and)
-    valid = not_same_site
-    valid *= (not_same_chain + (seqsep >= min_seg_len))
-    valid = valid.reshape(-1)
-
-    if sum(valid) == 0: return None
-
-    return (
-        x2exit.reshape(-1, 4, 4)[valid],
-        x2orig.reshape(-1, 4, 4)[valid],
-        ires.reshape(-1, 2)[valid].astype('i4'),
-        isite.reshape(-1, 2)[valid].astype('i4'),
-        chain.reshape(-1, 2)[valid].astype('i4'),
-        np.repeat(bbid, sum(valid)).astype('i4'),
-    )
-
-
-def Vertex(bbs, dirn, bbids=None, min_seg_len=1, parallel=0):
+    dirn = ''.join('NC_' [d] for d in vertex.dirn)
+    try:
+        new = Vertex(bbs, dirn, bbids, min_seg_len, parallel,
+                     lazy=vertex.lazy, symmetric=vertex.symmetric)
+    except ValueError:  # new bblocks add no rows
+        return vertex
+    old = dict(zip(_VERTEX_FIELDS, vertex._state))
+    new = dict(zip(_VERTEX_FIELDS, new._state))
+    new['inout'] += [len(old['x2orig']), np.max(old['inout'][:, 1]) + 1]
+    if vertex.symmetric:
+        width = max(old['orbit'].shape[1], new['orbit'].shape[1])
+        for state in (old, new):
+            pad = width - state['orbit'].shape[1]
+            state['orbit'] = np.pad(state['orbit'], [(0, 0), (0, pad)],
+                                    constant_values=-1)
+        # orbits hold rows of the uncompressed vertex, each exactly once
+        nfull = np.sum(old['orbit'] >= 0)
+        new['orbit'][new['orbit'] >= 0] += nfull
+    state = dict()
+    for name in _VERTEX_FIELDS:
+        if name in ('inbreaks', 'dirn'): continue
+        ary = np.concatenate([old[name], new[name].astype(old[name].dtype)])
+        state[name] = np.ascontiguousarray(ary)
+    state['inbreaks'] = util.contig_idx_breaks(state['inout'][:, 0])
+    state['dirn'] = old['dirn']
+    return vertex_from_state([state[name] for name in _VERTEX_FIELDS])
+
+
+def _vertex_tail(vertex, start):
+    """rows start: of vertex as a vertex, entries and exits from 0"""
+    state = dict(zip(_VERTEX_FIELDS, vertex._state))
+    inout = state['inout'][start:]
+    ientry, iexit = inout[0, 0], np.min(inout[:, 1])
+    inout = np.ascontiguousarray(inout - [ientry, iexit]).astype('i4')
+    for name in ('ires', 'isite', 'ichain', 'ibblock'):
+        state[name] = np.ascontiguousarray(state[name][start:])
+    if len(state['x2exit']):
+        state['x2exit'] = state['x2exit'][start:]
+    if len(state['exit_stub']):
+        state['exit_stub'] = state['exit_stub'][iexit:]
+    state['x2orig'] = state['x2orig'][ientry:]
+    state['inout'] = inout
+    state['inbreaks'] = util.contig_idx_breaks(inout[:, 0])
+    state['orbit'] = np.empty((0, 0), dtype='i4')
+    return vertex_from_state([state[name] for name in _VERTEX_FIELDS])
+
+
+def vertex_cache_key(
+        bbset, dirn, bbids, min_seg_len, lazy=False, symmetric=False
+):
+    """content hash of everything a Vertex is built from
+
+    Args:
+        bbset (_BBlockSet): bblock library
+        dirn (str): vertex direction, like 'NC'
+        bbids (np.ndarray): int32 ibblock values of blocks
+        min_seg_len (int): min segment length
+        lazy (bool): lazy vertex
+        symmetric (bool): symmetry compressed vertex
+
+    Returns:
+        str: sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps([_VERTEX_CACHE_VERSION, dirn,
+                           int(min_seg_len),
+                           bool(lazy),
+                           bool(symmetric)]).encode())
+    # ncac because symmetric vertices take their orbits from coordinates
+    offsets, ncac, stubs, _, chains, connections, _ = bbset._state
+    for ary in (offsets, ncac, stubs, chains, connections, bbids):
+        ary = np.ascontiguousarray(ary)
+        sha.update(str((ary.dtype.str, ary.shape)).encode())
+        sha.update(ary.data)
+    return sha.hexdigest()
+
+
+def save_vertex(path, vertex):
+    """write vertex arrays to directory path as .npy files
+
+    the directory is written under a temporary name and renamed into place,
+    if another process got there first its copy is kept
+    """
+    path = os.path.abspath(str(path))
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.vertex_tmp')
+    for name, ary in zip(_VERTEX_FIELDS, vertex._state):
+        np.save(os.path.join(tmp, name + '.npy'), ary)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_vertex(path):
+    """load vertex saved with save_vertex, arrays are memory mapped"""
+    state = tuple(
+        # copy-on-write, jitclass members must be writeable
+        np.asarray(np.load(os.path.join(path, f + '.npy'), mmap_mode='c'))
+        for f in _VERTEX_FIELDS)
+    return vertex_from_state(state)
+
+
+def Vertex(
+        bbs,
+        dirn,
+        bbids=None,
+        min_seg_len=1,
+        parallel=0,
+        dtype=np.float64,
+        cachedir=None,
+        lazy=False,
+        symmetric=False,
+):
     """Summary
 
     Args:
-        bbs (TYPE): Description
+        bbs (list or _BBlockSet): bblocks, lists are packed with BBlockSet
         bbids (TYPE): Description
         dirn (TYPE): Description
         min_seg_len (TYPE): Description
+        parallel (int): build vertex arrays in numba threads instead of
+            the process pool over blocks of earlier versions. an int > 1
+            still sets the number of workers, now threads, see
+            vertex_arrays
+        dtype (np.dtype): np.float32 for a _Vertex_f4 with single precision
+            transforms
+        cachedir (str, optional): load the vertex from, or save it to, this
+            directory, keyed by vertex_cache_key
+        lazy (bool): don't store x2exit, which is entries * exits per block,
+            but only the exit stubs. x2exit is computed in vertex_x2exit.
+            for libraries where x2exit doesn't fit in memory
+        symmetric (bool): keep one row per set of rows of a Cn
+            homo-oligomer related by its symmetry, see _symmetry_compress.
+            orbit holds the equivalent rows of the vertex built with
+            symmetric=False. grow_linear searches and scores the kept rows,
+            with edges built over them, expand_symmetric gives the worms
+            over the uncompressed vertices
 
     Returns:
         TYPE: Description
@@ -183,32 +740,47 @@ def Vertex(bbs, dirn, bbids=None, min_seg_len=1, parallel=0):
     dirn_map = {'N': 0, 'C': 1, '_': 2}
     din = dirn_map[dirn[0]]
     dout = dirn_map[dirn[1]]
+    if not isinstance(bbs, _BBlockSet):
+        bbs = BBlockSet(bbs)
     if bbids is None:
-        bbids = np.arange(len(bbs))
-
-    exe = cf.ProcessPoolExecutor if parallel else InProcessExecutor
-    with exe() as pool:
-        futures = list()
-        for bb, bid in zip(bbs, bbids):
-            futures.append(
-                pool.submit(vertex_single, bb._state, bid, din, dout,
-                            min_seg_len))
-        verts = [f.result() for f in futures]
-    verts = [v for v in verts if v is not None]
-    if not verts:
+        bbids = np.arange(bbs.len)
+    bbids = np.asarray(bbids, dtype='i4')
+
+    if cachedir:
+        key = vertex_cache_key(bbs, dirn, bbids, min_seg_len, lazy,
+                               symmetric)
+        path = os.path.join(cachedir, 'vertex_' + key)
+        if os.path.exists(path):
+            vertex = load_vertex(path)
+        else:
+            vertex = _build_vertex(bbs, dirn, din, dout, bbids, min_seg_len,
+                                   parallel, lazy, symmetric)
+            save_vertex(path, vertex)
+    else:
+        vertex = _build_vertex(bbs, dirn, din, dout, bbids, min_seg_len,
+                               parallel, lazy, symmetric)
+    if dtype != np.float64:
+        vertex = vertex_astype(vertex, dtype)
+    return vertex
+
+
+def _build_vertex(
+        bbs, dirn, din, dout, bbids, min_seg_len, parallel, lazy, symmetric
+):
+    tup, invalid, rowstart = vertex_arrays(bbs, din, dout, bbids, min_seg_len,
+                                           parallel, lazy)
+    for i in invalid:
+        warning('invalid vertex ' + dirn + ' ' +
+                bytes(bbs._string(i, 0)).decode())
+    orbit = np.empty((0, 0), dtype='i4')
+    if symmetric:
+        tup, orbit = _symmetry_compress(tup, rowstart, bbs, din)
+    x2exit, x2orig, ires, isite, ichain, ibblock, inout, exit_stub = tup
+    if not len(ires):
         raise ValueError('no way to make vertex: \'' + dirn + '\'')
-    tup = tuple(np.concatenate(_) for _ in zip(*verts))
-    assert len({x.shape[0] for x in tup}) == 1
-    ibblock, ires = tup[5], tup[2]
-
-    inout = np.stack(
-        [
-            util.unique_key(ibblock, ires[:, 0]),
-            util.unique_key(ibblock, ires[:, 1])
-        ],
-        axis=-1).astype('i4')
-
     inbreaks = util.contig_idx_breaks(inout[:, 0])
     assert inbreaks.dtype == np.int32
 
-    return _Vertex(*tup, inout, inbreaks, np.array([din, dout], dtype='i4'))
+    return _Vertex(x2exit, x2orig, ires, isite, ichain, ibblock, inout,
+                   inbreaks, np.array([din, dout], dtype='i4'), exit_stub,
+                   orbit)